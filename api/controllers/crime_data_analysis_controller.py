@@ -1,7 +1,14 @@
-from fastapi import APIRouter, HTTPException, Query
+from typing import List, Optional, Tuple
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel
-from services.crime_data_analysis_service import analyze_crime_data, analyze_coordinate_crime_data
-from models.crime_data_models import CITIES, TIME_RANGES
+from services.crime_data_analysis_service import analyze_crime_data, analyze_coordinate_crime_data, encode_coordinate_crime_data, get_analysis_cache_stats
+from models.crime_data_models import CITIES, TIME_RANGES, COORDINATE_RESPONSE_FORMATS
+from services.spatial_index_service import query_crimes_in_bbox, query_crimes_within_radius, query_crime_density_along_route
+from constants import GEOHASH_MIN_PRECISION, GEOHASH_MAX_PRECISION, MAX_SPATIAL_QUERY_RADIUS_METERS, MAX_SPATIAL_QUERY_COORDINATES, MAX_COORDINATE_PAGE_SIZE
+from util.executor_util import Backend, BackendSaturatedError, run_on_backend, get_backend_executor_stats
+from util.coordinate_codec import DELTA_MEDIA_TYPE, PACKED_MEDIA_TYPE, encode_delta_coordinates, encode_packed_coordinates
+from util.streaming_util import NDJSON_MEDIA_TYPE, iter_ndjson, iter_json_object, decode_cursor, paginate
 from util.logger import logger
 
 router = APIRouter()
@@ -11,8 +18,30 @@ class CrimeDataAnalysisResponse(BaseModel):
     crime_statistics: list[dict]
 
 class CoordinateCrimeDataResponse(BaseModel):
+    next_cursor: Optional[str] = None
     coordinate_crime_data: list[dict]
 
+class SpatialCrimeDataResponse(BaseModel):
+    crime_count: int
+    coordinate_count: int
+    coordinates: list[dict]
+
+class RouteCrimeDensityResponse(SpatialCrimeDataResponse):
+    length_meters: float
+    crimes_per_km: Optional[float]
+    segments: list[dict]
+
+class AnalysisCacheStatsResponse(BaseModel):
+    size: int
+    max_size: int
+    ttl_seconds: float
+    hits: int
+    misses: int
+    coalesced: int
+    hit_ratio: float
+    evictions: int
+    invalidations: int
+
 @router.get("/", response_model=CrimeDataAnalysisResponse)
 async def analyze_crime_data_route(
     city: CITIES = Query(..., description="City to analyze"),
@@ -20,27 +49,173 @@ async def analyze_crime_data_route(
 ) -> CrimeDataAnalysisResponse:
     try:
         logger.info(f"Received request for crime data analysis: city={city.value}, time_range={time_range.value}")
-        result = analyze_crime_data(city.value, time_range.value)
+        result = await run_on_backend(Backend.ANALYSIS, analyze_crime_data, city.value, time_range.value)
         logger.info(f"Analyzed crime result: {result}")
         return CrimeDataAnalysisResponse(
             total_crimes=result["total_crimes"],
             crime_statistics=result["crime_statistics"]
         )
+    except BackendSaturatedError:
+        raise
     except Exception as e:
         logger.error(f"Error during crime data analysis: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@router.get("/coordinate", response_model=CoordinateCrimeDataResponse)
+# Binary coordinate formats: media type and encoder
+COORDINATE_ENCODERS = {
+    COORDINATE_RESPONSE_FORMATS.DELTA: (DELTA_MEDIA_TYPE, encode_delta_coordinates),
+    COORDINATE_RESPONSE_FORMATS.PACKED: (PACKED_MEDIA_TYPE, encode_packed_coordinates)
+}
+
+def get_coordinate_response_format(request: Request, response_format: Optional[COORDINATE_RESPONSE_FORMATS]) -> COORDINATE_RESPONSE_FORMATS:
+    '''
+    The `format` query parameter wins, otherwise the Accept header picks the format.
+    '''
+    if response_format is not None:
+        return response_format
+    accept = request.headers.get("accept", "")
+    for media_type, accepted_format in (
+        (DELTA_MEDIA_TYPE, COORDINATE_RESPONSE_FORMATS.DELTA),
+        (PACKED_MEDIA_TYPE, COORDINATE_RESPONSE_FORMATS.PACKED),
+        (NDJSON_MEDIA_TYPE, COORDINATE_RESPONSE_FORMATS.NDJSON)
+    ):
+        if media_type in accept:
+            return accepted_format
+    return COORDINATE_RESPONSE_FORMATS.JSON
+
+@router.get(
+    "/coordinate",
+    response_model=CoordinateCrimeDataResponse,
+    responses={200: {"content": {NDJSON_MEDIA_TYPE: {}, DELTA_MEDIA_TYPE: {}, PACKED_MEDIA_TYPE: {}}}}
+)
 async def coordinate_crime_data_route(
+    request: Request,
     city: CITIES = Query(..., description="City to analyze"),
-    time_range: TIME_RANGES = Query(..., description="Time range for analysis")
-) -> CoordinateCrimeDataResponse:
-    try:
-        logger.info(f"Analyzing coordinate crime data for {city.value} with time range: {time_range.value}")
-        result = analyze_coordinate_crime_data(city.value, time_range.value)
-        return CoordinateCrimeDataResponse(
-            coordinate_crime_data=result
+    time_range: TIME_RANGES = Query(..., description="Time range for analysis"),
+    resolution: Optional[int] = Query(
+        None,
+        ge=GEOHASH_MIN_PRECISION,
+        le=GEOHASH_MAX_PRECISION,
+        description="Geohash precision of the cells the crimes are counted in, raw coordinates when omitted"
+    ),
+    response_format: Optional[COORDINATE_RESPONSE_FORMATS] = Query(
+        None,
+        alias="format",
+        description=(
+            "json (default), ndjson (one row per line), or the binary delta or packed coordinate encodings "
+            "(see util/coordinate_codec.py). Except for json the next page cursor is in the X-Next-Cursor header"
         )
+    ),
+    top_n: Optional[int] = Query(None, ge=1, description="Only the top_n coordinates with the most crimes"),
+    page_size: Optional[int] = Query(None, ge=1, le=MAX_COORDINATE_PAGE_SIZE, description="Rows per page, all rows when omitted"),
+    cursor: Optional[str] = Query(None, description="next_cursor of the previous page")
+) -> Response:
+    response_format = get_coordinate_response_format(request, response_format)
+    try:
+        offset = decode_cursor(cursor) if cursor else 0
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    try:
+        logger.info(f"Analyzing coordinate crime data for {city.value} with time range: {time_range.value}, resolution: {resolution}, format: {response_format.value}")
+        if response_format in COORDINATE_ENCODERS:
+            media_type, encode = COORDINATE_ENCODERS[response_format]
+            content, next_cursor = await run_on_backend(
+                Backend.ANALYSIS, encode_coordinate_crime_data,
+                city.value, time_range.value, resolution, response_format.value, encode, offset, page_size, top_n
+            )
+            headers = {"X-Next-Cursor": next_cursor} if next_cursor else None
+            return Response(content, media_type=media_type, headers=headers)
+
+        result = await run_on_backend(Backend.ANALYSIS, analyze_coordinate_crime_data, city.value, time_range.value, resolution)
+        rows, next_cursor = paginate(result, offset, page_size, top_n)
+    except BackendSaturatedError:
+        raise
     except Exception as e:
         logger.error(f"Error during coordinate crime data analysis: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
+
+    # Rows are serialized in batches while the response is sent, the response model
+    # documents the JSON body but is not built
+    if response_format == COORDINATE_RESPONSE_FORMATS.NDJSON:
+        headers = {"X-Next-Cursor": next_cursor} if next_cursor else None
+        return StreamingResponse(iter_ndjson(rows), media_type=NDJSON_MEDIA_TYPE, headers=headers)
+    return StreamingResponse(
+        iter_json_object({"next_cursor": next_cursor}, "coordinate_crime_data", rows),
+        media_type="application/json"
+    )
+
+def parse_route_path(path: str) -> List[Tuple[float, float]]:
+    '''
+    Parse a "lat,lon;lat,lon;..." polyline.
+    '''
+    try:
+        vertices = [tuple(float(value) for value in vertex.split(",")) for vertex in path.split(";") if vertex.strip()]
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid path: {path}")
+    if not vertices or any(len(vertex) != 2 or not (-90 <= vertex[0] <= 90 and -180 <= vertex[1] <= 180) for vertex in vertices):
+        raise HTTPException(status_code=400, detail=f"Invalid path: {path}")
+    return vertices
+
+@router.get("/bbox", response_model=SpatialCrimeDataResponse)
+async def bbox_crime_data_route(
+    city: CITIES = Query(..., description="City to analyze"),
+    time_range: TIME_RANGES = Query(..., description="Time range for analysis"),
+    min_lat: float = Query(..., ge=-90, le=90),
+    min_lon: float = Query(..., ge=-180, le=180),
+    max_lat: float = Query(..., ge=-90, le=90),
+    max_lon: float = Query(..., ge=-180, le=180),
+    limit: int = Query(100, ge=0, le=MAX_SPATIAL_QUERY_COORDINATES, description="Maximum number of coordinates returned, by crime count DESC")
+) -> SpatialCrimeDataResponse:
+    try:
+        result = await run_on_backend(Backend.ANALYSIS, query_crimes_in_bbox, city.value, time_range.value, min_lat, min_lon, max_lat, max_lon, limit)
+        return SpatialCrimeDataResponse(**result)
+    except BackendSaturatedError:
+        raise
+    except Exception as e:
+        logger.error(f"Error during bounding box crime data query: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/radius", response_model=SpatialCrimeDataResponse)
+async def radius_crime_data_route(
+    city: CITIES = Query(..., description="City to analyze"),
+    time_range: TIME_RANGES = Query(..., description="Time range for analysis"),
+    lat: float = Query(..., ge=-90, le=90),
+    lon: float = Query(..., ge=-180, le=180),
+    radius_meters: float = Query(..., gt=0, le=MAX_SPATIAL_QUERY_RADIUS_METERS),
+    limit: int = Query(100, ge=0, le=MAX_SPATIAL_QUERY_COORDINATES, description="Maximum number of coordinates returned, by crime count DESC")
+) -> SpatialCrimeDataResponse:
+    try:
+        result = await run_on_backend(Backend.ANALYSIS, query_crimes_within_radius, city.value, time_range.value, lat, lon, radius_meters, limit)
+        return SpatialCrimeDataResponse(**result)
+    except BackendSaturatedError:
+        raise
+    except Exception as e:
+        logger.error(f"Error during radius crime data query: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/route", response_model=RouteCrimeDensityResponse)
+async def route_crime_density_route(
+    city: CITIES = Query(..., description="City to analyze"),
+    time_range: TIME_RANGES = Query(..., description="Time range for analysis"),
+    path: str = Query(..., description="Walk route as lat,lon vertices separated by ';'"),
+    width_meters: float = Query(50, gt=0, le=MAX_SPATIAL_QUERY_RADIUS_METERS, description="Distance from the route within which crimes are counted"),
+    limit: int = Query(100, ge=0, le=MAX_SPATIAL_QUERY_COORDINATES, description="Maximum number of coordinates returned, by crime count DESC")
+) -> RouteCrimeDensityResponse:
+    vertices = parse_route_path(path)
+    try:
+        result = await run_on_backend(Backend.ANALYSIS, query_crime_density_along_route, city.value, time_range.value, vertices, width_meters, limit)
+        return RouteCrimeDensityResponse(**result)
+    except BackendSaturatedError:
+        raise
+    except Exception as e:
+        logger.error(f"Error during route crime density query: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/cache-stats", response_model=AnalysisCacheStatsResponse)
+async def analysis_cache_stats_route() -> AnalysisCacheStatsResponse:
+    return AnalysisCacheStatsResponse(**get_analysis_cache_stats())
+
+@router.get("/backend-stats")
+async def backend_stats_route() -> dict:
+    return get_backend_executor_stats()
@@ -1,11 +1,10 @@
-from config import config
-
+import asyncio
 from fastapi import APIRouter, HTTPException
-from pydantic import BaseModel
-from services.upload_crime_data_service import upload_crime_data_to_gcs
-from services.upload_coordinate_crime_data_service import upload_coordinate_crime_data_to_gcs
-from models.crime_data_models import TIME_RANGES, CITIES
-from util.fetch_crime_data import fetch_city_data
+from pydantic import BaseModel, validator
+from typing import List, Optional
+from services.ingest_job_service import ingest_job_queue
+from models.crime_data_models import TIME_RANGES, CITIES, OUTPUT_FORMATS, INGEST_MODES
+from util.executor_util import BackendSaturatedError
 from util.logger import logger
 
 router = APIRouter()
@@ -13,36 +12,95 @@ router = APIRouter()
 class UpLoadCrimeDataRequest(BaseModel):
     city: CITIES
     time_range: TIME_RANGES
+    output_format: OUTPUT_FORMATS = OUTPUT_FORMATS.CSV
+    # delta only fetches the records since the watermark of a previous Parquet upload,
+    # multi_range also uploads the time ranges within time_range from the same fetch,
+    # summary only refreshes the counts, aggregated by the portal
+    mode: INGEST_MODES = INGEST_MODES.FULL
+
+    @validator("mode")
+    def validate_mode(cls, mode, values):
+        if mode == INGEST_MODES.DELTA and values.get("output_format") != OUTPUT_FORMATS.PARQUET:
+            raise ValueError("delta mode requires the parquet output format (date partitioned output)")
+        return mode
 
 class UpLoadCrimeDataResponse(BaseModel):
     message: str
 
+class IngestJobResponse(BaseModel):
+    job_id: str
+    city: CITIES
+    time_range: TIME_RANGES
+    output_format: OUTPUT_FORMATS
+    mode: INGEST_MODES
+    status: str
+    stage: str
+    rows_fetched: int
+    rows_transformed: int
+    rows_uploaded: int
+    created_at: float
+    started_at: Optional[float]
+    finished_at: Optional[float]
+    error: Optional[str]
+    coalesced: bool = False
+
+class UpLoadCrimeDataBatchRequest(BaseModel):
+    items: List[UpLoadCrimeDataRequest]
+
+class UpLoadCrimeDataBatchResponse(BaseModel):
+    jobs: List[IngestJobResponse]
+
 @router.post("/", response_model=UpLoadCrimeDataResponse)
 async def upload_crime_data(request: UpLoadCrimeDataRequest) -> UpLoadCrimeDataResponse:
     try:
         city = request.city.value
         time_range = request.time_range.value
         logger.info(f"Received request to upload crime data for {city} with time range: {time_range}")
-        
-        # fetch crime raw data
-        logger.info(f"Fetching raw crime data for {city}")
-        raw_data = fetch_city_data(city, time_range)
-        logger.info(f"Successfully fetched {len(raw_data)} records of raw data for {city}")
-        
-        # upload all crime data to GCS
-        logger.info(f"Uploading all crime data to GCS for {city}")
-        transformed_data = upload_crime_data_to_gcs(raw_data, city, time_range, config.GCS_BUCKET_NAME)
-        logger.info(f"Successfully uploaded all crime data to GCS for {city}")
-        
-        # upload coordinate crime data to GCS
-        logger.info(f"Uploading coordinate crime data to GCS for {city}")
-        upload_coordinate_crime_data_to_gcs(transformed_data, city, time_range, config.GCS_BUCKET_NAME)
-        logger.info(f"Successfully uploaded coordinate crime data to GCS for {city}")
-        
+
+        # run the ingestion as a background job (shared with identical in-flight requests) and wait for it,
+        # shielded so a disconnecting client doesn't cancel a job other requests may be waiting on
+        job, _ = ingest_job_queue.submit(city, time_range, request.output_format, request.mode)
+        await asyncio.shield(asyncio.wrap_future(job.future))
+
         success_message = f"Crime data for {city} loaded successfully"
         logger.info(success_message)
         return UpLoadCrimeDataResponse(message=success_message)
+    except BackendSaturatedError:
+        raise
     except Exception as e:
         error_message = f"Error uploading crime data for {city}: {str(e)}"
         logger.error(error_message)
-        raise HTTPException(status_code=500, detail=error_message)
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=error_message)
+
+@router.post("/jobs", response_model=IngestJobResponse, status_code=202)
+async def create_upload_crime_data_job(request: UpLoadCrimeDataRequest) -> IngestJobResponse:
+    '''
+    Enqueue the upload and return right away, poll GET /jobs/{job_id} for its progress.
+    An identical queued or running job is returned instead of starting a new one.
+    '''
+    job, coalesced = ingest_job_queue.submit(request.city.value, request.time_range.value, request.output_format, request.mode)
+    return IngestJobResponse(**job.to_dict(), coalesced=coalesced)
+
+@router.get("/jobs/{job_id}", response_model=IngestJobResponse)
+async def get_upload_crime_data_job(job_id: str) -> IngestJobResponse:
+    job = ingest_job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return IngestJobResponse(**job.to_dict())
+
+@router.post("/batch", response_model=UpLoadCrimeDataBatchResponse, status_code=202)
+async def upload_crime_data_batch(request: UpLoadCrimeDataBatchRequest) -> UpLoadCrimeDataBatchResponse:
+    '''
+    Enqueue the ingestion of several city/time_range pairs at once and return their jobs right away,
+    poll GET /jobs/{job_id} for their progress. The items run concurrently on the job workers, with
+    the number of in-flight requests capped per city portal host. An item identical to another item
+    or to a queued or running job is coalesced into that job, so a batch rejected with 503 part way
+    can be retried as is.
+    '''
+    logger.info(f"Received batch request to upload crime data for {len(request.items)} items")
+    jobs = []
+    for item in request.items:
+        job, coalesced = ingest_job_queue.submit(item.city.value, item.time_range.value, item.output_format, item.mode)
+        jobs.append(IngestJobResponse(**job.to_dict(), coalesced=coalesced))
+    logger.info(f"Batch upload enqueued {len(jobs)} jobs, {sum(job.coalesced for job in jobs)} coalesced into existing jobs")
+    return UpLoadCrimeDataBatchResponse(jobs=jobs)
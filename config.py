@@ -3,7 +3,7 @@ from dotenv import load_dotenv
 from pydantic import BaseModel, Field, validator
 from typing import Optional
 from util.logger import logger
-from constants import Environment, EnvironmentVariable
+from constants import Environment, EnvironmentVariable, AnalysisEngineName, DEFAULT_GCS_UPLOAD_CHUNK_SIZE, GCS_CHUNK_SIZE_MULTIPLE, DEFAULT_INGEST_JOB_WORKERS, DEFAULT_SOCRATA_PAGE_CACHE_MAX_BYTES, DEFAULT_SOCRATA_PAGE_CACHE_TTL_SECONDS, DEFAULT_INGEST_MEMORY_BUDGET_BYTES
 
 # Load environment variables from .env file
 load_dotenv()
@@ -17,6 +17,23 @@ class ConfigModel(BaseModel):
     GCS_BUCKET_NAME: str
     GOOGLE_CREDENTIALS_FILE: Optional[str] = None
     GOOGLE_CREDENTIALS_FILE_LOCAL: Optional[str] = None
+    GCS_UPLOAD_CHUNK_SIZE: int = DEFAULT_GCS_UPLOAD_CHUNK_SIZE
+    # When set, buckets are stood in by directories under this path (offline runs)
+    LOCAL_STORAGE_DIR: Optional[str] = None
+    # Backend executing the analysis queries when no pre-aggregated summary exists
+    ANALYSIS_ENGINE: AnalysisEngineName = AnalysisEngineName.BIGQUERY
+    # Background workers running the ingestion jobs
+    INGEST_JOB_WORKERS: int = Field(default=DEFAULT_INGEST_JOB_WORKERS, gt=0)
+    # When set, raw Socrata pages are cached under this path and re-fetches are served from it
+    SOCRATA_PAGE_CACHE_DIR: Optional[str] = None
+    SOCRATA_PAGE_CACHE_MAX_BYTES: int = Field(default=DEFAULT_SOCRATA_PAGE_CACHE_MAX_BYTES, gt=0)
+    SOCRATA_PAGE_CACHE_TTL_SECONDS: int = Field(default=DEFAULT_SOCRATA_PAGE_CACHE_TTL_SECONDS, ge=0)
+    # Processes transforming the raw records of large ingestions, 1 transforms in-process
+    TRANSFORM_WORKERS: int = Field(default_factory=lambda: os.cpu_count() or 1, gt=0)
+    # Peak memory of the records held by the ingestions, split between the job workers
+    INGEST_MEMORY_BUDGET_BYTES: int = Field(default=DEFAULT_INGEST_MEMORY_BUDGET_BYTES, gt=0)
+    # Directory of the temporary files the ingestions spill to (e.g. a mounted disk), the system one by default
+    INGEST_SPILL_DIR: Optional[str] = None
 
     @validator('GOOGLE_CREDENTIALS_FILE', always=True)
     def validate_google_credentials(cls, v, values):
@@ -26,6 +43,12 @@ class ConfigModel(BaseModel):
                 raise ValueError(f"GOOGLE_CREDENTIALS_FILE is required for {env} environment")
         return v
 
+    @validator('GCS_UPLOAD_CHUNK_SIZE')
+    def validate_gcs_upload_chunk_size(cls, v):
+        if v <= 0 or v % GCS_CHUNK_SIZE_MULTIPLE != 0:
+            raise ValueError(f"GCS_UPLOAD_CHUNK_SIZE must be a positive multiple of {GCS_CHUNK_SIZE_MULTIPLE} bytes")
+        return v
+
     class Config:
         use_enum_values = True
 
@@ -47,6 +70,21 @@ class Config:
         elif ENVIRONMENT in [Environment.DOCKER, Environment.REPLIT]:
             env_vars['GOOGLE_CREDENTIALS_FILE'] = os.getenv(EnvironmentVariable.GOOGLE_CREDENTIALS_FILE.value)
 
+        # Optional variables fall back to the ConfigModel defaults when not set
+        optional_vars = {
+            'GCS_UPLOAD_CHUNK_SIZE': os.getenv(EnvironmentVariable.GCS_UPLOAD_CHUNK_SIZE.value),
+            'LOCAL_STORAGE_DIR': os.getenv(EnvironmentVariable.LOCAL_STORAGE_DIR.value),
+            'ANALYSIS_ENGINE': os.getenv(EnvironmentVariable.ANALYSIS_ENGINE.value),
+            'INGEST_JOB_WORKERS': os.getenv(EnvironmentVariable.INGEST_JOB_WORKERS.value),
+            'SOCRATA_PAGE_CACHE_DIR': os.getenv(EnvironmentVariable.SOCRATA_PAGE_CACHE_DIR.value),
+            'SOCRATA_PAGE_CACHE_MAX_BYTES': os.getenv(EnvironmentVariable.SOCRATA_PAGE_CACHE_MAX_BYTES.value),
+            'SOCRATA_PAGE_CACHE_TTL_SECONDS': os.getenv(EnvironmentVariable.SOCRATA_PAGE_CACHE_TTL_SECONDS.value),
+            'TRANSFORM_WORKERS': os.getenv(EnvironmentVariable.TRANSFORM_WORKERS.value),
+            'INGEST_MEMORY_BUDGET_BYTES': os.getenv(EnvironmentVariable.INGEST_MEMORY_BUDGET_BYTES.value),
+            'INGEST_SPILL_DIR': os.getenv(EnvironmentVariable.INGEST_SPILL_DIR.value),
+        }
+        env_vars.update({key: value for key, value in optional_vars.items() if value is not None})
+
         self.config_model = ConfigModel(**env_vars)
         
     def validate_config(self):
@@ -1,5 +1,5 @@
 from enum import Enum
-from models.crime_data_models import CityDataset, CityDatasets
+from models.crime_data_models import CITIES, CityDataset, CityDatasets
 
 class Environment(Enum):
     LOCAL = "local"
@@ -14,36 +14,140 @@ class EnvironmentVariable(Enum):
     GCS_BUCKET_NAME = "GCS_BUCKET_NAME"
     GOOGLE_CREDENTIALS_FILE = "GOOGLE_CREDENTIALS_FILE"
     GOOGLE_CREDENTIALS_FILE_LOCAL = "GOOGLE_CREDENTIALS_FILE_LOCAL"
+    GCS_UPLOAD_CHUNK_SIZE = "GCS_UPLOAD_CHUNK_SIZE"
+    LOCAL_STORAGE_DIR = "LOCAL_STORAGE_DIR"
+    ANALYSIS_ENGINE = "ANALYSIS_ENGINE"
+    INGEST_JOB_WORKERS = "INGEST_JOB_WORKERS"
+    SOCRATA_PAGE_CACHE_DIR = "SOCRATA_PAGE_CACHE_DIR"
+    TRANSFORM_WORKERS = "TRANSFORM_WORKERS"
+    INGEST_MEMORY_BUDGET_BYTES = "INGEST_MEMORY_BUDGET_BYTES"
+    INGEST_SPILL_DIR = "INGEST_SPILL_DIR"
+    SOCRATA_PAGE_CACHE_MAX_BYTES = "SOCRATA_PAGE_CACHE_MAX_BYTES"
+    SOCRATA_PAGE_CACHE_TTL_SECONDS = "SOCRATA_PAGE_CACHE_TTL_SECONDS"
+
+class AnalysisEngineName(Enum):
+    BIGQUERY = "bigquery"
+    SQLITE = "sqlite"
 
 DATA_LIMIT = 10000
 
+# Ingestions of at least this many pages of DATA_LIMIT records are transformed on the
+# TRANSFORM_WORKERS process pool, smaller ones in-process
+PARALLEL_TRANSFORM_MIN_PAGES = 2
+# Pages sent to the transform pool are cut smaller than DATA_LIMIT records when 2 pages per worker don't fit
+# in the memory budget, down to this many records (below that the worker round trips would dominate)
+MIN_TRANSFORM_PAGE_RECORDS = 1000
+
+# Memory an ingestion may use for the records it holds (buffered raw pages, pages in flight on the
+# transform pool, Parquet row buffers), on top of the app itself. Sizes are estimated per record
+DEFAULT_INGEST_MEMORY_BUDGET_BYTES = 128 * 1024 ** 2
+ESTIMATED_RECORD_BYTES = 1024
+# Raw records a job fetches ahead of their transform beyond its memory budget are spilled up to this many
+# bytes when INGEST_SPILL_DIR is set, the fetch waits for the transform otherwise
+PREFETCH_SPILL_MAX_BYTES = 1024 ** 3
+
+# Socrata request timeout, and in-flight requests per city portal host shared by the concurrent ingestion jobs
+SOCRATA_REQUEST_TIMEOUT_SECONDS = 120
+MAX_CONCURRENT_REQUESTS_PER_HOST = 2
+# Socrata responses are read and JSON decoded in chunks of this many bytes as they arrive
+SOCRATA_STREAM_CHUNK_BYTES = 64 * 1024
+
+# Raw Socrata pages cached on disk (when SOCRATA_PAGE_CACHE_DIR is set), gzip compressed
+DEFAULT_SOCRATA_PAGE_CACHE_MAX_BYTES = 2 * 1024 ** 3
+DEFAULT_SOCRATA_PAGE_CACHE_TTL_SECONDS = 6 * 60 * 60
+SOCRATA_PAGE_CACHE_COMPRESS_LEVEL = 6
+
+# GCS resumable uploads are sent in chunks, the chunk size must be a multiple of 256 KiB
+GCS_CHUNK_SIZE_MULTIPLE = 256 * 1024
+DEFAULT_GCS_UPLOAD_CHUNK_SIZE = 40 * GCS_CHUNK_SIZE_MULTIPLE
+
+# Parquet output buffers rows per incident date partition, once the buffered rows take this many
+# bytes (estimated) in total the largest partitions are spilled to a temporary file
+PARQUET_BUFFER_BYTES = 64 * 1024 ** 2
+# Rows per row group of the Parquet partition files (the last one of a file is smaller), also the rows held
+# in memory while a partition file is written
+PARQUET_ROW_GROUP_ROWS = 10000
+
+# Analysis results are cached per (city, time_range, query kind), uploads invalidate them
+ANALYSIS_CACHE_TTL_SECONDS = 60 * 60
+ANALYSIS_CACHE_MAX_SIZE = 256
+# and by their total size (estimated), a coordinate analysis result can hold millions of rows
+ANALYSIS_CACHE_MAX_BYTES = 256 * 1024 ** 2
+# Encoded coordinate pages are cached apart, bounded by their total size as well
+ENCODED_COORDINATE_CACHE_MAX_BYTES = 64 * 1024 ** 2
+
+# Blocking backend calls of the route handlers run in one bounded pool per backend:
+# (max running calls, max queued calls), calls beyond that are rejected with a 503
+BACKEND_EXECUTOR_LIMITS = {
+    "analysis": (16, 64),
+}
+BACKEND_SATURATED_RETRY_AFTER_SECONDS = 5
+
+# Ingestion jobs (fetch from Socrata, transform, upload) run on INGEST_JOB_WORKERS background workers,
+# at most INGEST_JOB_MAX_QUEUED more jobs wait for a worker. One worker per city by default, so a batch
+# over every city runs all at once and takes as long as its slowest city
+DEFAULT_INGEST_JOB_WORKERS = len(CITIES)
+INGEST_JOB_MAX_QUEUED = 16
+# Finished jobs kept for the status endpoint
+INGEST_JOB_HISTORY_SIZE = 200
+
+# Delta ingestion re-fetches the incident dates from this many days before the watermark up to today,
+# so records published late for those days are picked up, and replaces their partitions
+INGEST_DELTA_LOOKBACK_DAYS = 3
+
+# Coordinates are also binned into geohash cells at every precision in this range,
+# from ~156km (3) down to ~153m (7) cells
+GEOHASH_MIN_PRECISION = 3
+GEOHASH_MAX_PRECISION = 7
+
+# Cell size of the in-memory spatial index, ~110m of latitude
+SPATIAL_INDEX_CELL_DEGREES = 0.001
+# Limits of the spatial queries
+MAX_SPATIAL_QUERY_RADIUS_METERS = 5000
+MAX_SPATIAL_QUERY_COORDINATES = 10000
+
+# Streamed coordinate responses are serialized and sent this many rows at a time
+COORDINATE_STREAM_BATCH_ROWS = 1000
+MAX_COORDINATE_PAGE_SIZE = 50000
+# Fixed-point precision of the delta encoded coordinates, 10^-6 degrees is ~0.1m
+COORDINATE_DELTA_DECIMALS = 6
+
+# BigQuery tables loaded from the uploaded files, used when no pre-aggregated summary exists
+BIGQUERY_PROJECT = "safe-city-walk"
+BIGQUERY_CITY_CRIME_DATASET = "city_crime_data"
+BIGQUERY_COORDINATE_CRIME_DATASET = "coordinate_crime_data"
+
 CITY_DATASETS: CityDatasets = CityDatasets(
     newYork=CityDataset(
         endpoint="data.cityofnewyork.us",
         identifier="5uac-w243",
         datasetUrl="https://data.cityofnewyork.us/Public-Safety/NYPD-Complaint-Data-Current-Year-To-Date-/5uac-w243",
         apiEndpoint="https://data.cityofnewyork.us/resource/5uac-w243.json",
-        query="$where=cmplnt_fr_dt >= '{start_date}T00:00:00' AND cmplnt_fr_dt <= '{end_date}T23:59:59'"
+        query="$where=cmplnt_fr_dt >= '{start_date}T00:00:00' AND cmplnt_fr_dt <= '{end_date}T23:59:59'",
+        dateField="cmplnt_fr_dt"
     ),
     seattle=CityDataset(
         endpoint="data.seattle.gov",
         identifier="tazs-3rd5",
         datasetUrl="https://data.seattle.gov/Public-Safety/SPD-Crime-Data-2008-Present/tazs-3rd5",
         apiEndpoint="https://data.seattle.gov/resource/tazs-3rd5.json",
-        query="$where=offense_start_datetime >= '{start_date}T00:00:00' AND offense_start_datetime <= '{end_date}T23:59:59'"
+        query="$where=offense_start_datetime >= '{start_date}T00:00:00' AND offense_start_datetime <= '{end_date}T23:59:59'",
+        dateField="offense_start_datetime"
     ),
     losAngeles=CityDataset(
         endpoint="data.lacity.org",
         identifier="2nrs-mtv8",
         datasetUrl="https://data.lacity.org/Public-Safety/Crime-Data-from-2020-to-Present/2nrs-mtv8",
         apiEndpoint="https://data.lacity.org/resource/2nrs-mtv8.json",
-        query="$where=date_occ >= '{start_date}T00:00:00' AND date_occ <= '{end_date}T23:59:59'"
+        query="$where=date_occ >= '{start_date}T00:00:00' AND date_occ <= '{end_date}T23:59:59'",
+        dateField="date_occ"
     ),
     chicago=CityDataset(
         endpoint="data.cityofchicago.org",
         identifier="ijzp-q8t2",
         datasetUrl="https://data.cityofchicago.org/Public-Safety/Crimes-2001-to-Present/ijzp-q8t2",
         apiEndpoint="https://data.cityofchicago.org/resource/ijzp-q8t2.json",
-        query="$where=date >= '{start_date}T00:00:00' AND date <= '{end_date}T23:59:59'"
+        query="$where=date >= '{start_date}T00:00:00' AND date <= '{end_date}T23:59:59'",
+        dateField="date"
     )
 )
\ No newline at end of file
@@ -1,18 +1,36 @@
 import os
 import uvicorn
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 from api.routes.upload_crime_data_route import router as load_crime_data_router
 from api.routes.crime_data_analysis_route import router as crime_data_analysis_router
 from util.logger import logger
+from util.gcp_client_util import init_gcp_clients, close_gcp_clients
+from util.executor_util import BackendSaturatedError, shutdown_backend_executors
+from util.transform_pool_util import shutdown_transform_pool
+from services.ingest_job_service import ingest_job_queue
 from constants import Environment
 app = FastAPI(title="City Crime Data API", version="1.0.0")
 
 app.include_router(load_crime_data_router)
 app.include_router(crime_data_analysis_router)
 
+@app.exception_handler(BackendSaturatedError)
+async def backend_saturated_handler(request: Request, exc: BackendSaturatedError) -> JSONResponse:
+    return JSONResponse(status_code=503, content={"detail": str(exc)}, headers={"Retry-After": str(exc.retry_after)})
+
 @app.on_event("startup")
 async def startup_event():
     logger.info("Starting the FastAPI application")
+    init_gcp_clients()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    logger.info("Shutting down the FastAPI application")
+    ingest_job_queue.shutdown()
+    shutdown_backend_executors()
+    shutdown_transform_pool()
+    close_gcp_clients()
 
 def main(): 
     port = os.getenv("PORT", 8000)
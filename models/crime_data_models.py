@@ -1,14 +1,33 @@
-from typing import Optional, Dict, Any
+from typing import ClassVar, List, Optional, Dict, Any, Sequence
 from dataclasses import dataclass, fields
+from functools import lru_cache
+from operator import attrgetter
 from enum import Enum
 import pytz
-from datetime import datetime
+from util.timestamp_util import TimestampNormalizer
 
 class TIME_RANGES(str, Enum):
     ONE_YEAR = "1year"
     SIX_MONTHS = "6months"
     THREE_MONTHS = "3months"
 
+class OUTPUT_FORMATS(str, Enum):
+    CSV = "csv"
+    CSV_GZIP = "csv.gz"
+    PARQUET = "parquet"
+
+class INGEST_MODES(str, Enum):
+    FULL = "full"
+    DELTA = "delta"
+    MULTI_RANGE = "multi_range"
+    SUMMARY = "summary"
+
+class COORDINATE_RESPONSE_FORMATS(str, Enum):
+    JSON = "json"
+    NDJSON = "ndjson"
+    DELTA = "delta"
+    PACKED = "packed"
+
 class CITIES(str, Enum):
     NEW_YORK = "newYork"
     LOS_ANGELES = "losAngeles"
@@ -22,8 +41,11 @@ class CityDataset:
     datasetUrl: str
     apiEndpoint: str
     query: str
+    # Incident date column the query filters on, also the watermark of incremental ingestion
+    dateField: str
     
-@dataclass
+# Slotted: one instance per ingested record, no per-instance __dict__
+@dataclass(slots=True)
 class UnifiedCrimeData:
     report_number: str
     incident_datetime: str
@@ -37,9 +59,62 @@ class UnifiedCrimeData:
     latitude: str
 
 UnifiedCrimeDataFieldNames = [field.name for field in fields(UnifiedCrimeData)]
+# Field values of a UnifiedCrimeData in UnifiedCrimeDataFieldNames order, without building a dict
+unified_crime_data_values = attrgetter(*UnifiedCrimeDataFieldNames)
+UnifiedCrimeDataDatetimeFieldNames = ["incident_datetime", "reported_datetime"]
 
 class CITY_DATA_MODELS:
-    pass
+    # Source column of every UnifiedCrimeData field, None when the city has no such column
+    UNIFIED_FIELD_SOURCES: ClassVar[Dict[str, Optional[str]]] = {}
+    TIMEZONE: ClassVar[Any] = None
+
+    def transform(self) -> UnifiedCrimeData:
+        return compile_unified_transform(type(self))(vars(self))
+
+    @classmethod
+    def get_source_columns(cls) -> List[str]:
+        '''
+        Source columns read by the transform, the only ones requested from Socrata ($select).
+        '''
+        return sorted({column for column in cls.UNIFIED_FIELD_SOURCES.values() if column})
+
+class UnifiedTransformPlan:
+    '''
+    Transform going straight from raw Socrata records to UnifiedCrimeData, built once per city model.
+    Only the source columns declared in UNIFIED_FIELD_SOURCES are read, the rest of the record
+    is never touched. Timestamps are normalized by the city TimestampNormalizer.
+    '''
+    def __init__(self, city_model: type):
+        sources = city_model.UNIFIED_FIELD_SOURCES
+        self.columns = tuple(sources[name] for name in UnifiedCrimeDataFieldNames)
+        self.datetime_positions = tuple(UnifiedCrimeDataFieldNames.index(name) for name in UnifiedCrimeDataDatetimeFieldNames)
+        self.timestamp_normalizer = TimestampNormalizer(city_model.TIMEZONE)
+
+    def __call__(self, record: Dict[str, Any]) -> UnifiedCrimeData:
+        get = record.get
+        values = [(get(column) or "") if column else "" for column in self.columns]
+        for position in self.datetime_positions:
+            values[position] = self.timestamp_normalizer.normalize(values[position])
+        return UnifiedCrimeData(*values)
+
+    def transform_page_values(self, records: Sequence[Dict[str, Any]]) -> List[List[Any]]:
+        '''
+        Field values of the UnifiedCrimeData of a page of records, timestamps are normalized column-wise for the whole page.
+        '''
+        columns = self.columns
+        rows = [[(record.get(column) or "") if column else "" for column in columns] for record in records]
+        for position in self.datetime_positions:
+            normalized = self.timestamp_normalizer.normalize_many([row[position] for row in rows])
+            for row, value in zip(rows, normalized):
+                row[position] = value
+        return rows
+
+    def transform_page(self, records: Sequence[Dict[str, Any]]) -> List[UnifiedCrimeData]:
+        return [UnifiedCrimeData(*row) for row in self.transform_page_values(records)]
+
+@lru_cache(maxsize=None)
+def compile_unified_transform(city_model: type) -> UnifiedTransformPlan:
+    return UnifiedTransformPlan(city_model)
 
 def flexible_dataclass(cls):
     def __init(self, **kwargs):
@@ -92,23 +167,19 @@ class NewYorkCrimeData(CITY_DATA_MODELS):
     lat_lon: Dict[str, str] = None
     geocoded_column: Dict[str, Any] = None
 
-    def transform(self) -> UnifiedCrimeData:
-        incident_dt = datetime.strptime(f"{self.cmplnt_fr_dt or ''}".strip(), "%Y-%m-%dT%H:%M:%S.%f").astimezone(NYC_TIMEZONE)
-        reported_dt = datetime.strptime(self.rpt_dt or "", "%Y-%m-%dT%H:%M:%S.%f").astimezone(NYC_TIMEZONE)
-        
-        return UnifiedCrimeData(
-            report_number=self.cmplnt_num or "",
-            incident_datetime=incident_dt,
-            reported_datetime=reported_dt,
-            offense_type=self.law_cat_cd or "",
-            offense_description=self.ofns_desc or "",
-            victim_age=self.vic_age_group or "",
-            victim_sex=self.vic_sex or "",
-            location_description=self.loc_of_occur_desc or "",
-            longitude=self.longitude or "",
-            latitude=self.latitude or ""
-        )
-    pass
+    TIMEZONE = NYC_TIMEZONE
+    UNIFIED_FIELD_SOURCES = {
+        "report_number": "cmplnt_num",
+        "incident_datetime": "cmplnt_fr_dt",
+        "reported_datetime": "rpt_dt",
+        "offense_type": "law_cat_cd",
+        "offense_description": "ofns_desc",
+        "victim_age": "vic_age_group",
+        "victim_sex": "vic_sex",
+        "location_description": "loc_of_occur_desc",
+        "longitude": "longitude",
+        "latitude": "latitude",
+    }
 
 @flexible_dataclass
 class LosAngelesCrimeData(CITY_DATA_MODELS):
@@ -141,23 +212,19 @@ class LosAngelesCrimeData(CITY_DATA_MODELS):
     lat: str = ""
     lon: str = ""
 
-    def transform(self) -> UnifiedCrimeData:
-        incident_dt = datetime.strptime(f"{self.date_occ or ''}".strip(), "%Y-%m-%dT%H:%M:%S.%f").astimezone(LA_TIMEZONE)
-        reported_dt = datetime.strptime(self.date_rptd or "", "%Y-%m-%dT%H:%M:%S.%f").astimezone(LA_TIMEZONE)
-
-        return UnifiedCrimeData(
-            report_number=self.dr_no or "",
-            incident_datetime=incident_dt,
-            reported_datetime=reported_dt,
-            offense_type=self.crm_cd_desc or "",
-            offense_description=self.crm_cd_desc or "",
-            victim_age=self.vict_age or "",
-            victim_sex=self.vict_sex or "",
-            location_description=self.premis_desc or "",
-            longitude=self.lon or "",
-            latitude=self.lat or ""
-        )
-    pass
+    TIMEZONE = LA_TIMEZONE
+    UNIFIED_FIELD_SOURCES = {
+        "report_number": "dr_no",
+        "incident_datetime": "date_occ",
+        "reported_datetime": "date_rptd",
+        "offense_type": "crm_cd_desc",
+        "offense_description": "crm_cd_desc",
+        "victim_age": "vict_age",
+        "victim_sex": "vict_sex",
+        "location_description": "premis_desc",
+        "longitude": "lon",
+        "latitude": "lat",
+    }
 
 @flexible_dataclass
 class SeattleCrimeData(CITY_DATA_MODELS):
@@ -178,23 +245,19 @@ class SeattleCrimeData(CITY_DATA_MODELS):
     longitude: str = ""
     latitude: str = ""
 
-    def transform(self) -> UnifiedCrimeData:
-        incident_dt = datetime.strptime(self.offense_start_datetime or "", "%Y-%m-%dT%H:%M:%S.%f").astimezone(SEATTLE_TIMEZONE)
-        reported_dt = datetime.strptime(self.report_datetime or "", "%Y-%m-%dT%H:%M:%S.%f").astimezone(SEATTLE_TIMEZONE)
-
-        return UnifiedCrimeData(
-            report_number=self.report_number or "",
-            incident_datetime=incident_dt,
-            reported_datetime=reported_dt,
-            offense_type=self.offense_parent_group or "",
-            offense_description=self.offense or "",
-            victim_age="",
-            victim_sex="",
-            location_description=self._100_block_address or "",
-            longitude=self.longitude or "",
-            latitude=self.latitude or ""
-        )
-    pass
+    TIMEZONE = SEATTLE_TIMEZONE
+    UNIFIED_FIELD_SOURCES = {
+        "report_number": "report_number",
+        "incident_datetime": "offense_start_datetime",
+        "reported_datetime": "report_datetime",
+        "offense_type": "offense_parent_group",
+        "offense_description": "offense",
+        "victim_age": None,
+        "victim_sex": None,
+        "location_description": "_100_block_address",
+        "longitude": "longitude",
+        "latitude": "latitude",
+    }
 
 @flexible_dataclass
 class ChicagoCrimeData(CITY_DATA_MODELS):
@@ -221,23 +284,19 @@ class ChicagoCrimeData(CITY_DATA_MODELS):
     longitude: str = ""
     location: Dict[str, str] = None
 
-    def transform(self) -> UnifiedCrimeData:
-        incident_dt = datetime.strptime(self.date or "", "%Y-%m-%dT%H:%M:%S.%f").astimezone(CHICAGO_TIMEZONE)
-        reported_dt = datetime.strptime(self.updated_on or "", "%Y-%m-%dT%H:%M:%S.%f").astimezone(CHICAGO_TIMEZONE)
-
-        return UnifiedCrimeData(
-            report_number=self.case_number or "",
-            incident_datetime=incident_dt,
-            reported_datetime=reported_dt,
-            offense_type=self.primary_type or "",
-            offense_description=self.description or "",
-            victim_age="",
-            victim_sex="",
-            location_description=self.location_description or "",
-            longitude=self.longitude or "",
-            latitude=self.latitude or ""
-        )
-    pass
+    TIMEZONE = CHICAGO_TIMEZONE
+    UNIFIED_FIELD_SOURCES = {
+        "report_number": "case_number",
+        "incident_datetime": "date",
+        "reported_datetime": "updated_on",
+        "offense_type": "primary_type",
+        "offense_description": "description",
+        "victim_age": None,
+        "victim_sex": None,
+        "location_description": "location_description",
+        "longitude": "longitude",
+        "latitude": "latitude",
+    }
 
 @dataclass
 class CityDatasets:
@@ -0,0 +1,119 @@
+'''
+Benchmark of the incremental decoder of the Socrata pages (util.streaming_util.iter_json_array) against
+decoding the whole body at once like `response.json()`, reports the time and peak memory of each path.
+
+The body is generated in SOCRATA_STREAM_CHUNK_BYTES chunks as it would arrive from the portal. The whole
+body path joins the chunks (`response.content`) and decodes the text, the incremental path decodes the
+chunks as they come. Every record is consumed and dropped right away, like the ingestion does.
+
+Run from the repository root: python scripts/bench_stream_decode.py [--records N] [--repeat N]
+'''
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Iterable, Iterator
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from constants import DATA_LIMIT, SOCRATA_STREAM_CHUNK_BYTES
+from util.streaming_util import iter_json_array
+
+def make_record(number: int) -> dict:
+    # a raw New York record with the columns the portal returns most often
+    return {
+        "cmplnt_num": str(100000000 + number),
+        "cmplnt_fr_dt": f"2026-02-{number % 28 + 1:02d}T00:00:00.000",
+        "cmplnt_fr_tm": f"{number % 24:02d}:30:00",
+        "rpt_dt": f"2026-02-{number % 28 + 1:02d}T00:00:00.000",
+        "addr_pct_cd": str(number % 120),
+        "boro_nm": "BROOKLYN",
+        "law_cat_cd": "MISDEMEANOR",
+        "ofns_desc": "PETIT LARCENY",
+        "pd_desc": "LARCENY,PETIT FROM STORE-SHOPL",
+        "prem_typ_desc": "CHAIN STORE",
+        "loc_of_occur_desc": "INSIDE",
+        "susp_age_group": "25-44",
+        "susp_race": "BLACK",
+        "susp_sex": "M",
+        "vic_age_group": "UNKNOWN",
+        "vic_race": "UNKNOWN",
+        "vic_sex": "D",
+        "latitude": f"40.{600000 + number % 300000}",
+        "longitude": f"-73.{900000 + number % 99999}",
+        "lat_lon": {"latitude": f"40.{600000 + number % 300000}", "longitude": f"-73.{900000 + number % 99999}"},
+    }
+
+def iter_page_chunks(record_count: int, chunk_size: int = SOCRATA_STREAM_CHUNK_BYTES) -> Iterator[bytes]:
+    '''
+    The JSON array of `record_count` records in chunks of about `chunk_size` bytes, generated lazily.
+    '''
+    pending = bytearray(b"[")
+    for number in range(record_count):
+        if number:
+            pending += b",\n"
+        pending += json.dumps(make_record(number)).encode("utf-8")
+        if len(pending) >= chunk_size:
+            yield bytes(pending)
+            pending.clear()
+    pending += b"]"
+    yield bytes(pending)
+
+def decode_whole_body(chunks: Iterable[bytes]) -> Iterator[Any]:
+    # what `response.json()` does: buffer the whole body, then decode it in one go
+    body = b"".join(chunks)
+    return iter(json.loads(body.decode("utf-8")))
+
+def decode_incrementally(chunks: Iterable[bytes]) -> Iterator[Any]:
+    return iter_json_array(chunks)
+
+def consume(records: Iterator[Any]) -> int:
+    return sum(1 for _ in records)
+
+def measure_seconds(decode: Callable[[Iterable[bytes]], Iterator[Any]], chunks: list, repeat: int) -> float:
+    '''
+    Best time of `repeat` runs over pre-built chunks, so only the decoding is timed.
+    '''
+    timings = []
+    for _ in range(repeat):
+        gc.collect()
+        started = time.perf_counter()
+        consume(decode(chunks))
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+def measure_peak_bytes(decode: Callable[[Iterable[bytes]], Iterator[Any]], record_count: int) -> int:
+    '''
+    Peak traced memory while decoding a lazily generated body, counting the body as it arrives.
+    '''
+    gc.collect()
+    tracemalloc.start()
+    try:
+        baseline, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        consume(decode(iter_page_chunks(record_count)))
+        return tracemalloc.get_traced_memory()[1] - baseline
+    finally:
+        tracemalloc.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--records", type=int, default=5 * DATA_LIMIT, help="records in the page")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per path, the best one is reported")
+    args = parser.parse_args()
+
+    chunks = list(iter_page_chunks(args.records))
+    body_bytes = sum(len(chunk) for chunk in chunks)
+    assert consume(decode_whole_body(chunks)) == consume(decode_incrementally(chunks)) == args.records
+    print(f"{args.records} records, {body_bytes / 1024 ** 2:.1f} MiB body in {len(chunks)} chunks")
+
+    for name, decode in (("response.json()", decode_whole_body), ("iter_json_array", decode_incrementally)):
+        seconds = measure_seconds(decode, chunks, args.repeat)
+        peak_bytes = measure_peak_bytes(decode, args.records)
+        print(f"{name:>16}: {seconds:.3f} s ({args.records / seconds:,.0f} records/s), peak {peak_bytes / 1024 ** 2:.1f} MiB")
+
+if __name__ == "__main__":
+    main()
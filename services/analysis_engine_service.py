@@ -0,0 +1,238 @@
+import csv
+import gzip
+import io
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+from google.cloud import bigquery
+from config import config
+from constants import AnalysisEngineName, BIGQUERY_PROJECT, BIGQUERY_CITY_CRIME_DATASET, BIGQUERY_COORDINATE_CRIME_DATASET
+from models.crime_data_models import OUTPUT_FORMATS, UnifiedCrimeDataFieldNames
+from services.upload_crime_data_service import get_crime_data_file_name, get_crime_data_partition_prefix, pa, pq
+from util.gcp_client_util import get_bigquery_client
+from util.gcs_util import list_gcs_blobs, read_from_gcs
+from util.logger import logger
+
+class AnalysisEngine(ABC):
+      '''
+      Backend executing the analysis queries of a city/time_range.
+      '''
+      @abstractmethod
+      def analyze_crime_data(self, city: str, time_range: str) -> dict[str, Any]:
+            '''
+            Offense type counts and percentages: {"total_crimes": int, "crime_statistics": [{"crime_type", "count", "percentage"}]}
+            '''
+
+      @abstractmethod
+      def analyze_coordinate_crime_data(self, city: str, time_range: str) -> list[dict]:
+            '''
+            Crime counts per coordinate: [{"coordinate", "crime_count"}] by crime_count DESC
+            '''
+
+      def invalidate(self, city: str, time_range: str):
+            '''
+            Called when new data was uploaded for the city/time_range.
+            '''
+
+class BigQueryAnalysisEngine(AnalysisEngine):
+      '''
+      Runs the analysis as BigQuery jobs over the tables loaded from the uploaded files.
+      '''
+      def read_data_from_bigquery(self, query: str, process_data: Callable[[bigquery.table.RowIterator], Any]) -> Any:
+            client = get_bigquery_client()
+            query_job = client.query(query)
+            result = query_job.result()
+            return process_data(result)
+
+      def get_crime_data_table(self, city: str, time_range: str) -> str:
+            return f"`{BIGQUERY_PROJECT}.{BIGQUERY_CITY_CRIME_DATASET}.{city.lower()}_city_crime_data_{time_range.lower()}`"
+
+      def get_coordinate_crime_data_table(self, city: str, time_range: str) -> str:
+            return f"`{BIGQUERY_PROJECT}.{BIGQUERY_COORDINATE_CRIME_DATASET}.{city.lower()}_coordiante_crime_data_{time_range.lower()}`"
+
+      def analyze_crime_data(self, city: str, time_range: str) -> dict[str, Any]:
+            query = f"""
+            SELECT
+                  offense_type,
+                  COUNT(*) as count,
+                  ROUND(COUNT(*) * 100.0 / SUM(COUNT(*)) OVER(), 2) as percentage
+            FROM
+                  {self.get_crime_data_table(city, time_range)}
+            GROUP BY
+                  offense_type
+            ORDER BY
+                  count DESC
+            """
+            return self.read_data_from_bigquery(query, process_all_crime_data)
+
+      def analyze_coordinate_crime_data(self, city: str, time_range: str) -> list[dict]:
+            query = f"""
+            SELECT
+                  coordinate,
+                  SUM(crime_count) as crime_count
+            FROM
+                  {self.get_coordinate_crime_data_table(city, time_range)}
+            GROUP BY
+                  coordinate
+            ORDER BY
+                  crime_count DESC
+            """
+            return self.read_data_from_bigquery(query, process_coordinate_crime_data)
+
+class SQLiteAnalysisEngine(AnalysisEngine):
+      '''
+      Embedded backend: the crime data file written by the upload services (CSV, gzip CSV or
+      Parquet partitions) is loaded once into an in-memory SQLite database per city/time_range,
+      then every analysis is a local query. Works fully offline together with LOCAL_STORAGE_DIR.
+      '''
+      def __init__(self, bucket_name: str):
+            self.bucket_name = bucket_name
+            self._databases: Dict[Tuple[str, str], sqlite3.Connection] = {}
+            self._database_locks: Dict[Tuple[str, str], threading.Lock] = {}
+            self._lock = threading.Lock()
+
+      def iter_crime_data_rows(self, city: str, time_range: str) -> Iterator[Tuple]:
+            for output_format in (OUTPUT_FORMATS.CSV, OUTPUT_FORMATS.CSV_GZIP):
+                  data = read_from_gcs(self.bucket_name, get_crime_data_file_name(city, time_range, output_format))
+                  if data is None:
+                        continue
+                  if output_format == OUTPUT_FORMATS.CSV_GZIP:
+                        data = gzip.decompress(data)
+                  reader = csv.reader(io.StringIO(data.decode("utf-8"), newline=""))
+                  next(reader, None)
+                  yield from reader
+                  return
+
+            part_names = [name for name in list_gcs_blobs(self.bucket_name, get_crime_data_partition_prefix(city, time_range)) if name.endswith(".parquet")]
+            if part_names and pq is not None:
+                  for part_name in part_names:
+                        table = pq.read_table(pa.BufferReader(read_from_gcs(self.bucket_name, part_name)))
+                        # coordinates are typed in Parquet, rendered as str() like the raw values of the CSV summaries
+                        columns = [
+                              [None if value is None else str(value) for value in table.column(name).to_pylist()] if name in ("latitude", "longitude") else table.column(name).to_pylist()
+                              for name in UnifiedCrimeDataFieldNames
+                        ]
+                        yield from zip(*columns)
+                  return
+
+            raise ValueError(f"No crime data file found for {city} with time range: {time_range}")
+
+      def load_database(self, city: str, time_range: str) -> sqlite3.Connection:
+            logger.info(f"Loading crime data for {city}-{time_range} into SQLite")
+            database = sqlite3.connect(":memory:", check_same_thread=False)
+            columns = ", ".join(f"{name} TEXT" for name in UnifiedCrimeDataFieldNames)
+            placeholders = ", ".join("?" for _ in UnifiedCrimeDataFieldNames)
+            database.execute(f"CREATE TABLE crime_data ({columns})")
+            database.executemany(f"INSERT INTO crime_data VALUES ({placeholders})", self.iter_crime_data_rows(city, time_range))
+            database.commit()
+            row_count = database.execute("SELECT COUNT(*) FROM crime_data").fetchone()[0]
+            logger.info(f"Loaded {row_count} rows of crime data for {city}-{time_range} into SQLite")
+            return database
+
+      def query(self, city: str, time_range: str, query: str) -> list[sqlite3.Row]:
+            key = (city, time_range)
+            with self._lock:
+                  database_lock = self._database_locks.setdefault(key, threading.Lock())
+            # sqlite3 connections are not safe for concurrent use, one query at a time per database
+            with database_lock:
+                  database = self._databases.get(key)
+                  if database is None:
+                        database = self.load_database(city, time_range)
+                        database.row_factory = sqlite3.Row
+                        self._databases[key] = database
+                  return database.execute(query).fetchall()
+
+      def analyze_crime_data(self, city: str, time_range: str) -> dict[str, Any]:
+            rows = self.query(city, time_range, """
+            SELECT
+                  offense_type,
+                  COUNT(*) as count,
+                  ROUND(COUNT(*) * 100.0 / SUM(COUNT(*)) OVER(), 2) as percentage
+            FROM
+                  crime_data
+            GROUP BY
+                  offense_type
+            ORDER BY
+                  count DESC
+            """)
+            return process_all_crime_data(rows)
+
+      def analyze_coordinate_crime_data(self, city: str, time_range: str) -> list[dict]:
+            rows = self.query(city, time_range, """
+            SELECT
+                  '(''' || latitude || ''', ''' || longitude || ''')' as coordinate,
+                  COUNT(*) as crime_count
+            FROM
+                  crime_data
+            WHERE
+                  latitude IS NOT NULL AND longitude IS NOT NULL AND latitude != '' AND longitude != ''
+            GROUP BY
+                  latitude, longitude
+            ORDER BY
+                  crime_count DESC
+            """)
+            return process_coordinate_crime_data(rows)
+
+      def invalidate(self, city: str, time_range: str):
+            key = (city, time_range)
+            with self._lock:
+                  database_lock = self._database_locks.setdefault(key, threading.Lock())
+            with database_lock:
+                  database = self._databases.pop(key, None)
+                  if database is not None:
+                        database.close()
+
+def process_all_crime_data(rows) -> dict[str, Any]:
+      rows_list = list(rows)
+      if not rows_list:
+            raise ValueError("No data found in the analysis result.")
+
+      crime_statistics = []
+      for row in rows_list:
+            crime_statistics.append({
+                  "crime_type": row["offense_type"],
+                  "count": row["count"],
+                  "percentage": row["percentage"]
+            })
+
+      total_crimes = sum(row['count'] for row in rows_list)
+
+      return {
+            "total_crimes": total_crimes,
+            "crime_statistics": crime_statistics
+      }
+
+def process_coordinate_crime_data(rows) -> list:
+      rows_list = list(rows)
+      if not rows_list:
+            raise ValueError("No data found in the analysis result.")
+
+      coordinate_crime_data = []
+      for row in rows_list:
+            coordinate_crime_data.append({
+                  "coordinate": row["coordinate"],
+                  "crime_count": row["crime_count"]
+            })
+
+      return coordinate_crime_data
+
+_analysis_engine: Optional[AnalysisEngine] = None
+_analysis_engine_lock = threading.Lock()
+
+def get_analysis_engine() -> AnalysisEngine:
+      '''
+      The process-wide analysis engine selected by the ANALYSIS_ENGINE setting.
+      '''
+      global _analysis_engine
+      if _analysis_engine is None:
+            with _analysis_engine_lock:
+                  if _analysis_engine is None:
+                        engine_name = AnalysisEngineName(config.ANALYSIS_ENGINE)
+                        logger.info(f"Using the {engine_name.value} analysis engine")
+                        if engine_name == AnalysisEngineName.SQLITE:
+                              _analysis_engine = SQLiteAnalysisEngine(config.GCS_BUCKET_NAME)
+                        else:
+                              _analysis_engine = BigQueryAnalysisEngine()
+      return _analysis_engine
@@ -1,95 +1,128 @@
 # from pyspark.sql import SparkSession, DataFrame, Row
 # from pyspark.sql.functions import count, col, round
 # from pyspark.storagelevel import StorageLevel
-from config import config 
-from typing import Any, Callable
-from constants import Environment
+import ast
+from typing import Any, Callable, Optional, Sequence, Tuple
 
-from google.cloud import bigquery
-from google.oauth2 import service_account
+from config import config
+from constants import ANALYSIS_CACHE_TTL_SECONDS, ANALYSIS_CACHE_MAX_SIZE, ANALYSIS_CACHE_MAX_BYTES, ENCODED_COORDINATE_CACHE_MAX_BYTES
+from services.analysis_engine_service import get_analysis_engine
+from services.crime_data_summary_service import read_crime_summary, read_coordinate_crime_summary, read_geohash_crime_summary, build_geohash_crime_summary
+from util.cache_util import ResultCache, estimate_result_bytes
+from util.spatial_util import SpatialBinCounter
+from util.streaming_util import paginate
+from util.logger import logger
 
-def create_bigquery_client():
+# Analysis results only change when new data is uploaded, see invalidate_analysis_results.
+# Weighed by their estimated size, a few coordinate lists would take hundreds of MB otherwise
+analysis_result_cache = ResultCache(
+      max_size=ANALYSIS_CACHE_MAX_SIZE, ttl_seconds=ANALYSIS_CACHE_TTL_SECONDS,
+      max_bytes=ANALYSIS_CACHE_MAX_BYTES, weigh=estimate_result_bytes
+)
+# (encoded page, next cursor) per page request, weighed by the encoded bytes
+encoded_coordinate_cache = ResultCache(
+      max_size=ANALYSIS_CACHE_MAX_SIZE, ttl_seconds=ANALYSIS_CACHE_TTL_SECONDS,
+      max_bytes=ENCODED_COORDINATE_CACHE_MAX_BYTES, weigh=lambda page: len(page[0])
+)
+
+def invalidate_analysis_results(city: str, time_range: str):
+      analysis_result_cache.invalidate(city, time_range)
+      encoded_coordinate_cache.invalidate(city, time_range)
+      get_analysis_engine().invalidate(city, time_range)
+
+def get_analysis_cache_stats() -> dict[str, Any]:
+      return analysis_result_cache.stats()
+
+def read_crime_data_analysis(city: str, time_range: str) -> dict[str, Any]:
       '''
-      Create a BigQuery client based on the environment
-      prod or stage: google cloud run then use the default credentials
-      local or docker: use the credentials in the google-credentials.json file
+      Serve the offense type analysis from the summary pre-aggregated at ingest time,
+      the analysis engine only runs the query when no summary was uploaded for the city/time_range.
       '''
-      env = config.ENVIRONMENT
-      if env == Environment.PROD or env == Environment.STAGE:
-            client = bigquery.Client()
-      else:
-            credentials = service_account.Credentials.from_service_account_file(config.GOOGLE_CREDENTIALS_FILE)
-            client = bigquery.Client(credentials=credentials, project=credentials.project_id)
-      return client
-
-def read_data_from_bigquery(query: str, process_data: Callable[[bigquery.table.RowIterator], Any]) -> Any:
-      client = create_bigquery_client()
-      query_job = client.query(query)
-      result = query_job.result()
-      return process_data(result)
-
-def process_all_crime_data_bigquery(rows: bigquery.table.RowIterator) -> dict[str, Any]:
-      rows_list = list(rows)
-      if not rows_list:
-            raise ValueError("No data found in the BigQuery result.")
-      
-      crime_statistics = []
-      for row in rows_list:
-            crime_statistics.append({
-                  "crime_type": row["offense_type"],
-                  "count": row["count"],
-                  "percentage": row["percentage"]
-            })
-            
-      total_crimes = sum(row['count'] for row in rows_list)
-      
-      return {
-            "total_crimes": total_crimes,
-            "crime_statistics": crime_statistics
-      }
-      
+      summary = read_crime_summary(city, time_range, config.GCS_BUCKET_NAME)
+      if summary is not None:
+            if not summary["crime_statistics"]:
+                  raise ValueError("No data found in the crime data summary.")
+            return summary
+
+      logger.info(f"No crime summary for {city}-{time_range}, falling back to the {config.ANALYSIS_ENGINE} analysis engine")
+      return get_analysis_engine().analyze_crime_data(city, time_range)
+
 def analyze_crime_data(city:str, time_range:str) -> dict[str, Any]:
-      query = f"""
-      SELECT 
-            offense_type,
-            COUNT(*) as count,
-            ROUND(COUNT(*) * 100.0 / SUM(COUNT(*)) OVER(), 2) as percentage
-      FROM 
-            `safe-city-walk.city_crime_data.newyork_city_crime_data_6months`
-      GROUP BY 
-            offense_type
-      ORDER BY 
-            count DESC
-      """
-      return read_data_from_bigquery(query, process_all_crime_data_bigquery)
-
-def process_coordinate_crime_data(rows: bigquery.table.RowIterator) -> list:
-      rows_list = list(rows)
-      if not rows_list:
-            raise ValueError("No data found in the BigQuery result.")
-      
-      coordinate_crime_data = []
-      for row in rows_list:
-            coordinate_crime_data.append({
-                  "coordinate": row["coordinate"],
-                  "crime_count": row["crime_count"]
-            })
-      
-      return coordinate_crime_data
-
-def analyze_coordinate_crime_data(city: str, time_range: str) -> list[dict]:
-      query = f"""
-      SELECT 
-            coordinate,
-            COUNT(*) as crime_count
-      FROM 
-            `safe-city-walk.coordinate_crime_data.newyork_coordiante_crime_data_6months`
-      GROUP BY 
-            coordinate
-      ORDER BY 
-            crime_count DESC
-      """
-      return read_data_from_bigquery(query, process_coordinate_crime_data)
+      return analysis_result_cache.get_or_compute(
+            (city, time_range, "crime_statistics"),
+            lambda: read_crime_data_analysis(city, time_range)
+      )
+
+def read_coordinate_crime_data_analysis(city: str, time_range: str) -> list[dict]:
+      '''
+      Serve the coordinate analysis from the summary pre-aggregated at ingest time,
+      the analysis engine only runs the query when no summary was uploaded for the city/time_range.
+      '''
+      summary = read_coordinate_crime_summary(city, time_range, config.GCS_BUCKET_NAME)
+      if summary is not None:
+            if not summary:
+                  raise ValueError("No data found in the coordinate crime data summary.")
+            return summary
+
+      logger.info(f"No coordinate crime summary for {city}-{time_range}, falling back to the {config.ANALYSIS_ENGINE} analysis engine")
+      return get_analysis_engine().analyze_coordinate_crime_data(city, time_range)
+
+def bin_coordinate_crime_data(coordinate_crime_data: list[dict], precision: int) -> list[dict]:
+      spatial_bins = SpatialBinCounter(min_precision=precision, max_precision=precision)
+      for row in coordinate_crime_data:
+            latitude, longitude = ast.literal_eval(row["coordinate"])
+            spatial_bins.add(latitude, longitude, row["crime_count"])
+      return build_geohash_crime_summary(spatial_bins.cells(precision))
+
+def read_geohash_crime_data_analysis(city: str, time_range: str, precision: int) -> list[dict]:
+      '''
+      Serve the crime counts per geohash cell from the summary binned at ingest time,
+      data uploaded before the cells were binned is binned from the coordinate analysis.
+      '''
+      summary = read_geohash_crime_summary(city, time_range, precision, config.GCS_BUCKET_NAME)
+      if summary is None:
+            logger.info(f"No geohash{precision} crime summary for {city}-{time_range}, binning the coordinate crime data")
+            summary = bin_coordinate_crime_data(analyze_coordinate_crime_data(city, time_range), precision)
+      if not summary:
+            raise ValueError("No data found in the geohash crime data summary.")
+      return summary
+
+def analyze_coordinate_crime_data(city: str, time_range: str, resolution: Optional[int] = None) -> list[dict]:
+      '''
+      Crime counts per raw coordinate, or per geohash cell of `resolution` characters when set.
+      '''
+      if resolution is not None:
+            return analysis_result_cache.get_or_compute(
+                  (city, time_range, "geohash_crime_data", resolution),
+                  lambda: read_geohash_crime_data_analysis(city, time_range, resolution)
+            )
+      return analysis_result_cache.get_or_compute(
+            (city, time_range, "coordinate_crime_data"),
+            lambda: read_coordinate_crime_data_analysis(city, time_range)
+      )
+
+def encode_coordinate_crime_data(
+      city: str,
+      time_range: str,
+      resolution: Optional[int],
+      encoding: str,
+      encode: Callable[[Sequence[dict]], bytes],
+      offset: int = 0,
+      page_size: Optional[int] = None,
+      top_n: Optional[int] = None
+) -> Tuple[bytes, Optional[str]]:
+      '''
+      A page of the coordinate analysis encoded by `encode` and the cursor of the next page.
+      Encoded pages are cached, bounded by their total size, map clients keep requesting the same pages.
+      '''
+      def encode_page() -> Tuple[bytes, Optional[str]]:
+            rows, next_cursor = paginate(analyze_coordinate_crime_data(city, time_range, resolution), offset, page_size, top_n)
+            return encode(rows), next_cursor
+
+      return encoded_coordinate_cache.get_or_compute(
+            (city, time_range, "encoded_coordinate_crime_data", resolution, encoding, offset, page_size, top_n),
+            encode_page
+      )
 
       
 ''' Use Spark to process the crime data
@@ -0,0 +1,153 @@
+'''
+Summaries are pre-aggregated at ingest time, once per city/time_range, so the analysis
+endpoints read a few KB by key instead of scanning the raw rows on every request.
+
+Partitioned (Parquet) uploads also keep one daily summary per incident date partition, a delta
+upload rebuilds the summaries of the whole window from them without re-reading any rows.
+'''
+import json
+from typing import Any, Dict, List, Optional, Tuple
+from services.upload_crime_data_service import get_partition_incident_date, is_replaced_partition
+from util.crime_data_util import CrimeCounts
+from util.gcs_util import delete_gcs_blob, list_gcs_blobs, read_from_gcs, upload_to_gcs
+from util.spatial_util import SpatialBinCounter, get_geohash_cell_coordinate
+from util.logger import logger
+
+def get_crime_summary_file_name(city: str, time_range: str) -> str:
+    return f"summaries/{city.lower()}_crime_summary_{time_range.lower()}.json"
+
+def get_coordinate_crime_summary_file_name(city: str, time_range: str) -> str:
+    return f"summaries/{city.lower()}_coordinate_crime_summary_{time_range.lower()}.json"
+
+def get_geohash_crime_summary_file_name(city: str, time_range: str, precision: int) -> str:
+    return f"summaries/{city.lower()}_geohash{precision}_crime_summary_{time_range.lower()}.json"
+
+def get_daily_crime_summary_prefix(city: str, time_range: str) -> str:
+    return f"summaries/daily/{city.lower()}_crime_summary_{time_range.lower()}/"
+
+def get_daily_crime_summary_file_name(city: str, time_range: str, incident_date: str) -> str:
+    return f"{get_daily_crime_summary_prefix(city, time_range)}incident_date={incident_date}.json"
+
+def build_crime_summary(offense_type_counts: Dict[str, int]) -> Dict[str, Any]:
+    '''
+    Same shape as the BigQuery offense type analysis: counts and percentages per offense type, by count DESC.
+    '''
+    total_crimes = sum(offense_type_counts.values())
+    crime_statistics = [
+        {
+            "crime_type": offense_type,
+            "count": count,
+            "percentage": round(count * 100.0 / total_crimes, 2)
+        }
+        for offense_type, count in sorted(offense_type_counts.items(), key=lambda item: item[1], reverse=True)
+    ]
+    return {
+        "total_crimes": total_crimes,
+        "crime_statistics": crime_statistics
+    }
+
+def build_coordinate_crime_summary(coordinate_crime_data: Dict[Tuple[str, str], int]) -> List[Dict[str, Any]]:
+    '''
+    Same shape as the BigQuery coordinate analysis: crime count per coordinate, by crime_count DESC.
+    '''
+    return [
+        {
+            "coordinate": str(coordinate),
+            "crime_count": count
+        }
+        for coordinate, count in sorted(coordinate_crime_data.items(), key=lambda item: item[1], reverse=True)
+    ]
+
+def build_geohash_crime_summary(geohash_cells: Dict[str, int]) -> List[Dict[str, Any]]:
+    '''
+    Crime count per geohash cell, by crime_count DESC. `coordinate` is the cell center,
+    in the same form as the raw coordinates so clients can plot cells like points.
+    '''
+    return [
+        {
+            "geohash": geohash,
+            "coordinate": str(get_geohash_cell_coordinate(geohash)),
+            "crime_count": count
+        }
+        for geohash, count in sorted(geohash_cells.items(), key=lambda item: item[1], reverse=True)
+    ]
+
+def upload_crime_data_summaries(
+    offense_type_counts: Dict[str, int],
+    coordinate_crime_data: Dict[Tuple[str, str], int],
+    spatial_bins: SpatialBinCounter,
+    city: str,
+    time_range: str,
+    bucket_name: str
+):
+    crime_summary_file_name = get_crime_summary_file_name(city, time_range)
+    logger.info(f"Uploading crime summary {crime_summary_file_name} to {bucket_name}")
+    upload_to_gcs(json.dumps(build_crime_summary(offense_type_counts)), bucket_name, crime_summary_file_name, content_type='application/json')
+
+    coordinate_summary_file_name = get_coordinate_crime_summary_file_name(city, time_range)
+    logger.info(f"Uploading coordinate crime summary {coordinate_summary_file_name} to {bucket_name}")
+    upload_to_gcs(json.dumps(build_coordinate_crime_summary(coordinate_crime_data)), bucket_name, coordinate_summary_file_name, content_type='application/json')
+
+    for precision in spatial_bins.precisions:
+        geohash_summary_file_name = get_geohash_crime_summary_file_name(city, time_range, precision)
+        geohash_cells = spatial_bins.cells(precision)
+        logger.info(f"Uploading {len(geohash_cells)} geohash cells summary {geohash_summary_file_name} to {bucket_name}")
+        upload_to_gcs(json.dumps(build_geohash_crime_summary(geohash_cells)), bucket_name, geohash_summary_file_name, content_type='application/json')
+
+def build_daily_crime_summary(crime_counts: CrimeCounts) -> Dict[str, Any]:
+    return {
+        "offense_type_counts": crime_counts.offense_type_counts,
+        "coordinate_crime_data": [[latitude, longitude, count] for (latitude, longitude), count in crime_counts.coordinate_crime_data.items()]
+    }
+
+def parse_daily_crime_summary(daily_summary: Dict[str, Any]) -> CrimeCounts:
+    return CrimeCounts(
+        offense_type_counts=daily_summary["offense_type_counts"],
+        coordinate_crime_data={(latitude, longitude): count for latitude, longitude, count in daily_summary["coordinate_crime_data"]}
+    )
+
+def sync_daily_crime_summaries(
+    daily_crime_counts: Dict[str, CrimeCounts],
+    city: str,
+    time_range: str,
+    bucket_name: str,
+    replace_from_date: Optional[str] = None,
+    window_start_date: Optional[str] = None
+) -> Dict[str, CrimeCounts]:
+    '''
+    Upload the daily summaries of the incident dates in `daily_crime_counts` and remove the ones of
+    replaced partitions (see is_replaced_partition) that got no rows.
+    Returns the counts of every incident date of the window, the kept daily summaries are read back.
+    '''
+    for incident_date, crime_counts in daily_crime_counts.items():
+        upload_to_gcs(json.dumps(build_daily_crime_summary(crime_counts)), bucket_name, get_daily_crime_summary_file_name(city, time_range, incident_date), content_type='application/json')
+    logger.info(f"Uploaded {len(daily_crime_counts)} daily crime summaries of {city}-{time_range} to {bucket_name}")
+
+    window_crime_counts = dict(daily_crime_counts)
+    for blob_name in list_gcs_blobs(bucket_name, get_daily_crime_summary_prefix(city, time_range)):
+        incident_date = get_partition_incident_date(blob_name)
+        if incident_date in daily_crime_counts or not blob_name.endswith(".json"):
+            continue
+        if is_replaced_partition(incident_date, replace_from_date, window_start_date):
+            delete_gcs_blob(bucket_name, blob_name)
+            continue
+        daily_summary = read_summary(bucket_name, blob_name)
+        if daily_summary is not None:
+            window_crime_counts[incident_date] = parse_daily_crime_summary(daily_summary)
+    return window_crime_counts
+
+def read_summary(bucket_name: str, file_name: str) -> Optional[Any]:
+    data = read_from_gcs(bucket_name, file_name)
+    if data is None:
+        logger.info(f"Summary {file_name} not found in {bucket_name}")
+        return None
+    return json.loads(data)
+
+def read_crime_summary(city: str, time_range: str, bucket_name: str) -> Optional[Dict[str, Any]]:
+    return read_summary(bucket_name, get_crime_summary_file_name(city, time_range))
+
+def read_coordinate_crime_summary(city: str, time_range: str, bucket_name: str) -> Optional[List[Dict[str, Any]]]:
+    return read_summary(bucket_name, get_coordinate_crime_summary_file_name(city, time_range))
+
+def read_geohash_crime_summary(city: str, time_range: str, precision: int, bucket_name: str) -> Optional[List[Dict[str, Any]]]:
+    return read_summary(bucket_name, get_geohash_crime_summary_file_name(city, time_range, precision))
@@ -0,0 +1,243 @@
+from contextlib import ExitStack
+from dataclasses import dataclass
+from typing import Dict, Iterable, Iterator, Optional, Sequence, Tuple
+from config import config
+from models.crime_data_models import OUTPUT_FORMATS
+from services.upload_crime_data_service import open_crime_data_sink, open_crime_data_parquet_sink
+from services.upload_coordinate_crime_data_service import upload_coordinate_crime_data_to_gcs
+from services.crime_data_summary_service import sync_daily_crime_summaries, upload_crime_data_summaries
+from services.ingest_watermark_service import IngestWatermark, read_ingest_watermark, write_ingest_watermark
+from services.crime_data_analysis_service import invalidate_analysis_results
+from services.spatial_index_service import update_spatial_index
+from util.crime_data_util import CrimeCounts, transform_crime_data
+from util.fetch_crime_data import fetch_city_coordinate_counts, fetch_city_offense_type_counts, get_date_range
+from util.memory_budget_util import get_parquet_buffer_bytes
+from util.spatial_util import SpatialBinCounter
+from util.logger import logger
+
+@dataclass
+class IngestProgress:
+    '''
+    Counters of an ingestion, updated by the ingest pass while it runs.
+    '''
+    stage: str = "pending"
+    rows_fetched: int = 0
+    rows_transformed: int = 0
+    rows_uploaded: int = 0
+
+def count_fetched_records(raw_data: Iterable[dict], progress: IngestProgress) -> Iterator[dict]:
+    for record in raw_data:
+        progress.rows_fetched += 1
+        yield record
+
+def build_spatial_bins(coordinate_crime_data: Dict[Tuple[str, str], int]) -> SpatialBinCounter:
+    '''
+    Geohash cell counts of the coordinate counts, every distinct coordinate is encoded once.
+    '''
+    spatial_bins = SpatialBinCounter()
+    for (latitude, longitude), count in coordinate_crime_data.items():
+        spatial_bins.add(latitude, longitude, count)
+    return spatial_bins
+
+def publish_crime_data_aggregates(
+    crime_counts: CrimeCounts,
+    city: str,
+    time_range: str,
+    bucket_name: str,
+    compress: bool = False
+):
+    '''
+    Upload the coordinate crime data and the analysis summaries of the window counts and
+    drop the analysis results and the spatial index built from the previous data.
+    '''
+    spatial_bins = build_spatial_bins(crime_counts.coordinate_crime_data)
+    if spatial_bins.dropped:
+        logger.info(f"Dropped {spatial_bins.dropped} rows without a valid coordinate from the geohash cells of {city}-{time_range}")
+
+    # upload coordinate crime data to GCS
+    logger.info(f"Uploading coordinate crime data to GCS for {city}")
+    upload_coordinate_crime_data_to_gcs(crime_counts.coordinate_crime_data, city, time_range, bucket_name, compress=compress)
+    logger.info(f"Successfully uploaded coordinate crime data to GCS for {city}")
+
+    # upload the pre-aggregated summaries served by the analysis endpoints
+    logger.info(f"Uploading crime data summaries to GCS for {city}")
+    upload_crime_data_summaries(crime_counts.offense_type_counts, crime_counts.coordinate_crime_data, spatial_bins, city, time_range, bucket_name)
+    logger.info(f"Successfully uploaded crime data summaries to GCS for {city}")
+
+    # cached analysis results of this city/time_range are stale now
+    invalidate_analysis_results(city, time_range)
+    update_spatial_index(city, time_range, crime_counts.coordinate_crime_data)
+
+def ingest_crime_data_time_ranges(
+    raw_data: Iterable[dict],
+    city: str,
+    time_ranges: Sequence[str],
+    bucket_name: str,
+    output_format: OUTPUT_FORMATS = OUTPUT_FORMATS.CSV,
+    progress: Optional[IngestProgress] = None,
+    memory_budget_bytes: Optional[int] = None
+) -> Dict[str, int]:
+    '''
+    Single pass ingestion of nested time ranges of one city from the raw records of the widest one.
+    Every raw record is transformed once, then written to the crime data sink of `output_format` of each
+    time range whose window contains its incident date and added to the offense type and coordinate counts
+    of that time range in the same step, so no record is kept once it has been written.
+    The coordinate counts and the analysis summaries of every time range are uploaded after the pass.
+    Partitioned (Parquet) uploads also store the daily summaries and the watermark delta uploads resume from.
+    `progress` is updated along the way. `memory_budget_bytes` is the memory budget of this ingestion,
+    INGEST_MEMORY_BUDGET_BYTES by default.
+    Returns the number of ingested records per time range.
+    '''
+    progress = progress or IngestProgress()
+    memory_budget_bytes = memory_budget_bytes or config.INGEST_MEMORY_BUDGET_BYTES
+    partitioned = OUTPUT_FORMATS(output_format) == OUTPUT_FORMATS.PARQUET
+    start_dates = {time_range: get_date_range(time_range)[0] for time_range in time_ranges}
+    widest_time_range = min(time_ranges, key=start_dates.get)
+    crime_counts = {time_range: CrimeCounts() for time_range in time_ranges}
+    row_counts = dict.fromkeys(time_ranges, 0)
+    daily_crime_counts: Dict[str, CrimeCounts] = {}
+    watermark = IngestWatermark(city)
+    # the incident date is only needed to slice the narrower windows and to partition
+    needs_incident_date = partitioned or len(time_ranges) > 1
+    # the Parquet sinks split the row buffer share of the memory budget
+    parquet_buffer_bytes = get_parquet_buffer_bytes(len(time_ranges), memory_budget_bytes)
+
+    # upload all crime data to GCS while counting crimes by coordinate
+    logger.info(f"Uploading all crime data to GCS for {city} with time ranges: {', '.join(time_ranges)}")
+    progress.stage = "ingesting"
+    with ExitStack() as stack:
+        # the widest time range takes every record, the others the records since their start date
+        sinks = [
+            (
+                time_range,
+                None if time_range == widest_time_range else start_dates[time_range],
+                stack.enter_context(open_crime_data_sink(city, time_range, bucket_name, output_format, parquet_buffer_bytes)),
+                crime_counts[time_range]
+            )
+            for time_range in time_ranges
+        ]
+        for record in transform_crime_data(city, watermark.track(count_fetched_records(raw_data, progress)), config.TRANSFORM_WORKERS, memory_budget_bytes):
+            progress.rows_transformed += 1
+            incident_date = record.incident_datetime.date().isoformat() if needs_incident_date else None
+            for time_range, start_date, write_crime_data, time_range_crime_counts in sinks:
+                if start_date is None or incident_date >= start_date:
+                    write_crime_data(record)
+                    time_range_crime_counts.add(record)
+                    row_counts[time_range] += 1
+            progress.rows_uploaded += 1
+            if partitioned:
+                daily_crime_counts.setdefault(incident_date, CrimeCounts()).add(record)
+    for time_range in time_ranges:
+        logger.info(f"Successfully uploaded {row_counts[time_range]} rows of crime data to GCS for {city}-{time_range}")
+
+    progress.stage = "uploading_summaries"
+    for time_range in time_ranges:
+        if partitioned:
+            sync_daily_crime_summaries(
+                {incident_date: counts for incident_date, counts in daily_crime_counts.items() if time_range == widest_time_range or incident_date >= start_dates[time_range]},
+                city, time_range, bucket_name
+            )
+        publish_crime_data_aggregates(crime_counts[time_range], city, time_range, bucket_name, compress=output_format == OUTPUT_FORMATS.CSV_GZIP)
+        if partitioned:
+            write_ingest_watermark(watermark, city, time_range, bucket_name)
+    progress.stage = "done"
+
+    return row_counts
+
+def ingest_crime_data(
+    raw_data: Iterable[dict],
+    city: str,
+    time_range: str,
+    bucket_name: str,
+    output_format: OUTPUT_FORMATS = OUTPUT_FORMATS.CSV,
+    progress: Optional[IngestProgress] = None,
+    memory_budget_bytes: Optional[int] = None
+) -> int:
+    '''
+    Single pass ingestion of one city/time_range, see ingest_crime_data_time_ranges.
+    Returns the number of ingested records.
+    '''
+    return ingest_crime_data_time_ranges(raw_data, city, [time_range], bucket_name, output_format, progress, memory_budget_bytes)[time_range]
+
+def ingest_crime_data_delta(
+    raw_data: Iterable[dict],
+    city: str,
+    time_range: str,
+    bucket_name: str,
+    start_date: str,
+    progress: Optional[IngestProgress] = None,
+    memory_budget_bytes: Optional[int] = None
+) -> int:
+    '''
+    Merge the records fetched since `start_date` (see get_delta_start_date) into the Parquet partitions
+    of a previous partitioned upload. The partitions from `start_date` on are replaced, the ones that
+    fell out of the window are dropped along with their daily summaries, the others are kept as they are.
+    The window summaries are then rebuilt from the daily summaries and the watermark moved forward.
+    `memory_budget_bytes` is the memory budget of this ingestion, INGEST_MEMORY_BUDGET_BYTES by default.
+    Returns the number of ingested records.
+    '''
+    progress = progress or IngestProgress()
+    memory_budget_bytes = memory_budget_bytes or config.INGEST_MEMORY_BUDGET_BYTES
+    window_start_date, _ = get_date_range(time_range)
+    previous_watermark = read_ingest_watermark(city, time_range, bucket_name)
+    watermark = IngestWatermark(city, previous_watermark["latest"] if previous_watermark else None)
+    daily_crime_counts: Dict[str, CrimeCounts] = {}
+    row_count = 0
+
+    logger.info(f"Merging the crime data of {city}-{time_range} since {start_date} into its partitions")
+    progress.stage = "ingesting"
+    with open_crime_data_parquet_sink(
+        city, time_range, bucket_name, replace_from_date=start_date, window_start_date=window_start_date,
+        buffer_bytes=get_parquet_buffer_bytes(1, memory_budget_bytes)
+    ) as write_crime_data:
+        for record in transform_crime_data(city, watermark.track(count_fetched_records(raw_data, progress)), config.TRANSFORM_WORKERS, memory_budget_bytes):
+            progress.rows_transformed += 1
+            incident_date = record.incident_datetime.date().isoformat()
+            # partitions before start_date are kept, their rows must not be written twice
+            if incident_date < start_date:
+                continue
+            write_crime_data(record)
+            progress.rows_uploaded += 1
+            daily_crime_counts.setdefault(incident_date, CrimeCounts()).add(record)
+            row_count += 1
+    logger.info(f"Successfully merged {row_count} rows of crime data into {len(daily_crime_counts)} partitions for {city}")
+
+    progress.stage = "uploading_summaries"
+    window_crime_counts = sync_daily_crime_summaries(daily_crime_counts, city, time_range, bucket_name, replace_from_date=start_date, window_start_date=window_start_date)
+    crime_counts = CrimeCounts()
+    for incident_date_counts in window_crime_counts.values():
+        crime_counts.merge(incident_date_counts)
+    publish_crime_data_aggregates(crime_counts, city, time_range, bucket_name)
+    write_ingest_watermark(watermark, city, time_range, bucket_name)
+    progress.stage = "done"
+
+    return row_count
+
+def refresh_crime_data_summaries(
+    city: str,
+    time_range: str,
+    bucket_name: str,
+    output_format: OUTPUT_FORMATS = OUTPUT_FORMATS.CSV,
+    progress: Optional[IngestProgress] = None
+) -> int:
+    '''
+    Summary-only refresh of one city/time_range: the coordinate and offense type counts are aggregated
+    by the portal ($group), so only the grouped counts are transferred, no raw record.
+    The coordinate crime data and the analysis summaries are replaced, the crime data files are left as they are.
+    Returns the number of crimes counted.
+    '''
+    progress = progress or IngestProgress()
+    progress.stage = "fetching_counts"
+    crime_counts = CrimeCounts(
+        offense_type_counts=fetch_city_offense_type_counts(city, time_range),
+        coordinate_crime_data=fetch_city_coordinate_counts(city, time_range)
+    )
+    progress.rows_fetched = len(crime_counts.offense_type_counts) + len(crime_counts.coordinate_crime_data)
+    row_count = sum(crime_counts.offense_type_counts.values())
+    logger.info(f"Fetched the counts of {row_count} crimes of {city}-{time_range} in {progress.rows_fetched} grouped rows")
+
+    progress.stage = "uploading_summaries"
+    publish_crime_data_aggregates(crime_counts, city, time_range, bucket_name, compress=output_format == OUTPUT_FORMATS.CSV_GZIP)
+    progress.stage = "done"
+
+    return row_count
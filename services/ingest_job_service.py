@@ -0,0 +1,161 @@
+'''
+Background ingestion jobs.
+
+An upload request only enqueues a job and gets its id back, the fetch -> transform -> upload
+work runs on INGEST_JOB_WORKERS background workers and its progress is read from the job.
+A request for a city/time_range/output_format/mode that already has a queued or running job
+is coalesced into that job instead of doing the same work twice.
+The ingestion memory budget is split evenly between the workers, so the jobs running at once
+stay within it altogether.
+'''
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Any, Dict, Iterator, Optional, Tuple
+from config import config
+from constants import INGEST_JOB_MAX_QUEUED, INGEST_JOB_HISTORY_SIZE, PREFETCH_SPILL_MAX_BYTES
+from models.crime_data_models import INGEST_MODES, OUTPUT_FORMATS
+from services.ingest_crime_data_service import IngestProgress, ingest_crime_data, ingest_crime_data_delta, ingest_crime_data_time_ranges, refresh_crime_data_summaries
+from services.ingest_watermark_service import get_delta_start_date
+from util.executor_util import BoundedExecutor
+from util.fetch_crime_data import fetch_city_data, get_nested_time_ranges
+from util.logger import logger
+from util.memory_budget_util import iter_prefetched
+
+class JOB_STATUSES(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+
+@dataclass
+class IngestJob:
+    job_id: str
+    city: str
+    time_range: str
+    output_format: str
+    mode: str = INGEST_MODES.FULL.value
+    status: JOB_STATUSES = JOB_STATUSES.QUEUED
+    progress: IngestProgress = field(default_factory=IngestProgress)
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    error: Optional[str] = None
+    future: Optional[Future] = field(default=None, repr=False)
+
+    @property
+    def key(self) -> Tuple[str, str, str, str]:
+        return self.city, self.time_range, self.output_format, self.mode
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.job_id,
+            "city": self.city,
+            "time_range": self.time_range,
+            "output_format": self.output_format,
+            "mode": self.mode,
+            "status": self.status.value,
+            "stage": self.progress.stage,
+            "rows_fetched": self.progress.rows_fetched,
+            "rows_transformed": self.progress.rows_transformed,
+            "rows_uploaded": self.progress.rows_uploaded,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "error": self.error,
+        }
+
+class IngestJobQueue:
+    def __init__(self, bucket_name: str, max_workers: int, memory_budget_bytes: int, max_queued: int = INGEST_JOB_MAX_QUEUED, history_size: int = INGEST_JOB_HISTORY_SIZE):
+        self.bucket_name = bucket_name
+        self.job_memory_budget_bytes = max(1, memory_budget_bytes // max_workers)
+        self.history_size = history_size
+        self._executor = BoundedExecutor("ingest", max_workers, max_queued)
+        self._lock = threading.Lock()
+        self._jobs: "OrderedDict[str, IngestJob]" = OrderedDict()
+        self._active_jobs: Dict[Tuple[str, str, str, str], IngestJob] = {}
+
+    def submit(self, city: str, time_range: str, output_format: OUTPUT_FORMATS = OUTPUT_FORMATS.CSV, mode: INGEST_MODES = INGEST_MODES.FULL) -> Tuple[IngestJob, bool]:
+        '''
+        Enqueue an ingestion job, returns the job and whether it was coalesced into an identical
+        queued or running job. Raises BackendSaturatedError when too many jobs are waiting.
+        '''
+        output_format = OUTPUT_FORMATS(output_format).value
+        mode = INGEST_MODES(mode).value
+        with self._lock:
+            active_job = self._active_jobs.get((city, time_range, output_format, mode))
+            if active_job is not None:
+                logger.info(f"Coalesced the {mode} ingestion of {city}-{time_range} ({output_format}) into job {active_job.job_id}")
+                return active_job, True
+
+            job = IngestJob(job_id=uuid.uuid4().hex, city=city, time_range=time_range, output_format=output_format, mode=mode)
+            job.future = self._executor.submit(self._run, job)
+            self._active_jobs[job.key] = job
+            self._jobs[job.job_id] = job
+            self._trim_history()
+        logger.info(f"Queued job {job.job_id} for the {mode} ingestion of {city}-{time_range} ({output_format})")
+        return job, False
+
+    def _fetch(self, job: IngestJob, start_date: Optional[str] = None) -> Iterator[dict]:
+        # spilled only to a configured spill dir, the default one may be in memory
+        spill_bytes = PREFETCH_SPILL_MAX_BYTES if config.INGEST_SPILL_DIR else 0
+        return iter_prefetched(fetch_city_data(job.city, job.time_range, start_date), self.job_memory_budget_bytes // 4, spill_bytes)
+
+    def _run(self, job: IngestJob) -> int:
+        job.status = JOB_STATUSES.RUNNING
+        job.started_at = time.time()
+        try:
+            start_date = get_delta_start_date(job.city, job.time_range, self.bucket_name) if job.mode == INGEST_MODES.DELTA.value else None
+            # pages are fetched ahead of the transform within a quarter of the job memory budget, see iter_prefetched
+            if job.mode == INGEST_MODES.SUMMARY.value:
+                row_count = refresh_crime_data_summaries(job.city, job.time_range, self.bucket_name, job.output_format, job.progress)
+            elif job.mode == INGEST_MODES.MULTI_RANGE.value:
+                # one fetch of the widest window feeds the nested ones
+                row_count = ingest_crime_data_time_ranges(
+                    self._fetch(job), job.city, get_nested_time_ranges(job.time_range),
+                    self.bucket_name, job.output_format, job.progress, self.job_memory_budget_bytes
+                )[job.time_range]
+            elif start_date is not None:
+                row_count = ingest_crime_data_delta(
+                    self._fetch(job, start_date), job.city, job.time_range,
+                    self.bucket_name, start_date, job.progress, self.job_memory_budget_bytes
+                )
+            else:
+                if job.mode == INGEST_MODES.DELTA.value:
+                    logger.info(f"No watermark for {job.city}-{job.time_range} yet, job {job.job_id} ingests the whole time range")
+                row_count = ingest_crime_data(
+                    self._fetch(job), job.city, job.time_range,
+                    self.bucket_name, job.output_format, job.progress, self.job_memory_budget_bytes
+                )
+            job.status = JOB_STATUSES.SUCCEEDED
+            logger.info(f"Job {job.job_id} ingested {row_count} rows of {job.city}-{job.time_range}")
+            return row_count
+        except Exception as e:
+            job.status = JOB_STATUSES.FAILED
+            job.error = str(e)
+            logger.error(f"Job {job.job_id} failed to ingest {job.city}-{job.time_range}: {str(e)}")
+            raise
+        finally:
+            job.finished_at = time.time()
+            with self._lock:
+                if self._active_jobs.get(job.key) is job:
+                    del self._active_jobs[job.key]
+
+    def _trim_history(self):
+        # Drop the oldest finished jobs, active jobs are always kept
+        finished_job_ids = [job_id for job_id, job in self._jobs.items() if job.finished_at is not None]
+        for job_id in finished_job_ids[:max(0, len(self._jobs) - self.history_size)]:
+            del self._jobs[job_id]
+
+    def get(self, job_id: str) -> Optional[IngestJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def shutdown(self):
+        self._executor.shutdown()
+
+ingest_job_queue = IngestJobQueue(config.GCS_BUCKET_NAME, config.INGEST_JOB_WORKERS, config.INGEST_MEMORY_BUDGET_BYTES)
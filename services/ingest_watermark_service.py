@@ -0,0 +1,57 @@
+'''
+High-watermarks of the partitioned (Parquet) uploads: the latest incident date value already
+stored per city/time_range, stored next to the data so a delta upload only fetches newer records.
+'''
+import json
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Iterable, Iterator, Optional
+from constants import CITY_DATASETS, INGEST_DELTA_LOOKBACK_DAYS
+from util.fetch_crime_data import get_date_range
+from util.gcs_util import read_from_gcs, upload_to_gcs
+from util.logger import logger
+
+def get_ingest_watermark_file_name(city: str, time_range: str) -> str:
+    return f"watermarks/{city.lower()}_crime_data_{time_range.lower()}.json"
+
+class IngestWatermark:
+    '''
+    Tracks the latest value of the dataset date field (a Socrata floating timestamp, which sorts
+    as a string) over the raw records flowing through `track`.
+    '''
+    def __init__(self, city: str, latest: Optional[str] = None):
+        self.date_field = CITY_DATASETS.__dict__[city].dateField
+        self.latest = latest
+
+    def track(self, records: Iterable[dict]) -> Iterator[dict]:
+        date_field = self.date_field
+        for record in records:
+            value = record.get(date_field)
+            if value and (self.latest is None or value > self.latest):
+                self.latest = value
+            yield record
+
+def read_ingest_watermark(city: str, time_range: str, bucket_name: str) -> Optional[Dict[str, Any]]:
+    data = read_from_gcs(bucket_name, get_ingest_watermark_file_name(city, time_range))
+    return json.loads(data) if data is not None else None
+
+def write_ingest_watermark(watermark: IngestWatermark, city: str, time_range: str, bucket_name: str):
+    if watermark.latest is None:
+        return
+    logger.info(f"Moving the watermark of {city}-{time_range} to {watermark.date_field} = {watermark.latest}")
+    upload_to_gcs(json.dumps({
+        "date_field": watermark.date_field,
+        "latest": watermark.latest,
+        "updated_at": datetime.utcnow().isoformat()
+    }), bucket_name, get_ingest_watermark_file_name(city, time_range), content_type='application/json')
+
+def get_delta_start_date(city: str, time_range: str, bucket_name: str) -> Optional[str]:
+    '''
+    First incident date (YYYY-MM-DD) a delta upload re-fetches: INGEST_DELTA_LOOKBACK_DAYS before the
+    watermark, but not before the start of the window. None when there is no watermark to resume from.
+    '''
+    watermark = read_ingest_watermark(city, time_range, bucket_name)
+    if watermark is None:
+        return None
+    start_date = date.fromisoformat(watermark["latest"][:10]) - timedelta(days=INGEST_DELTA_LOOKBACK_DAYS)
+    window_start_date, _ = get_date_range(time_range)
+    return max(start_date.isoformat(), window_start_date)
@@ -0,0 +1,96 @@
+'''
+Spatial queries for walk-route safety lookups, answered from an in-memory grid index per
+city/time_range. The index is built from the coordinate crime counts, on first use from the
+coordinate analysis, and rebuilt from the counts of the ingest pass whenever data is uploaded.
+'''
+import ast
+import threading
+from typing import Any, Dict, Sequence, Tuple
+from services.crime_data_analysis_service import analyze_coordinate_crime_data
+from util.spatial_index_util import GridSpatialIndex, SpatialQueryResult, haversine_meters
+from util.logger import logger
+
+_spatial_indexes: Dict[Tuple[str, str], GridSpatialIndex] = {}
+_spatial_index_locks: Dict[Tuple[str, str], threading.Lock] = {}
+_lock = threading.Lock()
+
+def build_spatial_index(coordinate_crime_data: Dict[Tuple[str, str], int]) -> GridSpatialIndex:
+    spatial_index = GridSpatialIndex()
+    skipped = spatial_index.add_coordinate_counts(coordinate_crime_data.items())
+    logger.info(f"Indexed {spatial_index.point_count} coordinates ({spatial_index.crime_count} crimes), skipped {skipped} invalid coordinates")
+    return spatial_index
+
+def load_spatial_index(city: str, time_range: str) -> GridSpatialIndex:
+    logger.info(f"Building the spatial index of {city}-{time_range} from the coordinate crime data")
+    coordinate_crime_data = {
+        ast.literal_eval(row["coordinate"]): row["crime_count"]
+        for row in analyze_coordinate_crime_data(city, time_range)
+    }
+    return build_spatial_index(coordinate_crime_data)
+
+def get_spatial_index_lock(key: Tuple[str, str]) -> threading.Lock:
+    with _lock:
+        return _spatial_index_locks.setdefault(key, threading.Lock())
+
+def get_spatial_index(city: str, time_range: str) -> GridSpatialIndex:
+    key = (city, time_range)
+    spatial_index = _spatial_indexes.get(key)
+    if spatial_index is not None:
+        return spatial_index
+    # Only one request builds the index of a city/time_range, the others wait for it
+    with get_spatial_index_lock(key):
+        spatial_index = _spatial_indexes.get(key)
+        if spatial_index is None:
+            spatial_index = load_spatial_index(city, time_range)
+            _spatial_indexes[key] = spatial_index
+    return spatial_index
+
+def update_spatial_index(city: str, time_range: str, coordinate_crime_data: Dict[Tuple[str, str], int]):
+    '''
+    Swap in an index rebuilt from the freshly ingested coordinate counts, which replace the
+    counts of the window as a whole. Queries running on the previous index finish on it.
+    The swap waits for a lazy load in progress, so a load of the previous data can't
+    overwrite the fresh index once it completes.
+    '''
+    spatial_index = build_spatial_index(coordinate_crime_data)
+    key = (city, time_range)
+    with get_spatial_index_lock(key):
+        _spatial_indexes[key] = spatial_index
+
+def format_spatial_query_result(result: SpatialQueryResult) -> Dict[str, Any]:
+    return {
+        "crime_count": result.crime_count,
+        "coordinate_count": result.coordinate_count,
+        "coordinates": [
+            {
+                "latitude": latitude,
+                "longitude": longitude,
+                "crime_count": count
+            }
+            for latitude, longitude, count in result.points
+        ]
+    }
+
+def query_crimes_in_bbox(city: str, time_range: str, min_lat: float, min_lon: float, max_lat: float, max_lon: float, limit: int) -> Dict[str, Any]:
+    return format_spatial_query_result(get_spatial_index(city, time_range).query_bbox(min_lat, min_lon, max_lat, max_lon, limit))
+
+def query_crimes_within_radius(city: str, time_range: str, latitude: float, longitude: float, radius_meters: float, limit: int) -> Dict[str, Any]:
+    return format_spatial_query_result(get_spatial_index(city, time_range).query_radius(latitude, longitude, radius_meters, limit))
+
+def query_crime_density_along_route(city: str, time_range: str, path: Sequence[Tuple[float, float]], width_meters: float, limit: int) -> Dict[str, Any]:
+    query_result, segment_crime_counts = get_spatial_index(city, time_range).query_polyline(path, width_meters, limit)
+    segment_lengths = [haversine_meters(lat1, lon1, lat2, lon2) for (lat1, lon1), (lat2, lon2) in zip(path, path[1:])]
+    length_meters = sum(segment_lengths)
+    result = format_spatial_query_result(query_result)
+    result.update({
+        "length_meters": round(length_meters, 1),
+        "crimes_per_km": round(result["crime_count"] * 1000 / length_meters, 2) if length_meters else None,
+        "segments": [
+            {
+                "length_meters": round(segment_length, 1),
+                "crime_count": crime_count
+            }
+            for segment_length, crime_count in zip(segment_lengths, segment_crime_counts)
+        ]
+    })
+    return result
@@ -1,35 +1,33 @@
-from typing import List, Dict
-from models.crime_data_models import UnifiedCrimeData
+from typing import Dict, TextIO, Tuple
 from util.logger import logger
-from util.gcs_util import upload_to_gcs
-from io import StringIO
+from util.gcs_util import open_gcs_writer
 import csv
-from util.crime_data_util import count_crimes_by_coordinate
 
 
-def convert_coordinate_crime_data_to_csv(data: Dict[str, int]) -> str:
-    output = StringIO()
+def get_coordinate_crime_data_file_name(city: str, time_range: str, compress: bool = False) -> str:
+    extension = "csv.gz" if compress else "csv"
+    return f"{city.lower()}_coordiante_crime_data_{time_range.lower()}.{extension}"
+
+
+def write_coordinate_crime_data_csv(data: Dict[Tuple[str, str], int], output: TextIO):
     writer = csv.writer(output)
-    
+
     # Write header
     writer.writerow(['coordinate', 'crime_count'])
-    
+
     for coordinate, count in data.items():
         writer.writerow([coordinate, count])
-    return output.getvalue()
 
 
-def upload_coordinate_crime_data_to_gcs(data: List[UnifiedCrimeData], city: str, time_range: str, bucket_name: str):
-    file_name = f"{city.lower()}_coordiante_crime_data_{time_range.lower()}.csv"
+def upload_coordinate_crime_data_to_gcs(coordinate_crime_data: Dict[Tuple[str, str], int], city: str, time_range: str, bucket_name: str, compress: bool = False):
+    '''
+    Upload the crime counts per (latitude, longitude), as counted while ingesting the city data.
+    The CSV is gzip compressed when `compress` is set.
+    '''
+    file_name = get_coordinate_crime_data_file_name(city, time_range, compress)
     print(f"Uploading coordiante crime data: {file_name} to {bucket_name}")
-    
-    # Transform data
-    logger.info(f"Counting crimes by coordinate for {city.lower()}-{time_range.lower()}")
-    coordinate_crime_data = count_crimes_by_coordinate(data)
-    logger.info(f"Counted {len(coordinate_crime_data)} crimes by coordinate for {city}")
-    
-    # Load data to GCS
-    logger.info(f"Converting {file_name} to CSV")
-    csv_data = convert_coordinate_crime_data_to_csv(coordinate_crime_data)
-    logger.info(f"Uploading {file_name} to GCS in {bucket_name}")
-    upload_to_gcs(csv_data, bucket_name, file_name)
+
+    # Stream the CSV rows to GCS
+    logger.info(f"Streaming {len(coordinate_crime_data)} coordinates of {file_name} as CSV to GCS in {bucket_name}")
+    with open_gcs_writer(bucket_name, file_name, compress=compress) as output:
+        write_coordinate_crime_data_csv(coordinate_crime_data, output)
@@ -1,33 +1,213 @@
 import csv
-from io import StringIO
-from typing import List, Type
-from dataclasses import asdict
-from util.crime_data_util import transform_crime_data
-from models.crime_data_models import UnifiedCrimeData, UnifiedCrimeDataFieldNames
+import io
+import pickle
+import shutil
+from contextlib import contextmanager
+from itertools import chain
+from typing import Callable, ContextManager, Dict, Iterable, Iterator, List, Optional, Tuple
+from models.crime_data_models import UnifiedCrimeData, UnifiedCrimeDataFieldNames, OUTPUT_FORMATS, unified_crime_data_values
+from constants import PARQUET_BUFFER_BYTES, PARQUET_ROW_GROUP_ROWS
 from util.logger import logger
-from util.gcs_util import upload_to_gcs
-
-def upload_crime_data_to_gcs(raw_data: List[UnifiedCrimeData], city: str, time_range: str, bucket_name: str) -> List[UnifiedCrimeData]:
-    file_name = f"{city.lower()}_crime_data_{time_range.lower()}.csv"
-    logger.info(f"Uploading crime data for {city} with time range: {time_range} to {file_name} in {bucket_name}")
-        
-    # Transform data
-    logger.info(f"Transforming data for {city.lower()}-{time_range.lower()}")
-    transformed_data: List[UnifiedCrimeData] = transform_crime_data(city, raw_data)
-    logger.info(f"Transformed {len(transformed_data)} data for {city}")
-    
-    # Load data to GCS
-    logger.info(f"Transform {file_name} into CSV ")
-    csv_data = convert_crime_data_to_csv(transformed_data)
-    logger.info(f"Uploading {file_name} to GCS in {bucket_name}")
-    upload_to_gcs(csv_data, bucket_name, file_name)
-    
-    return transformed_data
-    
-def convert_crime_data_to_csv(data: List[Type[UnifiedCrimeData]]) -> str:
-    output = StringIO()
-    writer = csv.DictWriter(output, fieldnames=UnifiedCrimeDataFieldNames)
-    writer.writeheader()
-    for row in data:
-        writer.writerow(asdict(row))
-    return output.getvalue()
\ No newline at end of file
+from util.memory_budget_util import estimate_row_bytes, open_spill_file
+from util.gcs_util import PARTIAL_BLOB_SUFFIX, open_gcs_binary_writer, open_gcs_writer, list_gcs_blobs, delete_gcs_blob
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+def get_crime_data_file_name(city: str, time_range: str, output_format: OUTPUT_FORMATS = OUTPUT_FORMATS.CSV) -> str:
+    return f"{city.lower()}_crime_data_{time_range.lower()}.{OUTPUT_FORMATS(output_format).value}"
+
+def get_crime_data_partition_prefix(city: str, time_range: str) -> str:
+    return f"{city.lower()}_crime_data_{time_range.lower()}/"
+
+def get_partition_incident_date(blob_name: str) -> Optional[str]:
+    '''
+    Incident date (YYYY-MM-DD) of a blob under an `incident_date=YYYY-MM-DD` partition, None for other blobs.
+    '''
+    marker = "incident_date="
+    position = blob_name.find(marker)
+    if position < 0:
+        return None
+    return blob_name[position + len(marker):position + len(marker) + len("YYYY-MM-DD")]
+
+def is_replaced_partition(incident_date: Optional[str], replace_from_date: Optional[str] = None, window_start_date: Optional[str] = None) -> bool:
+    '''
+    Whether the existing data of an incident date partition is replaced by an upload: every partition
+    is replaced by a full upload (no `replace_from_date`), a delta upload replaces the partitions from
+    `replace_from_date` on and drops the ones before `window_start_date`.
+    '''
+    if replace_from_date is None or incident_date is None:
+        return True
+    return incident_date >= replace_from_date or (window_start_date is not None and incident_date < window_start_date)
+
+@contextmanager
+def open_crime_data_csv_sink(city: str, time_range: str, bucket_name: str, compress: bool = False) -> Iterator[Callable[[UnifiedCrimeData], None]]:
+    '''
+    Open the CSV blob of the city/time_range (gzip compressed when `compress` is set) and yield
+    a function writing one UnifiedCrimeData row to it.
+    Rows are streamed to GCS as they are written, the upload completes when the context exits.
+    '''
+    file_name = get_crime_data_file_name(city, time_range, OUTPUT_FORMATS.CSV_GZIP if compress else OUTPUT_FORMATS.CSV)
+    logger.info(f"Streaming crime data for {city} with time range: {time_range} as CSV to {file_name} in {bucket_name}")
+    with open_gcs_writer(bucket_name, file_name, compress=compress) as output:
+        writer = csv.writer(output)
+        writer.writerow(UnifiedCrimeDataFieldNames)
+        yield lambda row: writer.writerow(unified_crime_data_values(row))
+
+def get_crime_data_parquet_schema() -> "pa.Schema":
+    return pa.schema([
+        ("report_number", pa.string()),
+        ("incident_datetime", pa.timestamp("us", tz="UTC")),
+        ("reported_datetime", pa.timestamp("us", tz="UTC")),
+        ("offense_type", pa.string()),
+        ("offense_description", pa.string()),
+        ("victim_age", pa.string()),
+        ("victim_sex", pa.string()),
+        ("location_description", pa.string()),
+        ("longitude", pa.float64()),
+        ("latitude", pa.float64()),
+    ])
+
+def to_coordinate_value(value: str):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def to_crime_data_arrow_table(rows: List[Tuple]) -> "pa.Table":
+    schema = get_crime_data_parquet_schema()
+    coordinate_columns = {"longitude", "latitude"}
+    arrays = [
+        pa.array([to_coordinate_value(value) for value in column] if field.name in coordinate_columns else column, type=field.type)
+        for field, column in zip(schema, zip(*rows))
+    ]
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+class CrimeDataPartitionSpill:
+    '''
+    Rows of the incident date partitions flushed out of the Parquet row buffer. The rows are pickled in
+    chunks to one spill file, with the offsets of the chunks of every partition, and read back one
+    partition at a time when its Parquet file is written.
+    '''
+    def __init__(self):
+        self._file = open_spill_file("crime-data-partitions-")
+        self._chunk_offsets: Dict[str, List[int]] = {}
+
+    @property
+    def incident_dates(self) -> Iterable[str]:
+        return self._chunk_offsets.keys()
+
+    def append(self, incident_date: str, rows: List[Tuple]):
+        self._file.seek(0, io.SEEK_END)
+        self._chunk_offsets.setdefault(incident_date, []).append(self._file.tell())
+        pickle.dump(rows, self._file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def iter_chunks(self, incident_date: str) -> Iterator[List[Tuple]]:
+        for offset in self._chunk_offsets.pop(incident_date, []):
+            self._file.seek(offset)
+            yield pickle.load(self._file)
+
+    def close(self):
+        self._file.close()
+
+def upload_crime_data_partition(chunks: Iterable[List[Tuple]], bucket_name: str, blob_name: str, row_group_rows: int = PARQUET_ROW_GROUP_ROWS):
+    '''
+    Write the row chunks of one partition as a Parquet file of row groups of `row_group_rows` rows
+    (the last one smaller) to a spill file, then upload it.
+    '''
+    with open_spill_file("crime-data-partition-") as file:
+        writer = pq.ParquetWriter(file, get_crime_data_parquet_schema(), compression="snappy")
+        try:
+            rows = []
+            for chunk in chunks:
+                rows.extend(chunk)
+                while len(rows) >= row_group_rows:
+                    writer.write_table(to_crime_data_arrow_table(rows[:row_group_rows]))
+                    rows = rows[row_group_rows:]
+            if rows:
+                writer.write_table(to_crime_data_arrow_table(rows))
+        finally:
+            writer.close()
+        file.seek(0)
+        with open_gcs_binary_writer(bucket_name, blob_name) as gcs_writer:
+            shutil.copyfileobj(file, gcs_writer)
+
+@contextmanager
+def open_crime_data_parquet_sink(
+    city: str,
+    time_range: str,
+    bucket_name: str,
+    replace_from_date: Optional[str] = None,
+    window_start_date: Optional[str] = None,
+    buffer_bytes: int = PARQUET_BUFFER_BYTES
+) -> Iterator[Callable[[UnifiedCrimeData], None]]:
+    '''
+    Yield a function writing one UnifiedCrimeData row to typed, snappy compressed Parquet files
+    partitioned by incident date, one file per partition:
+        {city}_crime_data_{time_range}/incident_date=YYYY-MM-DD/part-00000.parquet
+
+    Rows are buffered per partition. Whenever the buffered rows take `buffer_bytes` (estimated) in total
+    the largest partitions are spilled to a temporary file (see CrimeDataPartitionSpill) until half of the
+    buffer is free. Once all rows are written the partition files are written and uploaded one at a time,
+    in row groups of PARQUET_ROW_GROUP_ROWS rows, so the buffer bounds the memory held but neither the
+    number of files nor the row group sizes. Part files left over from a previous upload are then removed.
+    With `replace_from_date` only the partitions from that date on are replaced and the ones before
+    `window_start_date` dropped, the others are kept as they are.
+    '''
+    if pa is None:
+        raise RuntimeError("Parquet output requires pyarrow, install it with `poetry install --extras parquet`")
+
+    prefix = get_crime_data_partition_prefix(city, time_range)
+    logger.info(f"Streaming crime data for {city} with time range: {time_range} as Parquet to {prefix} in {bucket_name}")
+    partitions: Dict[str, List[Tuple]] = {}
+    partition_bytes: Dict[str, int] = {}
+    spill = CrimeDataPartitionSpill()
+    written_blobs = set()
+    buffered_bytes = 0
+
+    def spill_partitions(target_bytes: int):
+        nonlocal buffered_bytes
+        for incident_date in sorted(partitions, key=partition_bytes.get, reverse=True):
+            if buffered_bytes <= target_bytes:
+                break
+            spill.append(incident_date, partitions.pop(incident_date))
+            buffered_bytes -= partition_bytes.pop(incident_date)
+
+    def write(row: UnifiedCrimeData):
+        nonlocal buffered_bytes
+        incident_date = row.incident_datetime.date().isoformat()
+        values = unified_crime_data_values(row)
+        row_bytes = estimate_row_bytes(values)
+        partitions.setdefault(incident_date, []).append(values)
+        partition_bytes[incident_date] = partition_bytes.get(incident_date, 0) + row_bytes
+        buffered_bytes += row_bytes
+        if buffered_bytes >= buffer_bytes:
+            spill_partitions(buffer_bytes // 2)
+
+    try:
+        yield write
+        for incident_date in sorted(set(spill.incident_dates) | set(partitions)):
+            blob_name = f"{prefix}incident_date={incident_date}/part-00000.parquet"
+            buffered_rows = [partitions.pop(incident_date)] if incident_date in partitions else []
+            upload_crime_data_partition(chain(spill.iter_chunks(incident_date), buffered_rows), bucket_name, blob_name)
+            written_blobs.add(blob_name)
+    finally:
+        spill.close()
+
+    for blob_name in list_gcs_blobs(bucket_name, prefix):
+        # partial blobs belong to uploads still in progress
+        if blob_name in written_blobs or blob_name.endswith(PARTIAL_BLOB_SUFFIX):
+            continue
+        if is_replaced_partition(get_partition_incident_date(blob_name), replace_from_date, window_start_date):
+            delete_gcs_blob(bucket_name, blob_name)
+    logger.info(f"Uploaded {len(written_blobs)} Parquet files for {city} with time range: {time_range} to {prefix} in {bucket_name}")
+
+def open_crime_data_sink(city: str, time_range: str, bucket_name: str, output_format: OUTPUT_FORMATS = OUTPUT_FORMATS.CSV, parquet_buffer_bytes: int = PARQUET_BUFFER_BYTES) -> ContextManager[Callable[[UnifiedCrimeData], None]]:
+    output_format = OUTPUT_FORMATS(output_format)
+    if output_format == OUTPUT_FORMATS.PARQUET:
+        return open_crime_data_parquet_sink(city, time_range, bucket_name, buffer_bytes=parquet_buffer_bytes)
+    return open_crime_data_csv_sink(city, time_range, bucket_name, compress=output_format == OUTPUT_FORMATS.CSV_GZIP)
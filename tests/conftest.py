@@ -0,0 +1,6 @@
+import os
+
+# the required settings, so config loads without a .env file
+os.environ.setdefault("SOCRATA_APP_TOKEN", "test-token")
+os.environ.setdefault("GCS_BUCKET_NAME", "test-bucket")
+os.environ.setdefault("GOOGLE_CREDENTIALS_FILE_LOCAL", "test-credentials.json")
@@ -0,0 +1,182 @@
+import json
+import os
+import random
+import threading
+import time
+import tracemalloc
+from concurrent.futures import Future
+import pytest
+import util.transform_pool_util as transform_pool_util
+from config import config
+from constants import DATA_LIMIT, DEFAULT_INGEST_JOB_WORKERS, DEFAULT_INGEST_MEMORY_BUDGET_BYTES, ESTIMATED_RECORD_BYTES
+from models.crime_data_models import CITIES, OUTPUT_FORMATS
+from services.ingest_crime_data_service import ingest_crime_data
+from util.crime_data_util import transform_crime_data
+from util.memory_budget_util import RecordSpillBuffer, get_max_pages_in_flight, get_transform_page_records, iter_prefetched
+
+# the budget of a job with the default INGEST_MEMORY_BUDGET_BYTES and INGEST_JOB_WORKERS
+DEFAULT_JOB_MEMORY_BUDGET_BYTES = DEFAULT_INGEST_MEMORY_BUDGET_BYTES // DEFAULT_INGEST_JOB_WORKERS
+
+PAGE_SIZE = 100
+
+def make_page(offset: int, size: int = PAGE_SIZE) -> list:
+    # ~1 KiB per record, like ESTIMATED_RECORD_BYTES
+    return [{"id": offset + i, "payload": "x" * 900} for i in range(size)]
+
+def test_record_spill_buffer_spills_pages_beyond_its_budget():
+    budget_bytes = 2 * PAGE_SIZE * ESTIMATED_RECORD_BYTES
+    page_count = 20
+    tracemalloc.start()
+    try:
+        with RecordSpillBuffer(budget_bytes, spill_bytes=1024 ** 3) as buffer:
+            baseline, _ = tracemalloc.get_traced_memory()
+            for page_number in range(page_count):
+                buffer.append(make_page(page_number * PAGE_SIZE))
+            buffer.finish()
+            buffered_bytes = tracemalloc.get_traced_memory()[0] - baseline
+
+            assert buffer.spilled_record_count == (page_count - 1) * PAGE_SIZE
+            # 10x as many records were appended, only the in-memory pages are held
+            assert buffered_bytes < 1.5 * budget_bytes
+            assert [record["id"] for record in buffer] == list(range(page_count * PAGE_SIZE))
+    finally:
+        tracemalloc.stop()
+
+def test_record_spill_buffer_keeps_pages_in_memory_again_once_the_reader_caught_up():
+    with RecordSpillBuffer(PAGE_SIZE * ESTIMATED_RECORD_BYTES, spill_bytes=1024 ** 3) as buffer:
+        records = iter(buffer)
+        for page_number in range(3):
+            buffer.append(make_page(page_number * PAGE_SIZE))
+        assert [next(records)["id"] for _ in range(3 * PAGE_SIZE)] == list(range(3 * PAGE_SIZE))
+        buffer.append(make_page(3 * PAGE_SIZE))
+        buffer.finish()
+
+        assert buffer.spilled_record_count == 2 * PAGE_SIZE
+        assert [record["id"] for record in records] == list(range(3 * PAGE_SIZE, 4 * PAGE_SIZE))
+
+def test_iter_prefetched_yields_every_record_then_the_fetch_error():
+    def fetch():
+        for page_number in range(10):
+            yield from make_page(page_number * PAGE_SIZE)
+        raise ConnectionError("portal went away")
+
+    records = []
+    with pytest.raises(ConnectionError):
+        for record in iter_prefetched(fetch(), 2 * PAGE_SIZE * ESTIMATED_RECORD_BYTES):
+            records.append(record["id"])
+    assert records == list(range(10 * PAGE_SIZE))
+
+def test_default_job_budget_keeps_every_transform_worker_busy():
+    assert get_max_pages_in_flight(os.cpu_count(), DEFAULT_JOB_MEMORY_BUDGET_BYTES) > 1
+
+@pytest.mark.parametrize("workers", [2, 4, 8])
+def test_default_job_budget_allows_two_pages_per_transform_worker(workers):
+    max_in_flight = get_max_pages_in_flight(workers, DEFAULT_JOB_MEMORY_BUDGET_BYTES)
+
+    assert max_in_flight == 2 * workers
+    assert max_in_flight * get_transform_page_records(workers, DEFAULT_JOB_MEMORY_BUDGET_BYTES) * ESTIMATED_RECORD_BYTES <= DEFAULT_JOB_MEMORY_BUDGET_BYTES // 2
+
+def test_iter_prefetched_pauses_the_fetch_while_the_buffer_is_full():
+    budget_bytes = 4 * PAGE_SIZE * ESTIMATED_RECORD_BYTES
+    fetched = 0
+
+    def fetch():
+        nonlocal fetched
+        for page_number in range(100):
+            for record in make_page(page_number * PAGE_SIZE):
+                fetched += 1
+                yield record
+
+    records = iter_prefetched(fetch(), budget_bytes)
+    next(records)
+    time.sleep(0.2)
+    # the page being read, the buffered pages and the page waiting for room
+    assert fetched <= 4 * PAGE_SIZE
+
+    assert sum(1 for _ in records) == 100 * PAGE_SIZE - 1
+    assert not [thread for thread in threading.enumerate() if thread.name == "ingest-prefetch"]
+
+class CountingExecutor:
+    '''
+    Runs the transform in-process and records how many submitted pages are not consumed yet.
+    '''
+    def __init__(self):
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def submit(self, fn, *args) -> Future:
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        future = Future()
+        future.set_result(fn(*args))
+        result = future.result
+
+        def consume(*result_args):
+            self.in_flight -= 1
+            return result(*result_args)
+        future.result = consume
+        return future
+
+@pytest.mark.parametrize("memory_budget_bytes", [None, 128 * 1024 ** 2, 1])
+def test_transform_crime_data_bounds_the_pages_in_flight(monkeypatch, memory_budget_bytes):
+    workers = 4
+    executor = CountingExecutor()
+    monkeypatch.setattr(transform_pool_util, "get_transform_pool", lambda workers: executor)
+    record = {"cmplnt_num": "1", "cmplnt_fr_dt": "2026-01-02T03:04:00.000", "rpt_dt": "2026-01-02T00:00:00.000", "ofns_desc": "PETIT LARCENY", "latitude": "40.7", "longitude": "-73.9"}
+    page_count = 10
+
+    transformed = transform_crime_data(CITIES.NEW_YORK, [record] * (page_count * DATA_LIMIT), workers, memory_budget_bytes)
+
+    assert sum(1 for _ in transformed) == page_count * DATA_LIMIT
+    expected_max_in_flight = get_max_pages_in_flight(workers, memory_budget_bytes) if memory_budget_bytes else 2 * workers
+    assert executor.max_in_flight == expected_max_in_flight
+    assert executor.in_flight == 0
+
+def iter_raw_records(count: int):
+    '''
+    Raw New York records over a month of incident dates and a few hundred coordinates, JSON decoded
+    one at a time like the streamed Socrata pages, so none of their strings are shared.
+    '''
+    generator = random.Random(7)
+    coordinates = [(f"40.{generator.randint(700000, 900000)}", f"-73.{generator.randint(900000, 999999)}") for _ in range(200)]
+    for number in range(count):
+        latitude, longitude = generator.choice(coordinates)
+        day = generator.randint(1, 28)
+        yield json.loads(json.dumps({
+            "cmplnt_num": str(number),
+            "cmplnt_fr_dt": f"2026-02-{day:02d}T{generator.randint(0, 23):02d}:30:00.000",
+            "rpt_dt": f"2026-02-{day:02d}T00:00:00.000",
+            "law_cat_cd": generator.choice(["FELONY", "MISDEMEANOR", "VIOLATION"]),
+            "ofns_desc": generator.choice(["PETIT LARCENY", "HARRASSMENT 2", "ASSAULT 3 & RELATED OFFENSES"]),
+            "vic_age_group": generator.choice(["25-44", "45-64", "18-24"]),
+            "vic_sex": generator.choice("MFE"),
+            "loc_of_occur_desc": generator.choice(["INSIDE", "FRONT OF"]),
+            "latitude": latitude,
+            "longitude": longitude,
+        }))
+
+def test_ingest_peak_memory_stays_within_the_budget(monkeypatch, tmp_path):
+    '''
+    A job-like Parquet ingestion (records fetched ahead, transformed, buffered and spilled by the sink) of
+    many pages of records holds less than its budget at its peak. The aggregates are small here, they are
+    outside the budget.
+    '''
+    monkeypatch.setattr(config.config_model, "LOCAL_STORAGE_DIR", str(tmp_path))
+    monkeypatch.setattr(config.config_model, "TRANSFORM_WORKERS", 1)
+    budget_bytes = 16 * 1024 ** 2
+    record_count = 5 * DATA_LIMIT
+
+    tracemalloc.start()
+    try:
+        baseline, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        row_count = ingest_crime_data(
+            iter_prefetched(iter_raw_records(record_count), budget_bytes // 4), CITIES.NEW_YORK.value, "1year",
+            "bucket", OUTPUT_FORMATS.PARQUET, memory_budget_bytes=budget_bytes
+        )
+        peak_bytes = tracemalloc.get_traced_memory()[1] - baseline
+    finally:
+        tracemalloc.stop()
+
+    assert row_count == record_count
+    assert peak_bytes < budget_bytes
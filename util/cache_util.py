@@ -0,0 +1,128 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+class ResultCache:
+    '''
+    Thread-safe result cache with a TTL and size-bounded LRU eviction.
+    With `max_bytes` the entries are also bounded by their total size as measured by `weigh`,
+    a value larger than `max_bytes` is returned but not cached.
+
+    Keys are tuples, so entries can be invalidated by key prefix (e.g. every entry of a
+    city/time_range). Concurrent misses on the same key are single-flighted: the first
+    caller computes the value and the others wait for its result instead of computing it again.
+    '''
+    def __init__(self, max_size: int, ttl_seconds: float, max_bytes: Optional[int] = None, weigh: Optional[Callable[[Any], int]] = None):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.weigh = weigh if max_bytes is not None else None
+        # (expiry, value, weight)
+        self._entries: "OrderedDict[Tuple, Tuple[float, Any, int]]" = OrderedDict()
+        self._bytes = 0
+        self._in_flight: Dict[Tuple, Future] = {}
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._coalesced = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+    def get_or_compute(self, key: Tuple[Hashable, ...], compute: Callable[[], Any]) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return entry[1]
+            if entry is not None:
+                self._remove(key)
+
+            future = self._in_flight.get(key)
+            is_leader = future is None
+            if is_leader:
+                self._misses += 1
+                future = Future()
+                self._in_flight[key] = future
+            else:
+                self._coalesced += 1
+
+        if not is_leader:
+            return future.result()
+
+        try:
+            value = compute()
+        except BaseException as e:
+            with self._lock:
+                if self._in_flight.get(key) is future:
+                    del self._in_flight[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            # The entry was invalidated while it was computed, hand the value to the
+            # waiting callers but don't cache it
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+                weight = self.weigh(value) if self.weigh else 0
+                if key in self._entries:
+                    self._remove(key)
+                if self.max_bytes is None or weight <= self.max_bytes:
+                    self._entries[key] = (time.monotonic() + self.ttl_seconds, value, weight)
+                    self._bytes += weight
+                    while len(self._entries) > self.max_size or (self.max_bytes is not None and self._bytes > self.max_bytes):
+                        self._remove(next(iter(self._entries)))
+                        self._evictions += 1
+        future.set_result(value)
+        return value
+
+    def invalidate(self, *key_prefix: Hashable) -> int:
+        '''
+        Drop every entry (and in-flight computation) whose key starts with `key_prefix`.
+        Returns the number of dropped entries.
+        '''
+        prefix_length = len(key_prefix)
+        with self._lock:
+            keys = [key for key in self._entries if key[:prefix_length] == key_prefix]
+            for key in keys:
+                self._remove(key)
+            for key in [key for key in self._in_flight if key[:prefix_length] == key_prefix]:
+                del self._in_flight[key]
+            self._invalidations += len(keys)
+        return len(keys)
+
+    def _remove(self, key: Tuple):
+        self._bytes -= self._entries.pop(key)[2]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self._hits + self._misses + self._coalesced
+            stats = {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self._hits,
+                "misses": self._misses,
+                "coalesced": self._coalesced,
+                "hit_ratio": round(self._hits / lookups, 4) if lookups else 0.0,
+                "evictions": self._evictions,
+                "invalidations": self._invalidations,
+            }
+            if self.max_bytes is not None:
+                stats.update({"size_bytes": self._bytes, "max_bytes": self.max_bytes})
+            return stats
+
+def estimate_result_bytes(value: Any) -> int:
+    '''
+    Approximate memory taken by a JSON-like result. A list is estimated from its first element,
+    the rows of a result all have the same shape.
+    '''
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(map(estimate_result_bytes, value.values()))
+    elif isinstance(value, (list, tuple)) and value:
+        size += len(value) * estimate_result_bytes(value[0])
+    return size
@@ -0,0 +1,110 @@
+'''
+Compact binary encodings of the coordinate crime data for map clients.
+
+Only rows with a valid coordinate are encoded. All integers are little-endian.
+
+Delta (`application/vnd.safe-city-walk.coordinates.delta`):
+    b"SCWD" magic
+    varint  decimals: coordinates are fixed-point integers of 10^-decimals degrees
+    varint  point count
+    then per point, sorted by (latitude, longitude):
+        zigzag varint  latitude delta from the previous point (from 0 for the first point)
+        zigzag varint  longitude delta from the previous point
+        varint         crime count
+    Varints are LEB128: 7 bits per byte, least significant group first, high bit set on
+    every byte but the last. Zigzag maps signed n to (n << 1) ^ (n >> 63).
+
+Packed (`application/vnd.safe-city-walk.coordinates.packed`), decodable into typed arrays:
+    b"SCWP" magic
+    uint32     point count n
+    float32[n] latitudes
+    float32[n] longitudes
+    uint32[n]  crime counts
+'''
+import struct
+import sys
+from array import array
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from constants import COORDINATE_DELTA_DECIMALS
+from util.spatial_util import parse_coordinate
+
+DELTA_MEDIA_TYPE = "application/vnd.safe-city-walk.coordinates.delta"
+PACKED_MEDIA_TYPE = "application/vnd.safe-city-walk.coordinates.packed"
+DELTA_MAGIC = b"SCWD"
+PACKED_MAGIC = b"SCWP"
+MAX_UINT32 = 0xFFFFFFFF
+
+def parse_coordinate_string(coordinate: str) -> Optional[Tuple[float, float]]:
+    '''
+    Parse the "('latitude', 'longitude')" coordinate of the analysis rows.
+    '''
+    parts = coordinate[2:-2].split("', '")
+    if len(parts) != 2:
+        parts = [part.strip(" '\"") for part in coordinate.strip("()").split(",")]
+        if len(parts) != 2:
+            return None
+    return parse_coordinate(parts[0], parts[1])
+
+def iter_valid_points(rows: Iterable[Dict[str, Any]]) -> Iterable[Tuple[float, float, int]]:
+    for row in rows:
+        coordinate = parse_coordinate_string(row["coordinate"])
+        if coordinate is not None:
+            yield coordinate[0], coordinate[1], row["crime_count"]
+
+def _append_varint(output: bytearray, value: int):
+    while value >= 0x80:
+        output.append((value & 0x7F) | 0x80)
+        value >>= 7
+    output.append(value)
+
+def encode_delta_coordinates(rows: Iterable[Dict[str, Any]], decimals: int = COORDINATE_DELTA_DECIMALS) -> bytes:
+    scale = 10 ** decimals
+    points: List[Tuple[int, int, int]] = [
+        (round(latitude * scale), round(longitude * scale), crime_count)
+        for latitude, longitude, crime_count in iter_valid_points(rows)
+    ]
+    # latitude then longitude order, as a single int key (latitude in the high bits, longitude offset to positive)
+    longitude_offset = 180 * scale
+    longitude_bits = (2 * longitude_offset).bit_length()
+    points.sort(key=lambda point: (point[0] << longitude_bits) | (point[1] + longitude_offset))
+
+    output = bytearray(DELTA_MAGIC)
+    _append_varint(output, decimals)
+    _append_varint(output, len(points))
+    append = output.append
+    previous_lat = 0
+    previous_lon = 0
+    # Single byte values (most latitude deltas and crime counts) skip the varint loop
+    for lat, lon, crime_count in points:
+        value = lat - previous_lat
+        value = (value << 1) ^ (value >> 63)
+        if value < 0x80:
+            append(value)
+        else:
+            _append_varint(output, value)
+        value = lon - previous_lon
+        value = (value << 1) ^ (value >> 63)
+        if value < 0x80:
+            append(value)
+        else:
+            _append_varint(output, value)
+        if crime_count < 0x80:
+            append(crime_count)
+        else:
+            _append_varint(output, crime_count)
+        previous_lat = lat
+        previous_lon = lon
+    return bytes(output)
+
+def encode_packed_coordinates(rows: Iterable[Dict[str, Any]]) -> bytes:
+    latitudes = array("f")
+    longitudes = array("f")
+    crime_counts = array("I")
+    for latitude, longitude, crime_count in iter_valid_points(rows):
+        latitudes.append(latitude)
+        longitudes.append(longitude)
+        crime_counts.append(min(crime_count, MAX_UINT32))
+    if sys.byteorder == "big":
+        for values in (latitudes, longitudes, crime_counts):
+            values.byteswap()
+    return b"".join((PACKED_MAGIC, struct.pack("<I", len(latitudes)), latitudes.tobytes(), longitudes.tobytes(), crime_counts.tobytes()))
@@ -1,6 +1,11 @@
-from typing import List, Dict, Type
-from models.crime_data_models import UnifiedCrimeData, NewYorkCrimeData, LosAngelesCrimeData, SeattleCrimeData, ChicagoCrimeData, CITY_DATA_MODELS, CITIES
+from dataclasses import dataclass, field
+from itertools import chain, islice
+from typing import Iterable, Iterator, Dict, Optional, Tuple, Type
+from models.crime_data_models import UnifiedCrimeData, NewYorkCrimeData, LosAngelesCrimeData, SeattleCrimeData, ChicagoCrimeData, CITY_DATA_MODELS, CITIES, compile_unified_transform
 from util.logger import logger
+from util.memory_budget_util import get_max_pages_in_flight, get_transform_page_records
+from util.transform_pool_util import transform_pages_in_pool
+from constants import DATA_LIMIT, PARALLEL_TRANSFORM_MIN_PAGES
 
 city_dataclass_map: Dict[CITIES, Type[CITY_DATA_MODELS]] = {
     CITIES.NEW_YORK: NewYorkCrimeData,
@@ -9,27 +14,65 @@ city_dataclass_map: Dict[CITIES, Type[CITY_DATA_MODELS]] = {
     CITIES.CHICAGO: ChicagoCrimeData
 }
 
-def transform_crime_data(city: CITIES, data: List[CITY_DATA_MODELS]) -> List[UnifiedCrimeData]:
+def transform_crime_data(city: CITIES, data: Iterable[dict], workers: int = 1, memory_budget_bytes: Optional[int] = None) -> Iterator[UnifiedCrimeData]:
+    '''
+    Lazily transform raw city records into UnifiedCrimeData.
+    `data` can be any iterable (e.g. the paged fetch generator), records are transformed a page
+    of DATA_LIMIT records at a time (fewer when it doesn't fit in `memory_budget_bytes`) as they are consumed.
+    With `workers` > 1 the pages are transformed on a process pool, in order, unless the input
+    is smaller than PARALLEL_TRANSFORM_MIN_PAGES pages, where the worker round trips would dominate.
+    `memory_budget_bytes` bounds the raw pages in flight on the pool, the pages are cut smaller
+    rather than sent fewer at a time, so every worker stays busy.
+    '''
     try:
         
-        city_dataclass = city_dataclass_map[city]
-        transformed_data: List[UnifiedCrimeData] = [
-            city_dataclass(**record).transform() for record in data
-        ]
+        # Raw records are mapped straight to UnifiedCrimeData by the compiled per-city plan,
+        # no intermediate city dataclass is built per record
+        city_model = city_dataclass_map[city]
+        transform_plan = compile_unified_transform(city_model)
+        transformed_count = 0
+        records = iter(data)
+        page_records = get_transform_page_records(workers, memory_budget_bytes) if memory_budget_bytes else DATA_LIMIT
+        if workers > 1:
+            pages = iter(lambda: list(islice(records, DATA_LIMIT)), [])
+            first_pages = list(islice(pages, PARALLEL_TRANSFORM_MIN_PAGES))
+            if len(first_pages) < PARALLEL_TRANSFORM_MIN_PAGES:
+                transformed_pages = map(transform_plan.transform_page, first_pages)
+            else:
+                logger.info(f"Transforming the data of {city} on {workers} worker processes")
+                max_in_flight = get_max_pages_in_flight(workers, memory_budget_bytes) if memory_budget_bytes else None
+                pool_records = chain(chain.from_iterable(first_pages), records)
+                pool_pages = iter(lambda: list(islice(pool_records, page_records)), [])
+                transformed_pages = transform_pages_in_pool(city_model, pool_pages, workers, max_in_flight)
+        else:
+            transformed_pages = map(transform_plan.transform_page, iter(lambda: list(islice(records, page_records)), []))
+        for transformed_page in transformed_pages:
+            yield from transformed_page
+            transformed_count += len(transformed_page)
         
-        logger.info(f"Transformed {len(transformed_data)} rows for {city}")
-        
-        return transformed_data
+        logger.info(f"Transformed {transformed_count} rows for {city}")
     except Exception as e:
         print(f"Error transforming data for {city}: {e}")
         raise
     
-def count_crimes_by_coordinate(data: List[UnifiedCrimeData]) -> dict:
-    crime_count = {}
-    for record in data:
-        coordinate = (record.latitude, record.longitude)
-        if coordinate not in crime_count:
-            crime_count[coordinate] = 0
-        crime_count[coordinate] += 1
-        
-    return crime_count
\ No newline at end of file
+def add_crime_to_coordinate_count(crime_count: dict, record: UnifiedCrimeData):
+    coordinate = (record.latitude, record.longitude)
+    crime_count[coordinate] = crime_count.get(coordinate, 0) + 1
+
+@dataclass
+class CrimeCounts:
+    '''
+    Crime counts by offense type and by coordinate of a set of records, e.g. one incident date partition.
+    '''
+    offense_type_counts: Dict[str, int] = field(default_factory=dict)
+    coordinate_crime_data: Dict[Tuple[str, str], int] = field(default_factory=dict)
+
+    def add(self, record: UnifiedCrimeData):
+        add_crime_to_coordinate_count(self.coordinate_crime_data, record)
+        self.offense_type_counts[record.offense_type] = self.offense_type_counts.get(record.offense_type, 0) + 1
+
+    def merge(self, other: "CrimeCounts"):
+        for offense_type, count in other.offense_type_counts.items():
+            self.offense_type_counts[offense_type] = self.offense_type_counts.get(offense_type, 0) + count
+        for coordinate, count in other.coordinate_crime_data.items():
+            self.coordinate_crime_data[coordinate] = self.coordinate_crime_data.get(coordinate, 0) + count
@@ -0,0 +1,90 @@
+'''
+Bounded thread pools for the blocking backend calls of the async route handlers.
+
+Every backend gets its own pool, so one slow backend can't take the threads the others
+need (ingestion runs on the ingest job workers instead). Each pool admits at most
+`max_workers` running plus `max_queued` waiting calls, further calls are rejected right
+away with BackendSaturatedError instead of queueing up unbounded work (mapped to 503 + Retry-After in main.py).
+'''
+import asyncio
+import contextvars
+import functools
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from enum import Enum
+from typing import Any, Callable, Dict
+from constants import BACKEND_EXECUTOR_LIMITS, BACKEND_SATURATED_RETRY_AFTER_SECONDS
+from util.logger import logger
+
+class Backend(str, Enum):
+    ANALYSIS = "analysis"
+
+class BackendSaturatedError(Exception):
+    def __init__(self, backend: str, retry_after: int = BACKEND_SATURATED_RETRY_AFTER_SECONDS):
+        super().__init__(f"The {backend} backend is saturated, retry in {retry_after} seconds")
+        self.backend = backend
+        self.retry_after = retry_after
+
+class BoundedExecutor:
+    def __init__(self, name: str, max_workers: int, max_queued: int):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"{name}-backend")
+        self._lock = threading.Lock()
+        self._admitted = 0
+        self._completed = 0
+        self._rejected = 0
+
+    def _release(self, _):
+        with self._lock:
+            self._admitted -= 1
+            self._completed += 1
+
+    def submit(self, func: Callable[..., Any], *args, **kwargs) -> Future:
+        with self._lock:
+            if self._admitted >= self.max_workers + self.max_queued:
+                self._rejected += 1
+                logger.warning(f"Rejected a call, the {self.name} backend pool is saturated")
+                raise BackendSaturatedError(self.name)
+            self._admitted += 1
+
+        # The slot is released when the call finishes, not when the awaiting request goes away
+        context = contextvars.copy_context()
+        future = self._executor.submit(context.run, functools.partial(func, *args, **kwargs))
+        future.add_done_callback(self._release)
+        return future
+
+    async def run(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        return await asyncio.wrap_future(self.submit(func, *args, **kwargs))
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "max_queued": self.max_queued,
+                "in_flight": self._admitted,
+                "completed": self._completed,
+                "rejected": self._rejected,
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+backend_executors: Dict[Backend, BoundedExecutor] = {
+    backend: BoundedExecutor(backend.value, *BACKEND_EXECUTOR_LIMITS[backend.value])
+    for backend in Backend
+}
+
+async def run_on_backend(backend: Backend, func: Callable[..., Any], *args, **kwargs) -> Any:
+    '''
+    Run the blocking `func` in the pool of `backend`, raises BackendSaturatedError when the pool is full.
+    '''
+    return await backend_executors[backend].run(func, *args, **kwargs)
+
+def get_backend_executor_stats() -> Dict[str, Dict[str, int]]:
+    return {backend.value: executor.stats() for backend, executor in backend_executors.items()}
+
+def shutdown_backend_executors():
+    for executor in backend_executors.values():
+        executor.shutdown()
@@ -1,14 +1,21 @@
 import requests
+import threading
+from collections import defaultdict
 from config import config
-from typing import List
-from models.crime_data_models import UnifiedCrimeData
-from constants import CITY_DATASETS
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+from urllib.parse import urlparse
+from models.crime_data_models import CityDataset, TIME_RANGES
+from constants import CITY_DATASETS, DATA_LIMIT, MAX_CONCURRENT_REQUESTS_PER_HOST, SOCRATA_REQUEST_TIMEOUT_SECONDS, SOCRATA_STREAM_CHUNK_BYTES
 from datetime import datetime, timedelta
+from util.crime_data_util import city_dataclass_map
+from util.page_cache_util import socrata_page_cache
+from util.streaming_util import iter_json_array
 
-def fetch_city_data(city: str, time_range: str) -> List[UnifiedCrimeData]:
-    print(f"Fetching data for {city} with time range: {time_range}")
+GROUPED_COUNT_COLUMN = "crime_count"
+
+def get_date_range(time_range: str) -> tuple[str, str]:
     end_date = datetime.now()
-    
+
     if time_range == "1year":
         start_date = end_date - timedelta(days=365)
     elif time_range == "6months":
@@ -19,24 +26,189 @@ def fetch_city_data(city: str, time_range: str) -> List[UnifiedCrimeData]:
         raise ValueError("Invalid time range")
 
     # Convert dates to string format required by the API
-    start_date_str = start_date.strftime("%Y-%m-%d")
-    end_date_str = end_date.strftime("%Y-%m-%d")
-    
+    return start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d")
+
+def get_nested_time_ranges(time_range: str) -> List[str]:
+    '''
+    `time_range` and the time ranges whose window lies within its window, widest first.
+    '''
+    start_date, _ = get_date_range(time_range)
+    nested_time_ranges = [nested.value for nested in TIME_RANGES if get_date_range(nested.value)[0] >= start_date]
+    return sorted(nested_time_ranges, key=lambda nested: get_date_range(nested)[0])
+
+def get_city_select_columns(city: str) -> List[str]:
+    '''
+    Columns fetched for the city: the source columns of its model, plus the date field the
+    watermark is tracked on. Everything else (e.g. the nested location columns) is left out.
+    '''
+    columns = city_dataclass_map[city].get_source_columns()
+    date_field = CITY_DATASETS.__dict__[city].dateField
+    return columns if date_field in columns else sorted(columns + [date_field])
+
+def build_city_api_url(city_api: CityDataset, start_date: str, end_date: str, limit: int, offset: int, select: Optional[Sequence[str]] = None) -> str:
+    '''
+    Build a paged SoQL url for the city dataset, projected on the `select` columns when given.
+    Pages are ordered by the Socrata row id (:id) so that $offset paging stays stable
+    while we walk the result set.
+    '''
+    query = city_api.query.format(start_date=start_date, end_date=end_date)
+    if select:
+        query = f"$select={','.join(select)}&{query}"
+    return f"{city_api.apiEndpoint}?{query}&$order=:id&$limit={limit}&$offset={offset}"
+
+def build_city_grouped_api_url(city_api: CityDataset, start_date: str, end_date: str, group_by: Sequence[str], limit: int, offset: int) -> str:
+    '''
+    Build a paged SoQL url counting the records of the city dataset per distinct `group_by` columns.
+    Groups are ordered by their columns so that $offset paging stays stable.
+    '''
+    query = city_api.query.format(start_date=start_date, end_date=end_date)
+    columns = ",".join(group_by)
+    return f"{city_api.apiEndpoint}?$select={columns},count(*) AS {GROUPED_COUNT_COLUMN}&{query}&$group={columns}&$order={columns}&$limit={limit}&$offset={offset}"
+
+def describe_payload(size: int, headers: Optional[dict] = None) -> str:
+    '''
+    Payload size of a page for the logs: the JSON bytes, and the bytes over the wire when the
+    response was compressed and announced its length.
+    '''
+    description = f"{size} bytes"
+    if headers and headers.get("Content-Encoding") and headers.get("Content-Length"):
+        description += f", {headers['Content-Length']} {headers['Content-Encoding']} bytes over the wire"
+    return description
+
+def get_socrata_headers() -> dict:
+    return {
+        "X-App-Token": config.SOCRATA_APP_TOKEN,
+        "Accept": "application/json",
+        # pages of JSON compress ~10x, both clients decode gzip transparently
+        "Accept-Encoding": "gzip"
+    }
+
+def iter_body_chunks(body: bytes, chunk_size: int = SOCRATA_STREAM_CHUNK_BYTES) -> Iterator[bytes]:
+    view = memoryview(body)
+    for start in range(0, len(body), chunk_size):
+        yield view[start:start + chunk_size].tobytes()
+
+class ReceivedBody:
+    '''
+    Counts the bytes of a page body streaming through `track`, and keeps them when the page
+    has to be written to the page cache once complete.
+    '''
+    def __init__(self, keep: bool):
+        self.size = 0
+        self.data = bytearray() if keep else None
+
+    def track(self, chunk: bytes) -> bytes:
+        self.size += len(chunk)
+        if self.data is not None:
+            self.data += chunk
+        return chunk
+
+class HostRequestLimiter:
+    '''
+    Caps the number of in-flight requests per city portal host, so concurrent ingestion jobs that
+    fan out over several cities (or several time ranges of the same city) do not hammer a single
+    Socrata endpoint.
+    '''
+    def __init__(self, max_per_host: int = MAX_CONCURRENT_REQUESTS_PER_HOST):
+        self._lock = threading.Lock()
+        self._semaphores: dict[str, threading.BoundedSemaphore] = defaultdict(lambda: threading.BoundedSemaphore(max_per_host))
+
+    def for_url(self, url: str) -> threading.BoundedSemaphore:
+        with self._lock:
+            return self._semaphores[urlparse(url).netloc]
+
+host_request_limiter = HostRequestLimiter()
+
+def fetch_socrata_records(city: str, build_url: Callable[[int, int], str], page_size: int = DATA_LIMIT) -> Iterator[dict]:
+    '''
+    Walk a SoQL query of the city dataset in pages of `page_size` rows, `build_url(limit, offset)` builds
+    the url of every page. Page bodies are streamed and decoded incrementally, records are yielded as their
+    bytes arrive (or are read from the page cache), so no whole page of records is held, nor its body
+    unless it is written to the page cache. Stops at the first short page.
+    '''
+    city_api = CITY_DATASETS.__dict__[city]
+    headers = get_socrata_headers()
+
+    offset = 0
+    with requests.Session() as session:
+        while True:
+            api_url = build_url(page_size, offset)
+            cached_body = socrata_page_cache.get(city_api.identifier, api_url) if socrata_page_cache else None
+            row_count = 0
+            if cached_body is not None:
+                print(f"Using the cached page of {city} for api_url: {api_url}")
+                body = ReceivedBody(keep=False)
+                response_headers = None
+                for record in iter_json_array(map(body.track, iter_body_chunks(cached_body))):
+                    row_count += 1
+                    yield record
+                del cached_body
+            else:
+                print(f"Fetching data for {city} with api_url: {api_url}")
+                body = ReceivedBody(keep=socrata_page_cache is not None)
+                try:
+                    # the host slot is held while the body streams in, i.e. until the records are consumed
+                    with host_request_limiter.for_url(api_url), session.get(api_url, headers=headers, stream=True, timeout=SOCRATA_REQUEST_TIMEOUT_SECONDS) as response:
+                        response.raise_for_status()
+                        response_headers = response.headers
+                        chunks = response.iter_content(chunk_size=SOCRATA_STREAM_CHUNK_BYTES)
+                        for record in iter_json_array(map(body.track, chunks)):
+                            row_count += 1
+                            yield record
+                except requests.RequestException as error:
+                    print(f"Error fetching data for {city}: {error}")
+                    raise
+                if socrata_page_cache:
+                    socrata_page_cache.put(city_api.identifier, api_url, bytes(body.data))
+
+            print(f"Received {row_count} rows for {city} at offset {offset} ({describe_payload(body.size, response_headers)})")
+            if row_count < page_size:
+                break
+            offset += page_size
+
+def fetch_city_grouped_counts(city: str, time_range: str, group_by: Sequence[str], page_size: int = DATA_LIMIT) -> Iterator[Tuple[Tuple[str, ...], int]]:
+    '''
+    Let the portal count the records of the time range per distinct `group_by` columns ($group) and yield
+    (column values, count). Missing (null) values come as "", like in the transformed records.
+    '''
+    print(f"Fetching crime counts for {city} with time range: {time_range} grouped by {', '.join(group_by)}")
+    start_date_str, end_date_str = get_date_range(time_range)
+    city_api = CITY_DATASETS.__dict__[city]
+    for row in fetch_socrata_records(
+        city,
+        lambda limit, offset: build_city_grouped_api_url(city_api, start_date_str, end_date_str, group_by, limit, offset),
+        page_size
+    ):
+        yield tuple(row.get(column) or "" for column in group_by), int(row[GROUPED_COUNT_COLUMN])
+
+def fetch_city_coordinate_counts(city: str, time_range: str) -> Dict[Tuple[str, str], int]:
+    '''
+    Crime counts per (latitude, longitude) of the time range, aggregated by the portal.
+    '''
+    sources = city_dataclass_map[city].UNIFIED_FIELD_SOURCES
+    return dict(fetch_city_grouped_counts(city, time_range, [sources["latitude"], sources["longitude"]]))
+
+def fetch_city_offense_type_counts(city: str, time_range: str) -> Dict[str, int]:
+    '''
+    Crime counts per offense type of the time range, aggregated by the portal.
+    '''
+    sources = city_dataclass_map[city].UNIFIED_FIELD_SOURCES
+    return {offense_type: count for (offense_type,), count in fetch_city_grouped_counts(city, time_range, [sources["offense_type"]])}
+
+def fetch_city_data(city: str, time_range: str, start_date: Optional[str] = None, page_size: int = DATA_LIMIT) -> Iterator[dict]:
+    '''
+    Lazily yield the raw records of the city dataset as the pages stream in, walked in pages of
+    `page_size` rows using $limit/$offset, so the full dataset is never held in memory.
+    `start_date` (YYYY-MM-DD) narrows the time range to the incidents since that date.
+    '''
+    print(f"Fetching data for {city} with time range: {time_range}")
+    start_date_str, end_date_str = get_date_range(time_range)
+    start_date_str = start_date or start_date_str
+
     city_api = CITY_DATASETS.__dict__[city]
-    
-    api_url = f"{city_api.apiEndpoint}?{city_api.query.format(start_date=start_date_str, end_date=end_date_str)}"
-    print(f"Fetching data for {city} with api_url: {api_url}")
-    
-    try:    
-        response = requests.get(api_url, headers={
-            "X-App-Token": config.SOCRATA_APP_TOKEN,
-            "Accept": "application/json"
-        })
-        response.raise_for_status()
-        data = response.json()
-
-        print(f"Received {len(data)} rows for {city}")
-        return data
-    except requests.RequestException as error:
-        print(f"Error fetching data for {city}: {error}")
-        raise
+    select = get_city_select_columns(city)
+    yield from fetch_socrata_records(
+        city,
+        lambda limit, offset: build_city_api_url(city_api, start_date_str, end_date_str, limit, offset, select),
+        page_size
+    )
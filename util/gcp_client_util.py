@@ -0,0 +1,78 @@
+'''
+Process-lifetime Google Cloud clients.
+The clients are created once, on first use (or at application startup), and shared by
+every request: credentials are loaded once and the HTTP sessions are kept alive.
+The google-cloud clients are safe to share between threads.
+'''
+import threading
+from typing import Optional
+from google.cloud import bigquery, storage
+from google.oauth2 import service_account
+from config import config
+from constants import AnalysisEngineName, Environment
+from util.logger import logger
+
+_lock = threading.Lock()
+_bigquery_client: Optional[bigquery.Client] = None
+_storage_client: Optional[storage.Client] = None
+
+def create_bigquery_client() -> bigquery.Client:
+    '''
+    Create a BigQuery client based on the environment
+    prod or stage: google cloud run then use the default credentials
+    local or docker: use the credentials in the google-credentials.json file
+    '''
+    env = Environment(config.ENVIRONMENT)
+    if env == Environment.PROD or env == Environment.STAGE:
+        client = bigquery.Client()
+    else:
+        credentials = service_account.Credentials.from_service_account_file(config.GOOGLE_CREDENTIALS_FILE)
+        client = bigquery.Client(credentials=credentials, project=credentials.project_id)
+    return client
+
+def create_storage_client() -> storage.Client:
+    return storage.Client()
+
+def get_bigquery_client() -> bigquery.Client:
+    global _bigquery_client
+    if _bigquery_client is None:
+        with _lock:
+            if _bigquery_client is None:
+                logger.info("Creating the shared BigQuery client")
+                _bigquery_client = create_bigquery_client()
+    return _bigquery_client
+
+def get_storage_client() -> storage.Client:
+    global _storage_client
+    if _storage_client is None:
+        with _lock:
+            if _storage_client is None:
+                logger.info("Creating the shared Cloud Storage client")
+                _storage_client = create_storage_client()
+    return _storage_client
+
+def init_gcp_clients():
+    '''
+    Create the shared clients at application startup so the first requests don't pay for it.
+    Failures are only logged, the clients are created again on first use.
+    '''
+    try:
+        if AnalysisEngineName(config.ANALYSIS_ENGINE) == AnalysisEngineName.BIGQUERY:
+            get_bigquery_client()
+        if not config.LOCAL_STORAGE_DIR:
+            get_storage_client()
+    except Exception as e:
+        logger.warning(f"Could not create the Google Cloud clients at startup: {str(e)}")
+
+def close_gcp_clients():
+    '''
+    Close the shared clients and their HTTP sessions at application shutdown.
+    '''
+    global _bigquery_client, _storage_client
+    with _lock:
+        for client in (_bigquery_client, _storage_client):
+            if client is not None:
+                client.close()
+        _bigquery_client = None
+        _storage_client = None
+    logger.info("Closed the Google Cloud clients")
@@ -1,10 +1,125 @@
-from google.cloud import storage
+import gzip
+import io
+import os
+import uuid
+from contextlib import contextmanager
+from typing import BinaryIO, Iterator, List, Optional, TextIO
+from google.api_core.exceptions import NotFound
+from config import config
+from util.gcp_client_util import get_storage_client
 from util.logger import logger
 
-def upload_to_gcs(csv_data: str, bucket_name: str, blob_name: str):
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(blob_name)
-    logger.info(f"Uploading {blob_name} to {bucket_name}")
-    blob.upload_from_string(csv_data, content_type='text/csv')
-    logger.info(f"File {blob_name} uploaded to {bucket_name}.")
\ No newline at end of file
+PARTIAL_BLOB_SUFFIX = ".partial"
+
+def get_local_blob_path(bucket_name: str, blob_name: str) -> str:
+    return os.path.join(config.LOCAL_STORAGE_DIR, bucket_name, blob_name)
+
+@contextmanager
+def open_gcs_binary_writer(bucket_name: str, blob_name: str, content_type: str = 'application/octet-stream', chunk_size: Optional[int] = None) -> Iterator[BinaryIO]:
+    '''
+    Open a binary file-like writer on the blob. Data written to it is streamed to GCS
+    as a chunked resumable upload of `chunk_size` bytes (GCS_UPLOAD_CHUNK_SIZE by default),
+    so only one chunk is buffered in memory at a time.
+
+    The data is streamed to a uniquely named `.partial` blob which replaces `blob_name` once the
+    context exits cleanly, if writing fails the partial blob is removed and the previous version
+    of `blob_name` stays in place. Concurrent writers of the same blob don't share a partial blob.
+
+    When LOCAL_STORAGE_DIR is configured the bucket is stood in by a local directory.
+    '''
+    chunk_size = chunk_size or config.GCS_UPLOAD_CHUNK_SIZE
+    partial_blob_name = f"{blob_name}.{uuid.uuid4().hex[:12]}{PARTIAL_BLOB_SUFFIX}"
+    logger.info(f"Streaming {blob_name} to {bucket_name} in chunks of {chunk_size} bytes")
+
+    if config.LOCAL_STORAGE_DIR:
+        local_path = get_local_blob_path(bucket_name, blob_name)
+        partial_path = get_local_blob_path(bucket_name, partial_blob_name)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        try:
+            with open(partial_path, 'wb') as writer:
+                yield writer
+        except BaseException:
+            try:
+                os.remove(partial_path)
+            except FileNotFoundError:
+                pass
+            raise
+        os.replace(partial_path, local_path)
+    else:
+        storage_client = get_storage_client()
+        bucket = storage_client.bucket(bucket_name)
+        partial_blob = bucket.blob(partial_blob_name)
+        try:
+            with partial_blob.open('wb', chunk_size=chunk_size, content_type=content_type, ignore_flush=True) as writer:
+                yield writer
+        except BaseException:
+            # a partial blob that was never created must not replace the original error
+            try:
+                partial_blob.delete()
+            except NotFound:
+                pass
+            raise
+        bucket.copy_blob(partial_blob, bucket, blob_name)
+        partial_blob.delete()
+
+    logger.info(f"File {blob_name} uploaded to {bucket_name}.")
+
+@contextmanager
+def open_gcs_writer(bucket_name: str, blob_name: str, content_type: str = 'text/csv', chunk_size: Optional[int] = None, compress: bool = False) -> Iterator[TextIO]:
+    '''
+    Text (utf-8) counterpart of open_gcs_binary_writer, gzip compressed when `compress` is set.
+    '''
+    with open_gcs_binary_writer(bucket_name, blob_name, content_type=content_type, chunk_size=chunk_size) as binary_writer:
+        stream = gzip.GzipFile(fileobj=binary_writer, mode='wb') if compress else binary_writer
+        writer = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+        try:
+            yield writer
+        finally:
+            # Detach (not close) so the underlying upload is finalized or discarded by open_gcs_binary_writer
+            writer.detach()
+            if compress:
+                stream.close()
+
+def upload_to_gcs(data: str, bucket_name: str, blob_name: str, content_type: str = 'text/csv'):
+    with open_gcs_writer(bucket_name, blob_name, content_type=content_type) as writer:
+        writer.write(data)
+
+def read_from_gcs(bucket_name: str, blob_name: str) -> Optional[bytes]:
+    '''
+    Read the whole blob, returns None when the blob does not exist.
+    '''
+    if config.LOCAL_STORAGE_DIR:
+        try:
+            with open(get_local_blob_path(bucket_name, blob_name), 'rb') as reader:
+                return reader.read()
+        except FileNotFoundError:
+            return None
+
+    storage_client = get_storage_client()
+    try:
+        return storage_client.bucket(bucket_name).blob(blob_name).download_as_bytes()
+    except NotFound:
+        return None
+
+def list_gcs_blobs(bucket_name: str, prefix: str) -> List[str]:
+    if config.LOCAL_STORAGE_DIR:
+        bucket_path = get_local_blob_path(bucket_name, "")
+        blob_names = []
+        for directory, _, file_names in os.walk(bucket_path):
+            for file_name in file_names:
+                blob_name = os.path.relpath(os.path.join(directory, file_name), bucket_path).replace(os.sep, "/")
+                if blob_name.startswith(prefix):
+                    blob_names.append(blob_name)
+        return sorted(blob_names)
+
+    storage_client = get_storage_client()
+    return [blob.name for blob in storage_client.list_blobs(bucket_name, prefix=prefix)]
+
+def delete_gcs_blob(bucket_name: str, blob_name: str):
+    logger.info(f"Deleting {blob_name} from {bucket_name}")
+    if config.LOCAL_STORAGE_DIR:
+        os.remove(get_local_blob_path(bucket_name, blob_name))
+        return
+
+    storage_client = get_storage_client()
+    storage_client.bucket(bucket_name).blob(blob_name).delete()
@@ -0,0 +1,207 @@
+'''
+Peak-memory budget of an ingestion (its share of INGEST_MEMORY_BUDGET_BYTES, see IngestJobQueue), for the
+records it holds on top of the memory of the app itself. Sizes are estimated at ESTIMATED_RECORD_BYTES per
+record, the budget is shared as:
+    half for the raw pages in flight on the transform pool
+    a quarter for the raw records fetched ahead of their transform
+    a quarter for the rows buffered by the Parquet sinks
+Data beyond that is spilled to temporary files (see open_spill_file) or, for the records fetched ahead,
+waits for the transform to catch up. The aggregates of an ingestion (CrimeCounts of the time ranges and of
+the incident dates, the watermark) are not counted: they grow with the distinct coordinates, offense types
+and days, not with the records.
+'''
+import io
+import pickle
+import sys
+import tempfile
+import threading
+from collections import deque
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Tuple
+from config import config
+from constants import DATA_LIMIT, ESTIMATED_RECORD_BYTES, MIN_TRANSFORM_PAGE_RECORDS, PARQUET_BUFFER_BYTES
+from util.logger import logger
+
+def get_budget_records(budget_bytes: int) -> int:
+    return max(1, budget_bytes // ESTIMATED_RECORD_BYTES)
+
+def get_transform_page_records(workers: int, budget_bytes: int) -> int:
+    '''
+    Records per raw page submitted to the transform pool: DATA_LIMIT, or fewer (down to MIN_TRANSFORM_PAGE_RECORDS)
+    so that 2 pages per worker fit in the pool share of the budget.
+    '''
+    return max(MIN_TRANSFORM_PAGE_RECORDS, min(DATA_LIMIT, get_budget_records(budget_bytes // 2) // (2 * workers)))
+
+def get_max_pages_in_flight(workers: int, budget_bytes: int) -> int:
+    '''
+    Raw pages of get_transform_page_records records submitted to the transform pool at once, 2 per worker
+    within the pool share of the budget.
+    '''
+    return max(1, min(2 * workers, get_budget_records(budget_bytes // 2) // get_transform_page_records(workers, budget_bytes)))
+
+def get_parquet_buffer_bytes(sink_count: int, budget_bytes: int) -> int:
+    '''
+    Bytes of rows buffered by each of `sink_count` Parquet sinks before they spill, PARQUET_BUFFER_BYTES within
+    the budget. A smaller budget only spills more rows, the partition files and their row groups stay the same.
+    '''
+    return max(1, min(PARQUET_BUFFER_BYTES, budget_bytes // 4 // sink_count))
+
+def estimate_row_bytes(values: Tuple) -> int:
+    '''
+    Memory taken by a buffered row of values: the tuple and every value it holds.
+    '''
+    return sys.getsizeof(values) + sum(map(sys.getsizeof, values))
+
+def open_spill_file(prefix: str) -> BinaryIO:
+    '''
+    Temporary file of an ingestion, in INGEST_SPILL_DIR when set. The default system temporary directory
+    is in memory on Cloud Run, spilled data only leaves RAM on a mounted disk.
+    '''
+    return tempfile.TemporaryFile(prefix=prefix, dir=config.INGEST_SPILL_DIR or None)
+
+class RecordSpillBuffer:
+    '''
+    Pages of raw records buffered between a fetch and its ingestion, appended and iterated concurrently
+    (see iter_prefetched). Pages are kept in memory while they fit in `budget_bytes`, together with the page
+    being filled and the page being read. Up to `spill_bytes` of the following pages are pickled to a spill
+    file until the reader has caught up with them, beyond that `append` blocks until the reader frees room,
+    so the writer never runs further ahead than the budget allows.
+    Iterated once, in order, until `finish` is called: every page is released as soon as its records are consumed.
+    '''
+    def __init__(self, budget_bytes: int, spill_bytes: int = 0):
+        self.budget_records = get_budget_records(budget_bytes)
+        # a quarter of the budget, so a page being filled and a page being read fit next to the buffered ones
+        self.page_records = max(1, min(DATA_LIMIT, self.budget_records // 4))
+        self.spill_bytes = spill_bytes
+        self.record_count = 0
+        self.spilled_record_count = 0
+        self._condition = threading.Condition()
+        self._memory_pages = deque()
+        self._memory_record_count = 0
+        self._spill_file: Optional[BinaryIO] = None
+        self._spilled_page_count = 0
+        self._spill_read_offset = 0
+        self._spill_size = 0
+        self._finished = False
+        self._closed = False
+        self._error: Optional[BaseException] = None
+
+    def _fits_in_memory(self, page: List[dict]) -> bool:
+        # while spilled pages are left all the following ones are spilled, so the pages are read back in order
+        if self._spilled_page_count:
+            return False
+        return not self._memory_pages or self._memory_record_count + 3 * len(page) <= self.budget_records
+
+    def _fits_in_spill_file(self) -> bool:
+        return self._spill_size < self.spill_bytes
+
+    def append(self, page: List[dict]):
+        with self._condition:
+            self._condition.wait_for(lambda: self._closed or self._fits_in_memory(page) or self._fits_in_spill_file())
+            if self._closed:
+                return
+            self.record_count += len(page)
+            if self._fits_in_memory(page):
+                self._memory_pages.append(page)
+                self._memory_record_count += len(page)
+            else:
+                if self._spill_file is None:
+                    self._spill_file = open_spill_file("ingest-spill-")
+                    logger.info(f"Buffered {self._memory_record_count} raw records in memory, spilling the next pages to a temporary file")
+                self._spill_file.seek(0, io.SEEK_END)
+                pickle.dump(page, self._spill_file, protocol=pickle.HIGHEST_PROTOCOL)
+                self._spill_size = self._spill_file.tell()
+                self._spilled_page_count += 1
+                self.spilled_record_count += len(page)
+            self._condition.notify_all()
+
+    def fill(self, records: Iterable[dict], page_size: Optional[int] = None):
+        '''
+        Append the records in pages of `page_size` (`page_records` by default) and finish, stops early once
+        the buffer is closed. An error of `records` finishes the buffer after the records received before it.
+        '''
+        page_size = page_size or self.page_records
+        page = []
+        error = None
+        try:
+            for record in records:
+                page.append(record)
+                if len(page) == page_size:
+                    if self._closed:
+                        return
+                    self.append(page)
+                    page = []
+        except BaseException as fetch_error:
+            error = fetch_error
+        if page:
+            self.append(page)
+        self.finish(error)
+
+    def finish(self, error: Optional[BaseException] = None):
+        '''
+        Mark the end of the pages, `error` is raised to the reader once the pages before it are consumed.
+        '''
+        with self._condition:
+            self._finished = True
+            self._error = error
+            self._condition.notify_all()
+
+    def _next_page(self) -> Optional[List[dict]]:
+        with self._condition:
+            self._condition.wait_for(lambda: self._memory_pages or self._spilled_page_count or self._finished)
+            # the writer may be waiting for room
+            self._condition.notify_all()
+            if self._memory_pages:
+                page = self._memory_pages.popleft()
+                self._memory_record_count -= len(page)
+                return page
+            if self._spilled_page_count:
+                self._spill_file.seek(self._spill_read_offset)
+                page = pickle.load(self._spill_file)
+                self._spilled_page_count -= 1
+                self._spill_read_offset = self._spill_file.tell()
+                if not self._spilled_page_count:
+                    # the reader caught up, the next pages are kept in memory again
+                    self._spill_file.truncate(0)
+                    self._spill_read_offset = 0
+                    self._spill_size = 0
+                return page
+            if self._error is not None:
+                raise self._error
+            return None
+
+    def __len__(self) -> int:
+        return self.record_count
+
+    def __iter__(self) -> Iterator[dict]:
+        while (page := self._next_page()) is not None:
+            yield from page
+            del page
+        self.close()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._memory_pages.clear()
+            self._memory_record_count = 0
+            self._spilled_page_count = 0
+            if self._spill_file is not None:
+                self._spill_file.close()
+                self._spill_file = None
+            self._condition.notify_all()
+
+    def __enter__(self) -> "RecordSpillBuffer":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def iter_prefetched(records: Iterable[dict], budget_bytes: int, spill_bytes: int = 0) -> Iterator[dict]:
+    '''
+    Yield `records` (e.g. the paged fetch generator) while a background thread fetches ahead of the
+    consumer into a RecordSpillBuffer of `budget_bytes` (and `spill_bytes` on disk), so responses are read
+    off the wire as fast as they arrive instead of at the pace of the transform. The fetch pauses while
+    the buffer is full and stops when the consumer does.
+    '''
+    with RecordSpillBuffer(budget_bytes, spill_bytes) as buffer:
+        threading.Thread(target=buffer.fill, args=(records,), name="ingest-prefetch", daemon=True).start()
+        yield from buffer
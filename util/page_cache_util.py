@@ -0,0 +1,148 @@
+'''
+Local on-disk cache of raw Socrata pages, so retried or re-run fetches of the same window skip the network.
+
+Pages are stored gzip compressed, content-addressed by the sha256 of their request url (dataset, query
+and $limit/$offset, not the app token):
+    {SOCRATA_PAGE_CACHE_DIR}/{dataset identifier}/{sha[:2]}/{sha}.json.gz
+
+A page is fresh for SOCRATA_PAGE_CACHE_TTL_SECONDS after it was written, the window dates are part
+of the url so a new day never hits the pages of the previous one. Once the cache grows past
+SOCRATA_PAGE_CACHE_MAX_BYTES the oldest pages are evicted. Cached pages are read through mmap and
+decompressed straight from the mapping.
+'''
+import gzip
+import hashlib
+import mmap
+import os
+import threading
+import time
+import uuid
+import zlib
+from typing import Dict, Optional
+from config import config
+from constants import SOCRATA_PAGE_CACHE_COMPRESS_LEVEL
+from util.logger import logger
+
+PAGE_FILE_SUFFIX = ".json.gz"
+
+class SocrataPageCache:
+    def __init__(self, directory: str, max_bytes: int, ttl_seconds: float):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        # bytes on disk, scanned on first use then kept up to date by put and evict
+        self._size: Optional[int] = None
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get_page_path(self, dataset_identifier: str, url: str) -> str:
+        digest = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, dataset_identifier, digest[:2], f"{digest}{PAGE_FILE_SUFFIX}")
+
+    def get(self, dataset_identifier: str, url: str) -> Optional[bytes]:
+        '''
+        Raw response body of `url`, None when the page is not cached or not fresh anymore.
+        '''
+        path = self.get_page_path(dataset_identifier, url)
+        try:
+            with open(path, "rb") as reader:
+                stat = os.fstat(reader.fileno())
+                if stat.st_size == 0 or stat.st_mtime + self.ttl_seconds < time.time():
+                    body = None
+                else:
+                    with mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                        body = gzip.decompress(mapped)
+        except FileNotFoundError:
+            body = None
+        except (OSError, EOFError, zlib.error) as error:
+            # truncated or corrupt page, fetched again and overwritten
+            logger.warning(f"Ignoring unreadable cached page {path}: {error}")
+            body = None
+
+        with self._lock:
+            if body is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+        return body
+
+    def put(self, dataset_identifier: str, url: str, body: bytes):
+        path = self.get_page_path(dataset_identifier, url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = gzip.compress(body, compresslevel=SOCRATA_PAGE_CACHE_COMPRESS_LEVEL)
+        # written aside then renamed, readers never see a partial page
+        temporary_path = f"{path}.{uuid.uuid4().hex[:12]}.tmp"
+        with open(temporary_path, "wb") as writer:
+            writer.write(data)
+        try:
+            previous_size = os.path.getsize(path)
+        except FileNotFoundError:
+            previous_size = 0
+        os.replace(temporary_path, path)
+
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan_size()
+            else:
+                self._size += len(data) - previous_size
+            over_budget = self._size > self.max_bytes
+        if over_budget:
+            self.evict()
+
+    def _scan_size(self) -> int:
+        return sum(os.path.getsize(path) for path in self._iter_page_paths())
+
+    def _iter_page_paths(self):
+        for directory, _, file_names in os.walk(self.directory):
+            for file_name in file_names:
+                if file_name.endswith(PAGE_FILE_SUFFIX):
+                    yield os.path.join(directory, file_name)
+
+    def evict(self):
+        '''
+        Remove the oldest pages until the cache is back under 90% of max_bytes.
+        '''
+        pages = []
+        for path in self._iter_page_paths():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            pages.append((stat.st_mtime, stat.st_size, path))
+        pages.sort()
+
+        size = sum(page_size for _, page_size, _ in pages)
+        target_size = self.max_bytes * 0.9
+        evicted = 0
+        for _, page_size, path in pages:
+            if size <= target_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= page_size
+            evicted += 1
+
+        with self._lock:
+            self._size = size
+            self._evictions += evicted
+        logger.info(f"Evicted {evicted} pages from the Socrata page cache, {size} bytes left")
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+                "size_bytes": self._size or 0,
+                "max_bytes": self.max_bytes,
+            }
+
+# None when SOCRATA_PAGE_CACHE_DIR is not configured, every page is then fetched
+socrata_page_cache: Optional[SocrataPageCache] = (
+    SocrataPageCache(config.SOCRATA_PAGE_CACHE_DIR, config.SOCRATA_PAGE_CACHE_MAX_BYTES, config.SOCRATA_PAGE_CACHE_TTL_SECONDS)
+    if config.SOCRATA_PAGE_CACHE_DIR else None
+)
@@ -0,0 +1,231 @@
+import heapq
+import math
+from itertools import islice
+from typing import Callable, Dict, Iterable, List, NamedTuple, Sequence, Tuple
+from constants import SPATIAL_INDEX_CELL_DEGREES
+from util.spatial_util import parse_coordinate
+
+EARTH_RADIUS_METERS = 6371008.8
+METERS_PER_DEGREE_LATITUDE = math.pi * EARTH_RADIUS_METERS / 180.0
+
+# (latitude, longitude, crime_count)
+IndexedPoint = Tuple[float, float, int]
+CellKey = Tuple[int, int]
+
+class SpatialQueryResult(NamedTuple):
+    crime_count: int
+    coordinate_count: int
+    # the `limit` points with the most crimes, by crime count DESC
+    points: List[IndexedPoint]
+
+def haversine_meters(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    a = math.sin((phi2 - phi1) / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * math.asin(math.sqrt(a))
+
+def meters_per_degree_longitude(latitude: float) -> float:
+    return METERS_PER_DEGREE_LATITUDE * max(math.cos(math.radians(latitude)), 1e-6)
+
+class GridSpatialIndex:
+    '''
+    In-memory grid bucket index over crime coordinates.
+
+    Points are bucketed in square cells of `cell_degrees` and a query only visits the cells
+    overlapping its bounding box. Every cell keeps its crime total and its points sorted by
+    crime count, so cells entirely inside the query area are counted without looking at their
+    points and only the cells crossing the area boundary are filtered point by point.
+
+    Points carry the crime count of their coordinate, so a city is indexed from its
+    (coordinate -> count) aggregation instead of one point per crime. Points can be added
+    at any time without reorganizing the index, but an upload replaces the counts of its
+    window as a whole, so its index is rebuilt from them (see update_spatial_index).
+
+    Distances are measured in a local equirectangular projection, accurate at walking scale.
+    '''
+    def __init__(self, cell_degrees: float = SPATIAL_INDEX_CELL_DEGREES):
+        self.cell_degrees = cell_degrees
+        self.point_count = 0
+        self.crime_count = 0
+        self._cells: Dict[CellKey, List[IndexedPoint]] = {}
+        self._cell_crime_counts: Dict[CellKey, int] = {}
+        self._unsorted_cells = set()
+
+    def _cell(self, latitude: float, longitude: float) -> CellKey:
+        return math.floor(latitude / self.cell_degrees), math.floor(longitude / self.cell_degrees)
+
+    def _cell_corners(self, cell: CellKey) -> Tuple[Tuple[float, float], ...]:
+        min_lat = cell[0] * self.cell_degrees
+        min_lon = cell[1] * self.cell_degrees
+        max_lat = min_lat + self.cell_degrees
+        max_lon = min_lon + self.cell_degrees
+        return (min_lat, min_lon), (min_lat, max_lon), (max_lat, min_lon), (max_lat, max_lon)
+
+    def add(self, latitude: float, longitude: float, count: int = 1):
+        cell = self._cell(latitude, longitude)
+        self._cells.setdefault(cell, []).append((latitude, longitude, count))
+        self._cell_crime_counts[cell] = self._cell_crime_counts.get(cell, 0) + count
+        self._unsorted_cells.add(cell)
+        self.point_count += 1
+        self.crime_count += count
+
+    def add_coordinate_counts(self, coordinate_crime_data: Iterable[Tuple[Tuple[str, str], int]]) -> int:
+        '''
+        Add ((latitude, longitude), count) pairs of the unified data, invalid coordinates are skipped.
+        Returns the number of skipped coordinates.
+        '''
+        skipped = 0
+        for (latitude, longitude), count in coordinate_crime_data:
+            coordinate = parse_coordinate(latitude, longitude)
+            if coordinate is None:
+                skipped += 1
+                continue
+            self.add(coordinate[0], coordinate[1], count)
+        self.sort_cells()
+        return skipped
+
+    def sort_cells(self):
+        for cell in self._unsorted_cells:
+            self._cells[cell].sort(key=lambda point: point[2], reverse=True)
+        self._unsorted_cells.clear()
+
+    def _cells_in_bbox(self, min_lat: float, min_lon: float, max_lat: float, max_lon: float) -> List[CellKey]:
+        min_row, min_column = self._cell(min_lat, min_lon)
+        max_row, max_column = self._cell(max_lat, max_lon)
+        cells = self._cells
+        # Iterate over whichever is smaller, the covered cells or the occupied cells
+        if (max_row - min_row + 1) * (max_column - min_column + 1) <= len(cells):
+            return [
+                (row, column)
+                for row in range(min_row, max_row + 1)
+                for column in range(min_column, max_column + 1)
+                if (row, column) in cells
+            ]
+        return [
+            (row, column) for row, column in cells
+            if min_row <= row <= max_row and min_column <= column <= max_column
+        ]
+
+    def _query(
+        self,
+        cells: Iterable[CellKey],
+        contains: Callable[[float, float], bool],
+        limit: int
+    ) -> SpatialQueryResult:
+        '''
+        Aggregate the points of `cells` inside the (convex) query area tested by `contains`.
+        A cell whose four corners are inside the area is entirely inside it.
+        '''
+        if self._unsorted_cells:
+            self.sort_cells()
+        crime_count = 0
+        coordinate_count = 0
+        matched_point_lists: List[List[IndexedPoint]] = []
+        for cell in cells:
+            points = self._cells[cell]
+            if all(contains(latitude, longitude) for latitude, longitude in self._cell_corners(cell)):
+                crime_count += self._cell_crime_counts[cell]
+                coordinate_count += len(points)
+            else:
+                points = [point for point in points if contains(point[0], point[1])]
+                crime_count += sum(point[2] for point in points)
+                coordinate_count += len(points)
+            if limit and points:
+                matched_point_lists.append(points)
+        top_points = list(islice(heapq.merge(*matched_point_lists, key=lambda point: point[2], reverse=True), limit))
+        return SpatialQueryResult(crime_count, coordinate_count, top_points)
+
+    def query_bbox(self, min_lat: float, min_lon: float, max_lat: float, max_lon: float, limit: int = 0) -> SpatialQueryResult:
+        return self._query(
+            self._cells_in_bbox(min_lat, min_lon, max_lat, max_lon),
+            lambda latitude, longitude: min_lat <= latitude <= max_lat and min_lon <= longitude <= max_lon,
+            limit
+        )
+
+    def query_radius(self, latitude: float, longitude: float, radius_meters: float, limit: int = 0) -> SpatialQueryResult:
+        x_scale = meters_per_degree_longitude(latitude)
+        lat_delta = radius_meters / METERS_PER_DEGREE_LATITUDE
+        lon_delta = radius_meters / x_scale
+        radius_squared = radius_meters * radius_meters
+
+        def contains(point_lat: float, point_lon: float) -> bool:
+            dx = (point_lon - longitude) * x_scale
+            dy = (point_lat - latitude) * METERS_PER_DEGREE_LATITUDE
+            return dx * dx + dy * dy <= radius_squared
+
+        return self._query(
+            self._cells_in_bbox(latitude - lat_delta, longitude - lon_delta, latitude + lat_delta, longitude + lon_delta),
+            contains,
+            limit
+        )
+
+    def query_polyline(self, path: Sequence[Tuple[float, float]], width_meters: float, limit: int = 0) -> Tuple[SpatialQueryResult, List[int]]:
+        '''
+        Points within `width_meters` of the polyline `path` of (latitude, longitude) vertices,
+        each point counted once. Also returns the crime count of every segment, a point
+        close to several segments is counted in the first one.
+        '''
+        if len(path) == 1:
+            result = self.query_radius(path[0][0], path[0][1], width_meters, limit)
+            return result, [result.crime_count]
+
+        width_squared = width_meters * width_meters
+        lat_delta = width_meters / METERS_PER_DEGREE_LATITUDE
+        # the cells and the points of partially covered cells counted by the previous segments
+        counted_cells = set()
+        counted_points: Dict[CellKey, set] = {}
+        crime_count = 0
+        coordinate_count = 0
+        matched_point_lists: List[List[IndexedPoint]] = []
+        segment_crime_counts: List[int] = []
+        if self._unsorted_cells:
+            self.sort_cells()
+
+        for (lat1, lon1), (lat2, lon2) in zip(path, path[1:]):
+            x_scale = meters_per_degree_longitude((lat1 + lat2) / 2)
+            lon_delta = width_meters / x_scale
+            # segment from (0, 0) to (dx, dy) in meters
+            dx = (lon2 - lon1) * x_scale
+            dy = (lat2 - lat1) * METERS_PER_DEGREE_LATITUDE
+            length_squared = dx * dx + dy * dy
+
+            def contains(point_lat: float, point_lon: float) -> bool:
+                px = (point_lon - lon1) * x_scale
+                py = (point_lat - lat1) * METERS_PER_DEGREE_LATITUDE
+                t = 0.0 if length_squared == 0 else max(0.0, min(1.0, (px * dx + py * dy) / length_squared))
+                ex = px - t * dx
+                ey = py - t * dy
+                return ex * ex + ey * ey <= width_squared
+
+            segment_crime_count = 0
+            cells = self._cells_in_bbox(
+                min(lat1, lat2) - lat_delta, min(lon1, lon2) - lon_delta,
+                max(lat1, lat2) + lat_delta, max(lon1, lon2) + lon_delta
+            )
+            for cell in cells:
+                if cell in counted_cells:
+                    continue
+                counted = counted_points.get(cell)
+                if counted is None and all(contains(latitude, longitude) for latitude, longitude in self._cell_corners(cell)):
+                    points = self._cells[cell]
+                    cell_crime_count = self._cell_crime_counts[cell]
+                    counted_cells.add(cell)
+                else:
+                    points = [
+                        point for point in self._cells[cell]
+                        if (counted is None or id(point) not in counted) and contains(point[0], point[1])
+                    ]
+                    cell_crime_count = sum(point[2] for point in points)
+                if not points:
+                    continue
+                if cell not in counted_cells:
+                    counted_points.setdefault(cell, set()).update(id(point) for point in points)
+                segment_crime_count += cell_crime_count
+                coordinate_count += len(points)
+                if limit:
+                    matched_point_lists.append(points)
+            crime_count += segment_crime_count
+            segment_crime_counts.append(segment_crime_count)
+
+        top_points = list(islice(heapq.merge(*matched_point_lists, key=lambda point: point[2], reverse=True), limit))
+        return SpatialQueryResult(crime_count, coordinate_count, top_points), segment_crime_counts
@@ -0,0 +1,112 @@
+from typing import Dict, Optional, Tuple
+from constants import GEOHASH_MIN_PRECISION, GEOHASH_MAX_PRECISION
+
+GEOHASH_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+GEOHASH_BASE32_INDEX = {char: index for index, char in enumerate(GEOHASH_BASE32)}
+
+def parse_coordinate(latitude: Optional[str], longitude: Optional[str]) -> Optional[Tuple[float, float]]:
+    '''
+    Parse a (latitude, longitude) pair of the unified data, None for empty, malformed or
+    out of range values and for (0, 0), which some city feeds use for a missing location.
+    '''
+    try:
+        lat = float(latitude)
+        lon = float(longitude)
+    except (TypeError, ValueError):
+        return None
+    if not (-90.0 <= lat <= 90.0 and -180.0 <= lon <= 180.0):
+        # also rejects nan
+        return None
+    if lat == 0.0 and lon == 0.0:
+        return None
+    return lat, lon
+
+def _spread_bits(value: int) -> int:
+    # Move bit i of a 32 bit value to bit 2i
+    value = (value | (value << 16)) & 0x0000FFFF0000FFFF
+    value = (value | (value << 8)) & 0x00FF00FF00FF00FF
+    value = (value | (value << 4)) & 0x0F0F0F0F0F0F0F0F
+    value = (value | (value << 2)) & 0x3333333333333333
+    value = (value | (value << 1)) & 0x5555555555555555
+    return value
+
+def encode_geohash(latitude: float, longitude: float, precision: int) -> str:
+    '''
+    Geohash of the point at `precision` characters.
+    The bisections of the geohash are the bits of the quantized coordinates, so both axes
+    are quantized once and their bits interleaved (longitude first) instead of bisecting bit by bit.
+    '''
+    axis_bits = (5 * precision + 1) // 2
+    cells = 1 << axis_bits
+    lat_index = min(int((latitude + 90.0) / 180.0 * cells), cells - 1)
+    lon_index = min(int((longitude + 180.0) / 360.0 * cells), cells - 1)
+    code = (_spread_bits(lon_index) << 1) | _spread_bits(lat_index)
+    # With an odd number of bits the last latitude bit is not part of the geohash
+    code >>= 2 * axis_bits - 5 * precision
+    return "".join(GEOHASH_BASE32[(code >> shift) & 31] for shift in range(5 * (precision - 1), -1, -5))
+
+def decode_geohash_center(geohash: str) -> Tuple[float, float]:
+    '''
+    (latitude, longitude) of the center of the geohash cell.
+    '''
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    is_lon = True
+    for char in geohash:
+        bits = GEOHASH_BASE32_INDEX[char]
+        for shift in range(4, -1, -1):
+            axis_range = lon_range if is_lon else lat_range
+            mid = (axis_range[0] + axis_range[1]) / 2
+            if (bits >> shift) & 1:
+                axis_range[0] = mid
+            else:
+                axis_range[1] = mid
+            is_lon = not is_lon
+    return (lat_range[0] + lat_range[1]) / 2, (lon_range[0] + lon_range[1]) / 2
+
+def get_geohash_cell_coordinate(geohash: str) -> Tuple[str, str]:
+    '''
+    Cell center in the ('latitude', 'longitude') string form of the raw coordinates,
+    rounded to the decimals that are meaningful at the precision of the cell.
+    '''
+    latitude, longitude = decode_geohash_center(geohash)
+    decimals = max(1, len(geohash) - 1)
+    return str(round(latitude, decimals)), str(round(longitude, decimals))
+
+class SpatialBinCounter:
+    '''
+    Counts crimes per geohash cell at every precision between `min_precision` and `max_precision`.
+
+    A point is only hashed once, at `max_precision`: the geohash of a coarser cell is a prefix
+    of it, so the coarser levels are rolled up from the finest cells when they are read.
+    Empty and invalid coordinates are dropped and counted in `dropped`.
+    '''
+    def __init__(self, min_precision: int = GEOHASH_MIN_PRECISION, max_precision: int = GEOHASH_MAX_PRECISION):
+        self.min_precision = min_precision
+        self.max_precision = max_precision
+        self.dropped = 0
+        self._finest_cells: Dict[str, int] = {}
+
+    def add(self, latitude: Optional[str], longitude: Optional[str], count: int = 1) -> bool:
+        coordinate = parse_coordinate(latitude, longitude)
+        if coordinate is None:
+            self.dropped += count
+            return False
+        geohash = encode_geohash(coordinate[0], coordinate[1], self.max_precision)
+        self._finest_cells[geohash] = self._finest_cells.get(geohash, 0) + count
+        return True
+
+    @property
+    def precisions(self) -> range:
+        return range(self.min_precision, self.max_precision + 1)
+
+    def cells(self, precision: int) -> Dict[str, int]:
+        if precision not in self.precisions:
+            raise ValueError(f"Geohash precision must be between {self.min_precision} and {self.max_precision}, got {precision}")
+        if precision == self.max_precision:
+            return dict(self._finest_cells)
+        cells: Dict[str, int] = {}
+        for geohash, count in self._finest_cells.items():
+            cell = geohash[:precision]
+            cells[cell] = cells.get(cell, 0) + count
+        return cells
@@ -0,0 +1,130 @@
+import base64
+import codecs
+import json
+from itertools import islice
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+from constants import COORDINATE_STREAM_BATCH_ROWS
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+def iter_ndjson(rows: Iterable[Dict[str, Any]], batch_rows: int = COORDINATE_STREAM_BATCH_ROWS) -> Iterator[bytes]:
+    '''
+    Serialize rows as newline delimited JSON, one chunk per `batch_rows` rows.
+    '''
+    rows = iter(rows)
+    while batch := list(islice(rows, batch_rows)):
+        yield "".join(json.dumps(row) + "\n" for row in batch).encode("utf-8")
+
+def iter_json_object(fields: Dict[str, Any], array_field: str, rows: Iterable[Dict[str, Any]], batch_rows: int = COORDINATE_STREAM_BATCH_ROWS) -> Iterator[bytes]:
+    '''
+    Serialize {**fields, array_field: [*rows]} as chunked JSON, one chunk per `batch_rows` rows of the array,
+    without building the whole document in memory.
+    '''
+    head = json.dumps(fields)[:-1]
+    separator = ", " if fields else ""
+    yield f'{head}{separator}"{array_field}": ['.encode("utf-8")
+    rows = iter(rows)
+    first = True
+    while batch := list(islice(rows, batch_rows)):
+        chunk = ", ".join(json.dumps(row) for row in batch)
+        yield (chunk if first else ", " + chunk).encode("utf-8")
+        first = False
+    yield b"]}"
+
+_json_decoder = json.JSONDecoder()
+_whitespace = " \t\n\r"
+_delimiters = _whitespace + ",]"
+
+class JsonArrayDecoder:
+    '''
+    Incremental decoder of a JSON array fed with the utf-8 chunks of a response body, every element
+    is returned as soon as its bytes have arrived and only the undecoded tail of the body is kept.
+    Raises ValueError for malformed input, `finish` also for truncated input.
+    '''
+    def __init__(self):
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ""
+        self._started = False
+        self.finished = False
+
+    def feed(self, chunk: bytes) -> List[Any]:
+        self._buffer += self._decoder.decode(chunk)
+        return self._decode_elements(end_of_input=False)
+
+    def finish(self) -> List[Any]:
+        self._buffer += self._decoder.decode(b"", final=True)
+        elements = self._decode_elements(end_of_input=True)
+        if not self.finished:
+            raise ValueError("Truncated JSON array")
+        return elements
+
+    def _decode_elements(self, end_of_input: bool) -> List[Any]:
+        buffer = self._buffer
+        position = 0
+        elements = []
+        while position < len(buffer) and not self.finished:
+            # skip whitespace and the array punctuation in front of the next element
+            character = buffer[position]
+            if character in _whitespace:
+                position += 1
+            elif not self._started:
+                if character != "[":
+                    raise ValueError(f"Expected a JSON array, got {character!r}")
+                self._started = True
+                position += 1
+            elif character == ",":
+                position += 1
+            elif character == "]":
+                self.finished = True
+            else:
+                try:
+                    element, end = _json_decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    # incomplete element, wait for more bytes
+                    if end_of_input:
+                        raise
+                    break
+                # a number cut by the chunk boundary decodes as its prefix (e.g. "2." as 2), it is only
+                # complete once a delimiter follows, objects and strings end on their own delimiter
+                if not end_of_input and not isinstance(element, (dict, list, str)) and (end == len(buffer) or buffer[end] not in _delimiters):
+                    break
+                elements.append(element)
+                position = end
+        self._buffer = buffer[position:]
+        return elements
+
+def iter_json_array(chunks: Iterable[bytes]) -> Iterator[Any]:
+    '''
+    Yield the elements of the JSON array made of the utf-8 `chunks` as the chunks are consumed.
+    '''
+    decoder = JsonArrayDecoder()
+    for chunk in chunks:
+        yield from decoder.feed(chunk)
+    yield from decoder.finish()
+
+def encode_cursor(offset: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps({"offset": offset}).encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: str) -> int:
+    '''
+    Offset of an opaque cursor made by encode_cursor, raises ValueError for malformed cursors.
+    '''
+    try:
+        offset = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))["offset"]
+    except Exception:
+        raise ValueError(f"Invalid cursor: {cursor}")
+    if not isinstance(offset, int) or offset < 0:
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return offset
+
+def paginate(rows: Sequence[Any], offset: int = 0, page_size: Optional[int] = None, top_n: Optional[int] = None) -> Tuple[Sequence[Any], Optional[str]]:
+    '''
+    The page of `rows` starting at `offset`, limited to the first `top_n` rows, and the cursor
+    of the next page (None on the last page).
+    '''
+    end = len(rows) if top_n is None else min(top_n, len(rows))
+    if page_size is None:
+        return rows[offset:end], None
+    page_end = min(offset + page_size, end)
+    next_cursor = encode_cursor(page_end) if page_end < end else None
+    return rows[offset:page_end], next_cursor
@@ -0,0 +1,45 @@
+from datetime import datetime, tzinfo
+from functools import lru_cache
+from typing import Dict, List, Sequence
+
+SOCRATA_DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+# Socrata floating timestamps always come as e.g. 2024-01-31T13:45:00.000
+SOCRATA_DATETIME_LENGTH = len("2024-01-31T13:45:00.000")
+TIMESTAMP_CACHE_SIZE = 65536
+
+def parse_socrata_datetime(value: str) -> datetime:
+    '''
+    Parse a naive Socrata floating timestamp. The fixed format is handled by the C
+    fromisoformat parser, anything else goes through strptime which raises ValueError
+    for values not matching SOCRATA_DATETIME_FORMAT.
+    '''
+    value = value.strip()
+    if len(value) == SOCRATA_DATETIME_LENGTH and value[10] == "T":
+        return datetime.fromisoformat(value)
+    return datetime.strptime(value, SOCRATA_DATETIME_FORMAT)
+
+class TimestampNormalizer:
+    '''
+    Turns the naive floating timestamps of a city dataset into timezone-aware datetimes.
+
+    Socrata floating timestamps carry no offset and are the local wall time of the city,
+    so they are localized in the city timezone (not converted from the host timezone).
+    Parsed values are memoized, Socrata feeds repeat the same timestamps a lot
+    (e.g. many NYC complaints share a midnight cmplnt_fr_dt).
+    '''
+    def __init__(self, timezone: tzinfo, cache_size: int = TIMESTAMP_CACHE_SIZE):
+        self.timezone = timezone
+        self.normalize = lru_cache(maxsize=cache_size)(self._normalize)
+
+    def _normalize(self, value: str) -> datetime:
+        naive_datetime = parse_socrata_datetime(value)
+        if hasattr(self.timezone, "localize"):
+            return self.timezone.localize(naive_datetime)
+        return naive_datetime.replace(tzinfo=self.timezone)
+
+    def normalize_many(self, values: Sequence[str]) -> List[datetime]:
+        '''
+        Normalize a whole page of timestamps, each distinct value is parsed and localized once.
+        '''
+        normalized: Dict[str, datetime] = {value: self.normalize(value) for value in set(values)}
+        return [normalized[value] for value in values]
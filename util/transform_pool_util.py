@@ -0,0 +1,88 @@
+'''
+Process pool transform of raw record pages, so large ingestions use every core instead of one.
+
+Pages are sharded across TRANSFORM_WORKERS spawned processes, at most `2 * workers` pages are in
+flight (fewer when they don't fit in the ingestion memory budget) and the transformed pages come
+back in input order. Workers don't send UnifiedCrimeData
+lists back: every column of a transformed page is dictionary encoded (distinct values + an
+array of uint32 codes), which pickles to a fraction of the size since most columns (offense types,
+timestamps, victim fields) repeat a lot, and the parent rebuilds the rows from the columns.
+'''
+import multiprocessing
+import threading
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+from models.crime_data_models import UnifiedCrimeData, compile_unified_transform
+from util.logger import logger
+
+# (distinct values, codes) of every UnifiedCrimeData field
+CompactPage = List[Tuple[List[Any], array]]
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+
+def dictionary_encode(values: Iterable[Any]) -> Tuple[List[Any], array]:
+    index: Dict[Any, int] = {}
+    codes = array("I", [index.setdefault(value, len(index)) for value in values])
+    return list(index), codes
+
+def transform_page_compact(city_model: type, records: List[dict]) -> CompactPage:
+    '''
+    Worker side: transform a page with the compiled plan of `city_model` (memoized per worker process)
+    and dictionary encode its columns.
+    '''
+    rows = compile_unified_transform(city_model).transform_page_values(records)
+    return [dictionary_encode(column) for column in zip(*rows)] if rows else []
+
+def decode_compact_page(page: CompactPage) -> List[UnifiedCrimeData]:
+    columns = [[values[code] for code in codes] for values, codes in page]
+    return list(map(UnifiedCrimeData, *columns))
+
+def get_transform_pool(workers: int) -> ProcessPoolExecutor:
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers != workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False, cancel_futures=True)
+            # spawned, not forked: the parent runs threads (job workers, backend pools) that fork would copy mid-flight
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+            _pool_workers = workers
+            logger.info(f"Started the transform pool with {workers} worker processes")
+        return _pool
+
+def transform_pages_in_pool(city_model: type, pages: Iterable[List[dict]], workers: int, max_in_flight: Optional[int] = None) -> Iterator[List[UnifiedCrimeData]]:
+    '''
+    Transform the raw `pages` on the process pool, yields the transformed pages in input order.
+    At most `max_in_flight` (default `2 * workers`) pages are submitted at once.
+    '''
+    global _pool
+    pool = get_transform_pool(workers)
+    max_in_flight = max_in_flight or 2 * workers
+    in_flight = deque()
+    try:
+        for page in pages:
+            in_flight.append(pool.submit(transform_page_compact, city_model, page))
+            if len(in_flight) >= max_in_flight:
+                yield decode_compact_page(in_flight.popleft().result())
+        while in_flight:
+            yield decode_compact_page(in_flight.popleft().result())
+    except BrokenProcessPool:
+        # a worker died (e.g. OOM killed), the next ingestion starts a fresh pool
+        with _pool_lock:
+            if _pool is pool:
+                _pool = None
+        raise
+    finally:
+        for future in in_flight:
+            future.cancel()
+
+def shutdown_transform_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None